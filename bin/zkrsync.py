@@ -40,8 +40,13 @@ from kazoo.security import make_digest_acl
 from vsc.utils import fancylogger
 from vsc.utils.daemon import Daemon
 from vsc.utils.generaloption import simple_option
+from vsc.zk.base import ZKRS_NO_SUCH_SESSION_EXIT_CODE
+from vsc.zk.rsync.concurrency import METRICS
 from vsc.zk.rsync.destination import RsyncDestination
+from vsc.zk.rsync.history import RunHistory
+from vsc.zk.rsync.loadmonitor import IOWAIT, MEMPRESSURE, WRITELATENCY, CONNECTIONS
 from vsc.zk.rsync.source import RsyncSource
+from vsc.zk.topology import TOPO_MODES
 
 TIME_OUT = 5
 CL_DEST = "dest"
@@ -102,18 +107,62 @@ def get_state(servers, kwargs):
     rsyncP.exit()
     sys.exit(code)
 
+def set_bwlimit(servers, bwlimit, kwargs):
+    """Change the bandwidth budget of a running session"""
+    kwargs['verifypath'] = False # Not needed to set the budget
+    rsyncP = RsyncSource(servers, rsyncdepth=0, **kwargs)
+    rsyncP.set_bwlimit(bwlimit)
+    rsyncP.exit()
+    sys.exit(0)
+
+def drain_clients(servers, clients, kwargs):
+    """Ask clients of a running session to leave it when idle"""
+    kwargs['verifypath'] = False # Not needed to drain
+    rsyncP = RsyncSource(servers, rsyncdepth=0, **kwargs)
+    rsyncP.drain(clients)
+    rsyncP.exit()
+    sys.exit(0)
+
+def show_history(options):
+    """Report the runs of a session from the local history, flagging regressions. Exits 1 if the last run regressed"""
+    if not options.historydb:
+        logger.error('No history database given!')
+        sys.exit(1)
+    trend = RunHistory(options.historydb).trend(options.history, threshold=options.regression)
+    if not trend:
+        logger.error('No runs of session %s in history %s', options.history, options.historydb)
+        sys.exit(ZKRS_NO_SUCH_SESSION_EXIT_CODE)
+
+    print(f"{'finished':<20}{'walltime':>10}{'walk':>8}{'enqueue':>8}{'MiB/s':>9}{'paths':>9}{'failed':>8}"
+          f"{'workers':>8}{'depth':>6}  regressions")
+    for run, flags in trend:
+        finished = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(run['finished']))
+        regressions = ', '.join(f'{metric} {change:+.0%}' for metric, change in flags.items())
+        print(f"{finished:<20}{run['walltime'] or 0:>10.0f}{run['walktime'] or 0:>8.0f}{run['enqueuetime'] or 0:>8.0f}"
+              f"{(run['throughput'] or 0) / 2**20:>9.1f}{run['paths'] or 0:>9}{run['failed'] or 0:>8}"
+              f"{run['workers'] or 0:>8}{run['depth'] or 0:>6}  {regressions}")
+
+    last, flags = trend[-1]
+    print('Slowest paths of the last run:')
+    for path, duration in last['slowest']:
+        print(f'{duration:>10.0f}s  {path}')
+    sys.exit(1 if flags else 0)
+
 def do_pathsonly(options, kwargs):
     """Only build the pathqueue and return timings"""
     kwargs['rsyncdepth'] = options.depth
     kwargs['excludere'] = options.excludere
     kwargs['excl_usr'] = options.excl_usr
     kwargs['rsubpaths'] = options.rsubpaths
+    kwargs['topology'] = options.topology
+    kwargs['topomap'] = options.topomap
+    kwargs['topocommand'] = options.topocommand
 
     rsyncP = RsyncSource(options.servers, **kwargs)
     locked = rsyncP.acq_lock()
     if locked:
         starttime = time.time()
-        rsyncP.build_pathqueue()
+        rsyncP.build_pathqueue(checkpoint=False)
         endtime = time.time()
         timing = endtime - starttime
         pathqueue = rsyncP.path_queue
@@ -132,6 +181,14 @@ def start_destination(options, kwargs):
     kwargs['rsyncport'] = options.rsyncport
     kwargs['startport'] = options.startport
     kwargs['domain'] = options.domain
+    kwargs['locality'] = options.locality
+    kwargs['loadlimits'] = {
+        IOWAIT: options.maxiowait,
+        MEMPRESSURE: options.maxmempressure,
+        WRITELATENCY: options.maxwritelatency,
+        CONNECTIONS: options.maxconnections,
+    }
+    kwargs['loadhysteresis'] = options.loadhysteresis
     rsyncD = RsyncDestination(options.servers, **kwargs)
     rsyncD.run()
 
@@ -146,6 +203,8 @@ def start_source(options, kwargs):
     kwargs['arbitopts'] = options.arbitopts
     kwargs['checksum'] = options.checksum
     kwargs['done_file'] = options.done_file
+    kwargs['report'] = options.report
+    kwargs['historydb'] = options.historydb
     kwargs['dryrun'] = options.dryrun
     kwargs['delete'] = options.delete
     kwargs['excludere'] = options.excludere
@@ -153,9 +212,37 @@ def start_source(options, kwargs):
     kwargs['hardlinks'] = options.hardlinks
     kwargs['inplace'] = options.inplace
     kwargs['timeout'] = options.timeout
+    kwargs['topology'] = options.topology
+    kwargs['topomap'] = options.topomap
+    kwargs['topocommand'] = options.topocommand
+    kwargs['topocap'] = options.topocap
     kwargs['verbose'] = options.verbose
+    kwargs['workers'] = options.workers
+    kwargs['adaptive'] = options.adaptive
+    kwargs['adaptinterval'] = options.adaptinterval
+    kwargs['domain'] = options.domain
+    kwargs['locality'] = options.locality
+    kwargs['destpolicy'] = options.destpolicy
+    kwargs['leasetimeout'] = options.leasetimeout
+    kwargs['stalltimeout'] = options.stalltimeout
+    kwargs['minrate'] = options.minrate * 1024
+    kwargs['maxstalls'] = options.maxstalls
+    kwargs['maxretries'] = options.maxretries
+    kwargs['retrydelay'] = options.retrydelay
+    kwargs['lookahead'] = options.lookahead
+    kwargs['prewarm'] = options.prewarm
+    kwargs['destprewarm'] = options.destprewarm
+    kwargs['progressinterval'] = options.progressinterval
+    kwargs['metricsport'] = options.metricsport
+    if options.metricsfile:
+        kwargs['metricsfile'] = options.metricsfile % {
+            'session': options.session,
+            'rstype': CL_SOURCE,
+            'pid': str(os.getpid())
+        }
     # Start zookeeper connections
     rsyncS = RsyncSource(options.servers, **kwargs)
+    rsyncS.start_metrics()
     # Try to retrieve session lock
     locked = rsyncS.acq_lock()
 
@@ -164,16 +251,21 @@ def start_source(options, kwargs):
         watchnode = rsyncS.start_ready_rwatch()
         if not watchnode:
             sys.exit(1)
-        rsyncS.build_pathqueue()
+        if options.bwlimit is not None:
+            rsyncS.set_bwlimit(options.bwlimit)
+        if not options.resume or rsyncS.resume_pathqueue() is None:
+            rsyncS.build_pathqueue()
         rsyncS.wait_and_keep_progress()
         rsyncS.shutdown_all()
 
     else:
         rsyncS.ready_with_stop_watch()
+        rsyncS.watch_bwlimit()
+        rsyncS.watch_drain()
+        rsyncS.watch_master()
         logger.debug('ready to process paths')
-        while not rsyncS.is_ready():
-            logger.debug('trying to get a path out of Queue')
-            rsyncS.rsync(TIME_OUT)
+        rsyncS.run_workers(TIME_OUT)
+        rsyncS.stop_contending()
 
         logger.debug('%s Ready', rsyncS.get_whoami())
 
@@ -185,12 +277,18 @@ def zkrsync_parse(options):
     if not options.servers:
         logger.error("No servers given!")
         sys.exit(1)
-    if not options.rsyncpath:
-        logger.error("Path is mandatory!")
+    if not options.rsyncpath and not options.rsyncroots:
+        logger.error("Path or rsync roots are mandatory!")
         sys.exit(1)
     if options.depth <= 0:
         logger.error("Invalid depth!")
         sys.exit(1)
+    if options.workers <= 0:
+        logger.error("Invalid number of workers!")
+        sys.exit(1)
+    if options.setbwlimit and options.bwlimit is None:
+        logger.error("No bwlimit given to set!")
+        sys.exit(1)
 
     rootcreds = [('digest', options.user + ':' + options.passwd)]
     admin_acl = make_digest_acl(options.user, options.passwd, all=True)
@@ -211,6 +309,10 @@ def start_zkrs(rstype, options, kwargs):
     """ Start a run of zkrs"""
     if options.state:
         get_state(options.servers, kwargs)
+    elif options.setbwlimit:
+        set_bwlimit(options.servers, options.bwlimit, kwargs)
+    elif options.drain:
+        drain_clients(options.servers, options.drain, kwargs)
     elif options.pathsonly:
         do_pathsonly(options, kwargs)
     elif rstype == CL_DEST:
@@ -230,37 +332,99 @@ def main():
         'destination' : ('rsync destination', None, 'store_true', False, 'D'),
         'pathsonly'   : ('Only do a test run of the pathlist building', None, 'store_true', False),
         'state'       : ('Only do the state', None, 'store_true', False),
+        'setbwlimit'  : ('Only set the bandwidth budget of a running session to bwlimit', None, 'store_true', False),
+        'drain'       : ('Only ask these clients (ids as shown by the master) of a running session to finish ' +
+                         'their current work and leave', 'strlist', 'store', None),
         # Session options; should be the same on all clients of the session!
         'session'     : ('session name', None, 'store', 'default', 'N'),
+        'resume'      : ('resume the checkpoint of an interrupted session instead of walking the paths again',
+                         None, 'store_true', False),
         'netcat'      : ('run netcat test instead of rsync', None, 'store_true', False),
         'dryrun'      : ('run rsync in dry run mode', None, 'store_true', False, 'n'),
         'rsyncpath'   : ('rsync basepath', None, 'store', None, 'r'),  # May differ between sources and dests
+        'rsyncroots'  : ('extra rsync basepaths, specified as <rootid>:<path>. Each root is exported as a separate '
+                         'destination module, root ids should be the same on all clients', 'strlist', 'store', None),
         # Pathbuilding (Source clients and pathsonly ) specific options:
         'rsubpaths'   : ('rsync subpaths, specified as <depth>_<path>, with deepest paths last',
                             'strlist', 'store', None),
         'excludere'   : ('Exclude from pathbuilding', None, 'regex', re.compile(r'/\.snapshots(/.*|$)')),
         'excl_usr'    : ('If set, exclude paths for this user only when using excludere', None, 'store', 'root'),
         'depth'       : ('queue depth', "int", 'store', 3),
+        'topology'    : ('spread the paths over the storage units they live on, by device id, path prefix ' +
+                         '(see topomap) or the output of topocommand', 'choice', 'store', None, TOPO_MODES),
+        'topomap'     : ('topology keys for the prefix mode, specified as <pathprefix>:<key>',
+                         'strlist', 'store', None),
+        'topocommand' : ('command returning the topology key of a path (e.g. a GPFS fileset lookup), ' +
+                         'with %(path)s as placeholder', None, 'store', None),
+        'topocap'     : ('maximum concurrent rsyncs per topology key (0 is unlimited)', "int", 'store', 0),
         # Source clients options; should be the same on all clients of the session!:
         'delete'      : ('run rsync with --delete', None, 'store_true', False),
         'checksum'    : ('run rsync with --checksum', None, 'store_true', False),
         'hardlinks'   : ('run rsync with --hard-links', None, 'store_true', False),
         'inplace'     : ('run rsync with --inplace', None, 'store_true', False),
+        'bwlimit'     : ('bandwidth budget in KiB/s for the whole session, divided among the sources with ' +
+                         '--bwlimit (0 is unlimited)', "int", 'store', None),
         # Individual client options
         'verifypath'  : ('Check basepath exists while running', None, 'store_false', True),
         'daemon'      : ('daemonize client', None, 'store_true', False),
         'domain'      : ('substitute domain', None, 'store', None),
+        'locality'    : ('locality labels of this client, most specific first (eg. rack1,row2,dc1). ' +
+                         'Default are the domain suffixes of its hostname', 'strlist', 'store', None),
         'done-file'   : ('cachefile to write state to when done', None, 'store', None),
+        'report'      : ('gzipped JSONL file to write the details of every path to when done', None, 'store', None),
+        'historydb'   : ('local database the master adds a summary of every finished run to', None, 'store', None),
+        'history'     : ('Only report the runs of this session from historydb, flagging regressions',
+                         None, 'store', None),
+        'regression'  : ('relative change against the median of the previous runs that is flagged as regression',
+                         "float", 'store', 0.2),
         'dropcache'   : ('run rsync with --drop-cache', None, 'store_true', False),
+        'zkstats'     : ('count and time all zookeeper calls per role, operation and call site, and log a summary ' +
+                         'at exit and every this many seconds (0 for only at exit)', "int", 'store', None),
         'logfile'     : ('Output to logfile', None, 'store', '/tmp/zkrsync/%(session)s-%(rstype)s-%(pid)s.log'),
         'pidfile'     : ('Pidfile template', None, 'store', '/tmp/zkrsync/%(session)s-%(rstype)s-%(pid)s.pid'),
         'max_bytes'   : ('logfile size', None, 'store', 1024 * 1024 * 100),
         'backup_count': ('logfile backups', None, 'store', 5),
         'timeout'     : ('run rsync with --timeout TIMEOUT', "int", 'store', 0),
         'verbose'     : ('run rsync with --verbose', None, 'store_true', False),
+        'workers'     : ('maximum number of concurrent rsyncs of a source client', "int", 'store', 1),
+        'adaptive'    : ('adapt the number of active workers to the throughput of finished paths, ' +
+                         'measured in bytes or files', 'choice', 'store', None, METRICS),
+        'adaptinterval': ('interval in seconds between adaptive concurrency decisions', "int", 'store', 120),
+        'leasetimeout': ('seconds without heartbeat after which the master frees the path and destination ' +
+                         'held by a worker (0 disables)', "int", 'store', 60),
+        'stalltimeout': ('kill and requeue an rsync that made no progress (or less than minrate) during this ' +
+                         'many seconds (0 disables)', "int", 'store', 0),
+        'minrate'     : ('minimum progress rate in KiB/s of an rsync, see stalltimeout', "int", 'store', 0),
+        'metricsfile' : ('write the metrics of a source in the node_exporter textfile format to this file, ' +
+                         'a template like logfile', None, 'store', None),
+        'metricsport' : ('serve the metrics of a source in the Prometheus format on this port (0 disables)',
+                         "int", 'store', 0),
+        'progressinterval': ('publish the live progress of running rsyncs (with --info=progress2, rsync >= 3.1) ' +
+                             'every this many seconds (0 disables)', "int", 'store', 0),
+        'maxstalls'   : ('quarantine a path after it stalled this many times', "int", 'store', 3),
+        'maxretries'  : ('retries of a path after a transient rsync error', "int", 'store', 3),
+        'retrydelay'  : ('delay in seconds before the first retry of a path, doubled for every next retry',
+                         "int", 'store', 10),
+        'lookahead'   : ('number of next paths a worker claims while its current rsync runs', "int", 'store', 0),
+        'prewarm'     : ('stat the paths claimed ahead in parallel, so their rsync starts with warm caches',
+                         None, 'store_true', False),
+        'destprewarm' : ('announce the paths to send (including the ones claimed ahead) to the destination, ' +
+                         'so it can warm its caches for them', None, 'store_true', False),
+        'destpolicy'  : ('how a source picks a destination: in queue order (fifo), or the available one with ' +
+                         'the closest locality and lowest load (best)', 'choice', 'store', RsyncSource.DEST_FIFO,
+                         RsyncSource.DEST_POLICIES),
         # Individual Destination client specific options
         'rsyncport'   : ('force port on which rsyncd binds', "int", 'store', None),
         'startport'   : ('offset to look for rsyncd ports', "int", 'store', 4444),
+        # Destination load limits: pause when going over one of them, activate when below loadhysteresis * limit
+        'maxiowait'   : ('pause destination when cpu iowait percentage exceeds this', "float", 'store', None),
+        'maxmempressure': ('pause destination when memory pressure (PSI some avg10) exceeds this',
+                           "float", 'store', None),
+        'maxwritelatency': ('pause destination when the write latency (ms) of its disk exceeds this',
+                            "float", 'store', None),
+        'maxconnections': ('pause destination when it has more active connections than this', "int", 'store', None),
+        'loadhysteresis': ('fraction of the load limits to go below before activating again',
+                           "float", 'store', 0.8),
         # Arbitrary rsync options: comma seperate list. Use a colon to seperate key and values
         'arbitopts'   : ('Arbitrary rsync source client long name options: comma seperate list. ' +
                              'Use a colon to seperate key and values. Beware these keys/values are not checked.',
@@ -269,6 +433,8 @@ def main():
     }
 
     go = simple_option(options)
+    if go.options.history:
+        show_history(go.options)
     acreds, admin_acl, rstype = zkrsync_parse(go.options)
     if go.options.logfile:
         init_logging(go.options.logfile, go.options.session, rstype, go.options.max_bytes, go.options.backup_count)
@@ -278,9 +444,11 @@ def main():
         'default_acl' : [admin_acl],
         'auth_data'   : acreds,
         'rsyncpath'   : go.options.rsyncpath,
+        'rsyncroots'  : go.options.rsyncroots,
         'netcat'      : go.options.netcat,
         'verifypath'  : go.options.verifypath,
         'dropcache'   : go.options.dropcache,
+        'zkstats'     : go.options.zkstats,
         }
 
     if go.options.daemon:
@@ -32,12 +32,18 @@ vsc-zk base
 
 import os
 import socket
+import threading
+import time
+from functools import partial
 
 from kazoo.client import KazooClient
 from kazoo.exceptions import NodeExistsError, NoNodeError, NoAuthError
 from kazoo.recipe.party import Party
+from kazoo.recipe.queue import LockingQueue
+from kazoo.recipe.watchers import ChildrenWatch, DataWatch
 from vsc.utils import fancylogger
 from vsc.utils.run import RunAsyncLoopLog, RunLoopException
+from vsc.zk.instrument import ZkInstrument
 
 RUNRUN_WATCH_EXITCODE = 101
 ZKRS_NO_SUCH_SESSION_EXIT_CODE = 14
@@ -65,12 +71,151 @@ class RunWatchLoopLog(RunAsyncLoopLog):
 
 run_watch = RunWatchLoopLog.run
 
+class RevocableLockingQueue(LockingQueue):
+    """
+    LockingQueue of which the lock on the held entry can be revoked by another client, like the master does
+    with the entries of a worker whose lease expired. Consuming or releasing an entry that is no longer held
+    lets go of it instead of failing: the entry is handed to another client.
+    """
+    def __init__(self, client, path):
+        super().__init__(client, path)
+        self.log = fancylogger.getLogger(self.__class__.__name__, fname=False)
+
+    def let_go(self, done):
+        """ Let go of the held entry when it was not consumed or released, because its lock was revoked """
+        if not done and self.processing_element is not None:
+            self.log.warning('Lock on entry %s of %s was revoked, letting go of it', self.processing_element[0],
+                             self.path)
+            self.processing_element = None
+        return done
+
+    def consume(self):
+        try:
+            return self.let_go(super().consume())
+        except NoNodeError:
+            return self.let_go(False)
+
+    def release(self):
+        try:
+            return self.let_go(super().release())
+        except NoNodeError:
+            return self.let_go(False)
+
+class RankedLockingQueue(RevocableLockingQueue):
+    """
+    LockingQueue that takes the available entry with the lowest rank instead of the oldest one.
+    rank is called with the value of an entry, entries with the same rank are taken in queue order.
+    """
+    def __init__(self, client, path, rank=None):
+        super().__init__(client, path)
+        self.rank = rank
+        self.entry_values = {}  # entries never change, so their values can be cached
+
+    def entry_value(self, entry):
+        """ Get the value of an entry """
+        if entry not in self.entry_values:
+            try:
+                self.entry_values[entry], _ = self.client.get(f'{self._entries_path}/{entry}')
+            except NoNodeError:
+                return None
+        return self.entry_values[entry]
+
+    def _filter_locked(self, values, taken):
+        for entry in set(self.entry_values) - set(values):
+            del self.entry_values[entry]  # taken out of the queue
+        available = super()._filter_locked(values, taken)
+        if self.rank is None or len(available) < 2:
+            return available
+        ranks = {}
+        for entry in available:
+            value = self.entry_value(entry)
+            ranks[entry] = self.rank(value) if value is not None else None
+        # vanished entries last, the sort is stable so equal ranks stay in queue order
+        return sorted([entry for entry in available if ranks[entry] is not None], key=ranks.get) + \
+            [entry for entry in available if ranks[entry] is None]
+
+class ChildrenCache:
+    """
+    Local copy of the children of a znode and their data, kept up to date by watches once started.
+    Reading it needs no zookeeper calls, but it can lag a little behind the real state.
+    """
+    def __init__(self, client, path):
+        self.client = client
+        self.path = path
+        self.lock = threading.Lock()
+        self.data = {}
+        self.watched = set()
+
+    def start(self):
+        """ Start watching the children """
+        self.client.ensure_path(self.path)
+        ChildrenWatch(self.client, self.path, self.update_children)
+
+    def update_children(self, children):
+        """ Watch the data of new children, forget removed ones """
+        with self.lock:
+            new = set(children) - self.watched
+            self.watched.update(new)
+            for child in set(self.data) - set(children):
+                del self.data[child]
+        for child in new:
+            DataWatch(self.client, f'{self.path}/{child}', partial(self.update_child, child))
+
+    def update_child(self, child, data, stat, event=None):  # pylint: disable=unused-argument
+        """ Update the data of a child, a removed child keeps its watch in case it is created again """
+        with self.lock:
+            if stat is None:
+                self.data.pop(child, None)
+            else:
+                self.data[child] = data.decode() if data is not None else ''
+
+    def get(self, child):
+        """ The data of child, None if unknown """
+        with self.lock:
+            return self.data.get(child)
+
+    def has_value(self, value):
+        """ Check if a child has value as data """
+        with self.lock:
+            return value in self.data.values()
+
+
+class ChildrenChanged:
+    """
+    Event that is set whenever the children of a znode change, by one persistent watch.
+    Waiting for the next change again and again sets no new watches, until it is stopped.
+    """
+    def __init__(self, client, path):
+        self.changed = client.handler.event_object()
+        self.stopped = False
+        client.ensure_path(path)
+        ChildrenWatch(client, path, self.update)
+
+    def update(self, children):  # pylint: disable=unused-argument
+        """ Wake up the waiter, or remove the watch when stopped """
+        if self.stopped:
+            return False
+        self.changed.set()
+        return None
+
+    def wait(self, timeout=None):
+        """ Wait until the children changed since the previous wait, returns False on timeout """
+        changed = self.changed.wait(timeout)
+        self.changed.clear()
+        return changed
+
+    def stop(self):
+        """ Remove the watch on the next change """
+        self.stopped = True
+
+
 class VscKazooClient(KazooClient):
 
     BASE_ZNODE = '/admin'
     BASE_PARTIES = None
+    ASYNC_BATCH = 100  # concurrent asynchronous requests for bulk operations
 
-    def __init__(self, hosts, session=None, name=None, default_acl=None, auth_data=None):
+    def __init__(self, hosts, session=None, name=None, default_acl=None, auth_data=None, zkstats=None):
         self.log = fancylogger.getLogger(self.__class__.__name__, fname=False)
         self.parties = {}
         self.whoami = self.get_whoami(name)
@@ -87,6 +232,9 @@ class VscKazooClient(KazooClient):
           #  'logger'      : self.log
         }
         super().__init__(**kwargs)
+        self.zk_instrument = None
+        if zkstats is not None:
+            self.instrument(zkstats)
         self.start()
         self.log.debug('Zookeeper client started')
 
@@ -95,6 +243,35 @@ class VscKazooClient(KazooClient):
         if self.BASE_PARTIES:
             self.join_parties(self.BASE_PARTIES)
 
+    def instrument(self, interval=0):
+        """
+        Count and time all zookeeper calls of this client and of the locks and queues it makes,
+        and log a summary every interval seconds (0 for only at exit)
+        """
+        self.zk_instrument = ZkInstrument(self.__class__.__name__, interval, paths=self.paths_done)
+        self.zk_instrument.instrument_client(self)
+        lock_factory = self.Lock
+        self.Lock = lambda *args, **kwargs: self.instrumented('lock', lock_factory(*args, **kwargs))
+        self.log.info('Instrumenting zookeeper calls')
+
+    def instrumented(self, kind, recipe):
+        """ Instrument the calls of a lock or queue when the zookeeper calls are instrumented """
+        if self.zk_instrument is not None:
+            self.zk_instrument.instrument_recipe(kind, recipe)
+        return recipe
+
+    def set_role(self, role, default=False):
+        """
+        Set the role the zookeeper calls of the current thread are counted for from now on,
+        or of all threads without a role of their own when default
+        """
+        if self.zk_instrument is not None:
+            self.zk_instrument.set_role(role, default=default)
+
+    def paths_done(self):
+        """ Number of paths this client handled, for the cost per path of the zookeeper calls """
+        return None
+
     def get_whoami(self, name=None):
         """Create a unique name for this client"""
         data = [socket.getfqdn(), str(os.getpid())]
@@ -159,6 +336,78 @@ class VscKazooClient(KazooClient):
         znode_path = self.znode_path(znode)
         return self.exists(znode_path)
 
+    def wait_for_children(self, znode, condition, timeout=None):
+        """
+        Wait until condition holds for the list of children of znode, woken up by watches instead of polling.
+        A missing znode has no children. Returns the children, or None on timeout.
+        Every call sets one watcher, kazoo keeps it only once per znode however often it is set again.
+        To wait for changes again and again, use a persistent ChildrenChanged instead.
+        """
+        znode_path = self.znode_path(znode)
+        changed = self.handler.event_object()
+
+        def watcher(event):  # pylint: disable=unused-argument
+            changed.set()
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            changed.clear()
+            try:
+                children = self.retry(self.get_children, znode_path, watch=watcher)
+            except NoNodeError:
+                children = []
+                if self.retry(self.exists, znode_path, watch=watcher):
+                    continue  # created in between
+            if condition(children):
+                return children
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+            changed.wait(remaining)
+
+    def children_many(self, znodes):
+        """ List the children of many znodes with batches of asynchronous requests, as full paths """
+        children = []
+        for start in range(0, len(znodes), self.ASYNC_BATCH):
+            requests = [(znode, self.get_children_async(znode)) for znode in znodes[start:start + self.ASYNC_BATCH]]
+            for znode, request in requests:
+                try:
+                    children.extend(f'{znode}/{child}' for child in request.get())
+                except NoNodeError:
+                    pass
+        return children
+
+    def get_many(self, znodes):
+        """ Read many znodes with batches of asynchronous requests, yields (znode, value) of the existing ones """
+        for start in range(0, len(znodes), self.ASYNC_BATCH):
+            requests = [(znode, self.get_async(znode)) for znode in znodes[start:start + self.ASYNC_BATCH]]
+            for znode, request in requests:
+                try:
+                    yield znode, request.get()[0]
+                except NoNodeError:
+                    pass
+
+    def delete_trees(self, znodes):
+        """
+        Delete whole subtrees with batches of asynchronous requests:
+        every level is listed in bulk, and the znodes are deleted deepest level first.
+        """
+        levels = []
+        level = [self.znode_path(znode) for znode in znodes]
+        while level:
+            levels.append(level)
+            level = self.children_many(level)
+        for level in reversed(levels):
+            for start in range(0, len(level), self.ASYNC_BATCH):
+                requests = [self.delete_async(znode) for znode in level[start:start + self.ASYNC_BATCH]]
+                for request in requests:
+                    try:
+                        request.get()
+                    except NoNodeError:
+                        pass
+        self.log.debug('Deleted %s znodes under %s', sum(len(level) for level in levels), ', '.join(znodes))
+
     def set_znode(self, znode=None, value=''):
         znode_path = self.znode_path(znode)
         return self.set(znode_path, value.encode())
@@ -222,6 +471,8 @@ class VscKazooClient(KazooClient):
 
     def exit(self):
         """stop and close the connection"""
+        if self.zk_instrument is not None:
+            self.zk_instrument.report(force=True)
         self.stop()
         self.close()
 
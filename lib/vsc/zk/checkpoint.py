@@ -0,0 +1,60 @@
+#
+# Copyright 2013-2023 Ghent University
+#
+# This file is part of vsc-zk,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://www.vscentrum.be),
+# the Flemish Research Foundation (FWO) (http://www.fwo.be/en)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# https://github.com/hpcugent/vsc-zk
+#
+# vsc-zk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Library General Public License as
+# published by the Free Software Foundation, either version 2 of
+# the License, or (at your option) any later version.
+#
+# vsc-zk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with vsc-zk. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+vsc-zk checkpoint
+
+Compact encodings for the checkpoint of a session, so it fits in a few znodes:
+the list of paths in compressed chunks, and the completed paths as a compressed bitmap of their indices.
+
+@author: Kenneth Waegeman (Ghent University)
+"""
+
+import json
+import zlib
+
+def pack_list(values):
+    """ Pack a list of paths (or other json values) into compressed bytes """
+    return zlib.compress(json.dumps(values).encode())
+
+def unpack_list(data):
+    """ Unpack the compressed bytes of pack_list into a list """
+    return json.loads(zlib.decompress(data).decode())
+
+def chunk_list(values, size):
+    """ Split a list into chunks of at most size values """
+    return [values[start:start + size] for start in range(0, len(values), size)]
+
+def pack_indices(indices):
+    """ Pack a collection of non-negative integers into a compressed bitmap """
+    bitmap = bytearray((max(indices) // 8 + 1) if indices else 0)
+    for index in indices:
+        bitmap[index // 8] |= 1 << (index % 8)
+    return zlib.compress(bytes(bitmap))
+
+def unpack_indices(data):
+    """ Unpack the compressed bitmap of pack_indices into a set of integers """
+    bitmap = zlib.decompress(data)
+    return {pos * 8 + bit for pos, byte in enumerate(bitmap) if byte for bit in range(8) if byte & (1 << bit)}
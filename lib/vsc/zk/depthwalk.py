@@ -31,6 +31,7 @@ vsc-zk depthwalk
 
 import os
 
+from concurrent.futures import ThreadPoolExecutor
 from pwd import getpwnam
 from vsc.utils import fancylogger
 
@@ -61,12 +62,23 @@ def exclude_path(path, exclude_re, ex_uid):
             return regfound
     return False
 
-def build_paths(path, depth, exclude_re=None, exclude_usr=None):
+def count_entries(path):
+    """ The number of entries of directory path, without stat-ing them. None when it can not be read """
+    try:
+        with os.scandir(path) as entries:
+            return sum(1 for _ in entries)
+    except OSError as err:
+        logger.debug('could not count the entries of %s: %s', path, err)
+        return None
+
+def build_paths(path, depth, exclude_re=None, exclude_usr=None, counts=None):
     """
     Returns a list of (path, recursive) tuples under path with the maximum depth specified.
     Depth 0 is the basepath itself.
     Recursive is True if and only if it is exactly on the depth specified.
     Exclude_re is a regex to exclude, if it belongs to exclude_usr. (used for eg. excluding snapshot folders)
+    If counts is a dict, the number of entries of every non recursive path is added to it,
+    and of every recursive path the number of entries directly in it, a cheap lower bound of its subtree.
     """
     ex_uid = None
     if exclude_usr:
@@ -74,14 +86,18 @@ def build_paths(path, depth, exclude_re=None, exclude_usr=None):
 
     path = path.rstrip(os.path.sep)
     if depth == 0:
+        if counts is not None:
+            counts[path] = count_entries(path)
         return [(path, 1)]
     pathlist = [(path, 0)]
     pathdepth = path.count(os.path.sep)
-    for root, dirs, _ in depthwalk(path, depth):
+    for root, dirs, files in depthwalk(path, depth):
         if exclude_path(root, exclude_re, ex_uid):
             logger.info('excluding path %s', root)
             del dirs[:]
             continue
+        if counts is not None and root.count(os.path.sep) < pathdepth + depth:
+            counts[root] = len(dirs) + len(files)
         for name in dirs:
             subpath = os.path.join(root, name)
             if os.path.islink(subpath):  # Don't return symlinks to directories
@@ -94,6 +110,8 @@ def build_paths(path, depth, exclude_re=None, exclude_usr=None):
             subpathdepth = subpath.count(os.path.sep)
             if pathdepth + depth == subpathdepth:
                 recursive = 1
+                if counts is not None:
+                    counts[subpath] = count_entries(subpath)
             else:
                 recursive = 0
             pathlist.append((subpath, recursive))
@@ -103,7 +121,7 @@ def build_paths(path, depth, exclude_re=None, exclude_usr=None):
 
     return pathlist
 
-def get_pathlist(path, depth, exclude_re=None, exclude_usr=None, rsubpaths=None):
+def get_pathlist(path, depth, exclude_re=None, exclude_usr=None, rsubpaths=None, counts=None):
     """
     Returns a list of (path, recursive) tuples under path with the maximum depth specified.
     Depth 0 is the basepath itself.
@@ -111,10 +129,11 @@ def get_pathlist(path, depth, exclude_re=None, exclude_usr=None, rsubpaths=None)
     Exclude_re is a regex to exclude, if it belongs to exclude_usr. (used for eg. excluding snapshot folders)
     if subpaths are given with rsubpaths, these are also walked with the given depth, and merged into the list
     Subpaths should already be in the base path pathlist.
+    If counts is a dict, the entry counts of the paths are added to it, see build_paths.
     """
 
     path = path.rstrip(os.path.sep)
-    pathlist = build_paths(path, depth, exclude_re, exclude_usr)
+    pathlist = build_paths(path, depth, exclude_re, exclude_usr, counts)
 
     if rsubpaths:
         pathdict = dict(pathlist)
@@ -135,7 +154,7 @@ def get_pathlist(path, depth, exclude_re=None, exclude_usr=None, rsubpaths=None)
                     % (newdepth, subpath, depthlevel))
             else:
                 depthlevel = newdepth
-                sublist = build_paths(subpath, int(subdepth), exclude_re, exclude_usr)
+                sublist = build_paths(subpath, int(subdepth), exclude_re, exclude_usr, counts)
                 pathdict.update(sublist)  # This suffice because the subpath is always in the pathlist
 
         pathlist = pathdict.items()
@@ -143,13 +162,91 @@ def get_pathlist(path, depth, exclude_re=None, exclude_usr=None, rsubpaths=None)
     logger.debug("pathlist is %s", pathlist)
     return pathlist
 
-def encode_paths(pathlist):
+def scan_dir(path):
+    """
+    lstat all entries of directory path, returns the list of its subdirectories and the number of entries
+    """
+    subdirs = []
+    count = 0
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                entry.stat(follow_symlinks=False)
+                count += 1
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+    except OSError as err:
+        logger.debug('could not scan %s: %s', path, err)
+    return subdirs, count
+
+def warm_metadata(path, recursive, threads=8, maxentries=100000):
+    """
+    Warm the dentry and inode caches for path by stat-ing its entries with a pool of threads,
+    level by level for the whole subtree if recursive.
+    Stops after about maxentries entries, returns the number of entries stat-ed.
+    """
+    total = 0
+    level = [path]
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        while level and total < maxentries:
+            nextlevel = []
+            for subdirs, count in pool.map(scan_dir, level):
+                nextlevel.extend(subdirs)
+                total += count
+            level = nextlevel if recursive else []
+    logger.debug('warmed %d entries of %s', total, path)
+    return total
+
+def encode_paths(pathlist, root=None):
+    """
+    Encode a list of (path, recursive) tuples as <recursive>_<path> strings.
+    When root is given, the root id is added: <recursive>_<root>_<path>
+    """
     enclist = []
     for (path, rec) in pathlist:
-        enclist.append(f"{int(rec)}_{path}")
+        if root:
+            enclist.append(f"{int(rec)}_{root}_{path}")
+        else:
+            enclist.append(f"{int(rec)}_{path}")
     logger.debug("encoded list is %s", enclist)
     return enclist
 
+def index_paths(enclist):
+    """
+    Prefix every encoded path with its index in the list: <index>:<encoded path>
+    """
+    return [f"{index}:{encpath}" for index, encpath in enumerate(enclist)]
+
+def path_index(encpath):
+    """
+    Return the index of an encoded path, None if it has no index
+    """
+    rec = encpath.split('_', 1)[0]
+    if ':' not in rec:
+        return None
+    return int(rec.split(':', 1)[0])
+
+def unindexed_path(encpath):
+    """
+    Return an encoded path without its index prefix
+    """
+    if path_index(encpath) is None:
+        return encpath
+    return encpath.split(':', 1)[1]
+
+def decode_root_path(encpath):
+    """
+    Decode an encoded path into a (root, path, recursive) tuple.
+    Paths are always absolute, so anything between the recursive flag and the first / is the root id.
+    Root is None for paths encoded without a root id. An index prefix is ignored.
+    """
+    rec, path = encpath.split('_', 1)
+    rec = rec.split(':')[-1]
+    root = None
+    if not path.startswith(os.path.sep):
+        root, path = path.split('_', 1)
+    return (root, path, int(rec))
+
 def decode_path(encpath):
-    pathl = encpath.split('_', 1)
-    return (pathl[1], int(pathl[0]))
+    _, path, rec = decode_root_path(encpath)
+    return (path, rec)
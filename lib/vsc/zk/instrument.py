@@ -0,0 +1,213 @@
+#
+# Copyright 2013-2023 Ghent University
+#
+# This file is part of vsc-zk,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://www.vscentrum.be),
+# the Flemish Research Foundation (FWO) (http://www.fwo.be/en)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# https://github.com/hpcugent/vsc-zk
+#
+# vsc-zk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Library General Public License as
+# published by the Free Software Foundation, either version 2 of
+# the License, or (at your option) any later version.
+#
+# vsc-zk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with vsc-zk. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+vsc-zk instrumentation
+
+Count and time the zookeeper calls of a client, per role, operation and call site.
+
+@author: Kenneth Waegeman (Ghent University)
+"""
+
+import functools
+import os
+import sys
+import threading
+import time
+
+import kazoo
+from vsc.utils import fancylogger
+
+# calls of the client that go to zookeeper, the synchronous ones go through the asynchronous ones
+ZK_CALLS = ['create', 'get', 'set', 'exists', 'get_children', 'delete', 'ensure_path', 'sync', 'get_async',
+            'get_children_async', 'delete_async']
+# calls of the transactions of the client, one round trip to zookeeper per commit
+TRANSACTION_CALLS = ['commit']
+# calls of the kazoo recipes, they make zookeeper calls themselves so they are counted apart
+RECIPE_CALLS = {
+    'lock': ['acquire', 'release'],
+    'queue': ['get', 'put', 'consume', 'release'],
+}
+# kazoo, this module and the client base class with its recipes
+SKIP_PREFIXES = (os.path.dirname(kazoo.__file__), os.path.splitext(__file__)[0],
+                 os.path.join(os.path.dirname(__file__), 'base.'))
+
+
+def code_site(code):
+    """ The module and name of a function """
+    module = os.path.splitext(os.path.basename(code.co_filename))[0]
+    return f'{module}.{code.co_name}'
+
+
+def call_site():
+    """
+    The function that made the call: the first caller outside of kazoo, this module and the client base class,
+    so the calls of the kazoo recipes are attributed to the code that used the recipe.
+    Calls made by a kazoo thread, like those of the watches, are attributed to the watch function as watch.<function>
+    """
+    frame = sys._getframe(1)  # pylint: disable=protected-access
+    watch = None
+    while frame is not None and frame.f_code.co_filename.startswith(SKIP_PREFIXES):
+        if watch is None:
+            watch = getattr(frame.f_locals.get('self'), '_func', None)
+        frame = frame.f_back
+    if frame is not None and frame.f_code.co_filename != threading.__file__:
+        return code_site(frame.f_code)
+    code = getattr(getattr(watch, 'func', watch), '__code__', None)  # partial functions and methods too
+    return f'watch.{code_site(code)}' if code else 'kazoo'
+
+
+class ZkInstrument:
+    """
+    Counts and times the calls of a zookeeper client and of its kazoo recipes.
+    The calls are replaced by timed ones on the instances, so nothing changes when not instrumented.
+    Asynchronous calls are only timed until they are sent.
+    Only the outermost call of a thread is counted, so a call that goes through another one counts once.
+    The recipe operations are counted apart from the zookeeper calls, which include the calls the recipes make.
+    The calls are counted for the role of the thread that makes them, or the default role of the client.
+    A summary is logged every interval seconds (never when 0), and at exit.
+    paths is an optional function that returns the number of paths done, to show the cost per path.
+    """
+
+    def __init__(self, role, interval=0, paths=None):
+        self.log = fancylogger.getLogger(self.__class__.__name__, fname=False)
+        self.default_role = role
+        self.local = threading.local()
+        self.interval = interval
+        self.paths = paths
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.recipe_stats = {}
+        self.started = time.time()
+        self.reported = self.started
+
+    @property
+    def role(self):
+        """ The role the calls of the current thread are counted for """
+        return getattr(self.local, 'role', self.default_role)
+
+    def set_role(self, role, default=False):
+        """ Count the calls of the current thread for role from now on, or of threads without a role when default """
+        if default:
+            self.default_role = role
+        else:
+            self.local.role = role
+
+    def wrap(self, operation, func, recipe=False):
+        """ A timed version of func, that is only recorded when it is not called by another timed call """
+        depth = 'recipe_depth' if recipe else 'call_depth'
+
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            if getattr(self.local, depth, 0):
+                return func(*args, **kwargs)
+            setattr(self.local, depth, 1)
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                setattr(self.local, depth, 0)
+                self.record(operation, call_site(), time.time() - start, recipe=recipe)
+        return timed
+
+    def instrument_client(self, client):
+        """ Time the zookeeper calls of client """
+        for operation in ZK_CALLS:
+            if hasattr(client, operation):
+                setattr(client, operation, self.wrap(operation, getattr(client, operation)))
+        if hasattr(client, 'transaction'):
+            client.transaction = self.transactions(client.transaction)
+
+    def transactions(self, factory):
+        """ A version of the transaction factory of a client, whose transactions time their commit """
+        @functools.wraps(factory)
+        def transaction(*args, **kwargs):
+            request = factory(*args, **kwargs)
+            for method in TRANSACTION_CALLS:
+                setattr(request, method, self.wrap(f'transaction.{method}', getattr(request, method)))
+            return request
+        return transaction
+
+    def instrument_recipe(self, kind, recipe):
+        """ Time the calls of a kazoo recipe object of a kind in RECIPE_CALLS """
+        for method in RECIPE_CALLS[kind]:
+            setattr(recipe, method, self.wrap(f'{kind}.{method}', getattr(recipe, method), recipe=True))
+        return recipe
+
+    def record(self, operation, site, duration, now=None, recipe=False):
+        """ Add a call, or a recipe operation, and log the summary when the interval passed """
+        key = (self.role, operation, site)
+        with self.lock:
+            stats = (self.recipe_stats if recipe else self.stats).setdefault(key, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += duration
+            stats[2] = max(stats[2], duration)
+        self.report(now=now)
+
+    def report(self, force=False, now=None):
+        """ Log the summary when forced or when the interval passed """
+        if now is None:
+            now = time.time()
+        if not force and (not self.interval or now - self.reported < self.interval):
+            return
+        self.reported = now
+        for line in self.summary(now):
+            self.log.info(line)
+
+    @staticmethod
+    def table(stats):
+        """ The lines of a table of calls, the most expensive first """
+        lines = []
+        for (role, operation, site), (count, duration, longest) in sorted(stats.items(), key=lambda item: item[1][1],
+                                                                           reverse=True):
+            lines.append(f'{role:<12} {operation:<20} {site:<40} {count:>8} {duration:>10.3f} '
+                         f'{1000 * duration / count:>9.2f} {1000 * longest:>9.2f}')
+        return lines
+
+    def summary(self, now=None):
+        """
+        A table of the zookeeper calls, followed by the recipe operations, as a list of lines.
+        The totals are those of the zookeeper calls only.
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            stats = dict(self.stats)
+            recipe_stats = dict(self.recipe_stats)
+        calls = sum(value[0] for value in stats.values())
+        total = sum(value[1] for value in stats.values())
+        lines = [f'Zookeeper calls: {calls} calls in {total:.3f} s during {now - self.started:.0f} s']
+        paths = self.paths() if self.paths else None
+        if paths:
+            lines[0] += f', {calls / paths:.1f} calls and {1000 * total / paths:.1f} ms per path ({paths} paths)'
+        lines.append(f"{'role':<12} {'operation':<20} {'call site':<40} {'calls':>8} {'total s':>10} "
+                     f"{'mean ms':>9} {'max ms':>9}")
+        lines.extend(self.table(stats))
+        if recipe_stats:
+            lines.append(f'Recipe operations: {sum(value[0] for value in recipe_stats.values())} operations in '
+                         f'{sum(value[1] for value in recipe_stats.values()):.3f} s, '
+                         'their zookeeper calls are included above')
+            lines.extend(self.table(recipe_stats))
+        return lines
@@ -0,0 +1,136 @@
+#
+# Copyright 2013-2023 Ghent University
+#
+# This file is part of vsc-zk,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://www.vscentrum.be),
+# the Flemish Research Foundation (FWO) (http://www.fwo.be/en)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# https://github.com/hpcugent/vsc-zk
+#
+# vsc-zk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Library General Public License as
+# published by the Free Software Foundation, either version 2 of
+# the License, or (at your option) any later version.
+#
+# vsc-zk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with vsc-zk. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+zk.rsync concurrency
+
+@author: Kenneth Waegeman (Ghent University)
+"""
+
+import threading
+import time
+
+from vsc.utils import fancylogger
+
+METRIC_BYTES = 'bytes'
+METRIC_FILES = 'files'
+METRICS = [METRIC_BYTES, METRIC_FILES]
+
+
+class ConcurrencyController:
+    """
+    Decide how many of the local rsync workers may be active.
+    Without a metric, all workers are always active.
+    With a metric, the limit follows an AIMD scheme driven by the aggregate throughput of the workers:
+    it is raised by one while the throughput of an interval improves, halved when it drops,
+    and kept otherwise. After PROBE_INTERVALS intervals without change, it probes one worker more.
+    The throughput is credited while the rsyncs run, and the rest when their paths finish,
+    so paths that take longer than an interval do not make the throughput jump.
+    An interval without any progress is no measurement, and keeps the limit.
+    """
+
+    TOLERANCE = 0.05  # relative throughput change that is considered noise
+    DECREASE = 0.5  # multiplicative decrease factor
+    PROBE_INTERVALS = 5
+
+    def __init__(self, maxlimit, metric=None, interval=120):
+        self.log = fancylogger.getLogger(self.__class__.__name__, fname=False)
+        self.maxlimit = maxlimit
+        self.metric = metric
+        self.interval = interval
+
+        if metric:
+            self.limit = max(1, maxlimit // 2)
+        else:
+            self.limit = maxlimit
+        self.condition = threading.Condition()
+        self.interval_start = time.time()
+        self.amount = 0
+        self.previous = None
+        self.holds = 0
+
+    def progress(self, nbytes, nfiles):
+        """ Credit the bytes and files transferred by a running rsync since its previous progress """
+        with self.condition:
+            if self.metric == METRIC_FILES:
+                self.amount += nfiles
+            else:
+                self.amount += nbytes
+
+    def record(self, nbytes, nfiles, duration, credited=(0, 0)):
+        """ Record the stats of a finished path, of which credited bytes and files were credited while it ran """
+        if duration > 0:
+            self.log.debug('path throughput: %.0f bytes/s, %.1f files/s', nbytes / duration, nfiles / duration)
+        self.progress(max(0, nbytes - credited[0]), max(0, nfiles - credited[1]))
+
+    def is_active(self, idx):
+        """ Check if worker idx may claim paths """
+        return idx < self.limit
+
+    def wait_active(self, idx, timeout=None):
+        """ Wait until worker idx may claim paths, returns False on timeout """
+        with self.condition:
+            return self.condition.wait_for(lambda: self.is_active(idx), timeout)
+
+    def set_limit(self, limit, decision, throughput):
+        """ Set a new limit, wake up waiting workers, and log the decision """
+        self.log.info('Concurrency %s: throughput %.1f %s/s (previous %s), active workers %s -> %s',
+                      decision, throughput, self.metric, self.previous, self.limit, limit)
+        with self.condition:
+            self.limit = limit
+            self.condition.notify_all()
+
+    def adjust(self, now=None):
+        """ Adjust the limit when an interval has passed, returns the limit """
+        if not self.metric:
+            return self.limit
+        if now is None:
+            now = time.time()
+        elapsed = now - self.interval_start
+        if elapsed < self.interval:
+            return self.limit
+
+        with self.condition:
+            throughput = self.amount / elapsed
+            self.amount = 0
+            self.interval_start = now
+
+        if not throughput:
+            self.log.debug('Concurrency hold: no progress in the last %.0f seconds', elapsed)
+            return self.limit
+        if self.previous is None or throughput > self.previous * (1 + self.TOLERANCE):
+            self.holds = 0
+            self.set_limit(min(self.maxlimit, self.limit + 1), 'increase', throughput)
+        elif throughput < self.previous * (1 - self.TOLERANCE):
+            self.holds = 0
+            self.set_limit(max(1, int(self.limit * self.DECREASE)), 'decrease', throughput)
+        elif self.holds >= self.PROBE_INTERVALS:
+            self.holds = 0
+            self.set_limit(min(self.maxlimit, self.limit + 1), 'probe', throughput)
+        else:
+            self.holds += 1
+            self.set_limit(self.limit, 'hold', throughput)
+        self.previous = throughput
+        return self.limit
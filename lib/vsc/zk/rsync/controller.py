@@ -31,9 +31,11 @@ zk.rsync controller
 """
 
 import os
+import re
+import socket
+import threading
 
-from kazoo.recipe.queue import LockingQueue
-from vsc.zk.base import VscKazooClient
+from vsc.zk.base import ChildrenCache, RevocableLockingQueue, VscKazooClient
 
 
 class RsyncController(VscKazooClient):
@@ -49,9 +51,12 @@ class RsyncController(VscKazooClient):
     STATE_ACTIVE = 'active'
     STATE_DISABLED = 'disabled'
     STATUS = 'status'
+    DEFAULT_ROOT = ''
+    ROOT_ID_RE = re.compile(r'^[A-Za-z0-9.-]+$')
 
     def __init__(self, hosts, session=None, name=None, default_acl=None,
-                 auth_data=None, rsyncpath=None, netcat=None, verifypath=True, dropcache=False):
+                 auth_data=None, rsyncpath=None, netcat=None, verifypath=True, dropcache=False,
+                 rsyncroots=None, zkstats=None):
 
         kwargs = {
             'hosts'       : hosts,
@@ -59,23 +64,56 @@ class RsyncController(VscKazooClient):
             'name'        : name,
             'default_acl' : default_acl,
             'auth_data'   : auth_data,
+            'zkstats'     : zkstats,
         }
         self.netcat = netcat
+        self.local = threading.local()
 
         super().__init__(**kwargs)
 
-        self.rsyncpath = rsyncpath.rstrip(os.path.sep)
+        self.rsyncroots = self.parse_rsyncroots(rsyncpath, rsyncroots)
+        self.rsyncpath = self.rsyncroots.get(self.DEFAULT_ROOT)
 
         if not netcat:
             if verifypath and not self.basepath_ok():
-                self.log.raiseException(f'Path does not exists in filesystem: {rsyncpath}')
+                self.log.raiseException(f'Path does not exists in filesystem: {list(self.rsyncroots.values())}')
             if not os.path.isdir(self.RSDIR):
                 os.mkdir(self.RSDIR, 0o700)
             self.module = f'zkrs-{self.session}'
 
-        self.dest_queue = LockingQueue(self, self.znode_path(self.session + '/destQueue'))
         self.verifypath = verifypath
         self.rsync_dropcache = dropcache
+        self.caches = None
+        self.cache_lock = threading.Lock()
+        self.draining = False
+
+    @property
+    def dest_queue(self):
+        """ The destination queue. Every thread has its own, so it can hold its own destination """
+        if not hasattr(self.local, 'dest_queue'):
+            self.local.dest_queue = self.new_dest_queue()
+        return self.local.dest_queue
+
+    def new_dest_queue(self):
+        """ Create a handle on the destination queue """
+        queue = RevocableLockingQueue(self, self.znode_path(self.session + '/destQueue'))
+        return self.instrumented('queue', queue)
+
+    @staticmethod
+    def local_host(domain=None):
+        """ The fqdn of this host, with its domain substituted by domain if given """
+        host = socket.getfqdn()
+        if domain:
+            hname = host.split('.', 1)
+            host = f'{hname[0]}.{domain}'
+        return host
+
+    def locality_labels(self, host, locality=None):
+        """ The given locality labels, or by default the domain suffixes of host, most specific first """
+        if locality:
+            return list(locality)
+        domain = host.split('.')[1:]
+        return ['.'.join(domain[idx:]) for idx in range(len(domain))]
 
     def get_all_hosts(self):
         """Return all zookeeper clients in this rsync session party"""
@@ -84,8 +122,89 @@ class RsyncController(VscKazooClient):
             hosts.append(host)
         return hosts
 
+    def parse_rsyncroots(self, rsyncpath, rsyncroots):
+        """
+        Returns a dict of root ids with their base path.
+        rsyncpath is the default root, rsyncroots is a list of <rootid>:<path> strings
+        """
+        roots = {}
+        if rsyncpath:
+            roots[self.DEFAULT_ROOT] = rsyncpath.rstrip(os.path.sep)
+        for rsyncroot in rsyncroots or []:
+            rootid, _, path = rsyncroot.partition(':')
+            if not self.ROOT_ID_RE.match(rootid) or not path:
+                self.log.raiseException(f'Invalid rsync root {rsyncroot}, should be <rootid>:<path>')
+            elif rootid in roots:
+                self.log.raiseException(f'Rsync root {rootid} specified more than once')
+            roots[rootid] = path.rstrip(os.path.sep)
+        if not roots:
+            self.log.raiseException('No rsync path or rsync roots given')
+        self.log.debug('rsync roots: %s', roots)
+        return roots
+
+    def root_path(self, root=None):
+        """Return the base path of the given root id"""
+        if root is None:
+            root = self.DEFAULT_ROOT
+        if root not in self.rsyncroots:
+            self.log.raiseException(f'Unknown rsync root {root}')
+        return self.rsyncroots[root]
+
+    def module_name(self, root=None):
+        """Return the rsyncd module name of the given root id"""
+        if root:
+            return f'{self.module}-{root}'
+        return self.module
+
     def basepath_ok(self):
-        return os.path.isdir(self.rsyncpath)
+        return all(os.path.isdir(path) for path in self.rsyncroots.values())
+
+    def drain(self, clients):
+        """ Ask the given clients (by id) to finish their current work and leave the session """
+        for client in clients:
+            drainpath = f'{self.session}/drain/{client}'
+            if not self.exists_znode(drainpath):
+                self.make_znode(drainpath, makepath=True)
+            self.log.info('Requested drain of %s', client)
+
+    def watch_drain(self):
+        """ Watch for a drain request for this client """
+        drainpath = self.znode_path(f'{self.session}/drain')
+        self.ensure_path(drainpath)
+
+        @self.ChildrenWatch(drainpath)
+        # pylint: disable=unused-variable
+        def drain_watcher(children):
+            if self.whoami in children and not self.draining:
+                self.log.info('Drain requested, %s will leave the session when idle', self.whoami)
+                self.draining = True
+
+    def start_caches(self):
+        """
+        Start the watch-backed caches of the destinations: the members of the allsd party,
+        the destination states, the portmaps and the destination info. Only done once, on first use.
+        """
+        with self.cache_lock:
+            if self.caches is None:
+                caches = {
+                    'allsd': ChildrenCache(self, f'{self.BASE_ZNODE}/{self.session}/parties/allsd'),
+                    'dests': ChildrenCache(self, self.znode_path(f'{self.session}/dests')),
+                    'portmap': ChildrenCache(self, self.znode_path(f'{self.session}/portmap')),
+                    'destinfo': ChildrenCache(self, self.znode_path(f'{self.session}/destinfo')),
+                }
+                for cache in caches.values():
+                    cache.start()
+                self.caches = caches
+        return self.caches
+
+    def cached_dest_ok(self, dest, port):
+        """
+        Check with the local caches, without zookeeper calls or locks, that dest is a member of the session,
+        is active and has port as rsync port. False means it is unknown or not ok.
+        """
+        caches = self.start_caches()
+        return (caches['allsd'].has_value(dest) and caches['dests'].get(dest) == self.STATE_ACTIVE and
+                caches['portmap'].get(dest) == port)
 
     def dest_state(self, dest, state):
         """ Set the destination to a different state """
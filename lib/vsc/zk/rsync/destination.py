@@ -30,13 +30,20 @@ zk.rsync destination
 @author: Kenneth Waegeman (Ghent University)
 """
 
+import json
 import os
 import socket
 import tempfile
+import threading
 import configparser
 
+from concurrent.futures import ThreadPoolExecutor
+
+from kazoo.exceptions import NodeExistsError, NoNodeError
 from vsc.zk.base import RunWatchLoopLog
+from vsc.zk.depthwalk import warm_metadata
 from vsc.zk.rsync.controller import RsyncController
+from vsc.zk.rsync.loadmonitor import LoadMonitor
 
 class RunDestination(RunWatchLoopLog):
     """When zookeeperclient is ready, stop"""
@@ -53,20 +60,41 @@ class RunDestination(RunWatchLoopLog):
         """Process the output that is read in blocks
         send it to the logger. The logger need to be stream-like
         Register destination after 2 loops.
+        Pause when the basepath is not available or the host is overloaded, activate again afterwards.
+        When draining, pause for good, take the own entries out of the destination queue and stop when idle.
         When watch is ready, stop
         """
         super()._loop_process_output(output)
 
-        if self.watchclient.verifypath and (self._loop_count % self.WAITLOOPS == 0):
-            if self.watchclient.basepath_ok():
-                if self.paused or not self.registered:
-                    self.watchclient.activate()
-                    self.paused = False
-            else:
-                self.log.info('Basepath not available')
+        watchclient = self.watchclient
+        if self._loop_count % self.WAITLOOPS == 0:
+            if watchclient.draining:
                 if not self.paused:
-                    self.watchclient.pause()
+                    watchclient.pause()
                     self.paused = True
+                watchclient.leave_queue()
+                if watchclient.is_idle():
+                    self.log.info('Destination %s drained', watchclient.whoami)
+                    watchclient.set_ready()
+            elif watchclient.verifypath or watchclient.load_monitor.limits:
+                available = True
+                if watchclient.verifypath and not watchclient.basepath_ok():
+                    self.log.info('Basepath not available')
+                    available = False
+                elif watchclient.is_overloaded():
+                    available = False
+
+                if available:
+                    if self.paused or not self.registered:
+                        watchclient.activate()
+                        self.paused = False
+                elif not self.paused:
+                    watchclient.pause()
+                    self.paused = True
+            if self.registered:
+                watchclient.publish_info()
+
+        watchclient.process_prewarm()
 
         if not self.registered and self._loop_count > 2 and not self.paused:
             self.watchclient.add_to_queue()
@@ -81,10 +109,14 @@ class RsyncDestination(RsyncController):
     Starts an rsync daemon available for the RsyncSources. Stops when ready
     """
     BASE_PARTIES = RsyncController.BASE_PARTIES + ['dests']
+    MAX_PORT = 65535
+    PREWARM_POOL = 2  # paths warmed at the same time
+    PREWARM_THREADS = 8  # stat threads per path
 
     def __init__(self, hosts, session=None, name=None, default_acl=None,
                  auth_data=None, rsyncpath=None, rsyncport=None, startport=4444,
-                 netcat=False, domain=None, verifypath=True, dropcache=False):
+                 netcat=False, domain=None, verifypath=True, dropcache=False, rsyncroots=None,
+                 loadlimits=None, loadhysteresis=0.8, locality=None, zkstats=None):
 
         kwargs = {
             'hosts'       : hosts,
@@ -96,18 +128,132 @@ class RsyncDestination(RsyncController):
             'verifypath'  : verifypath,
             'netcat'      : netcat,
             'dropcache'   : dropcache,
+            'rsyncroots'  : rsyncroots,
+            'zkstats'     : zkstats,
         }
 
-        host = socket.getfqdn()
-        if domain:
-            hname = host.split('.', 1)
-            host = f'{hname[0]}.{domain}'
-        self.daemon_host = host
+        self.daemon_host = self.local_host(domain)
         self.daemon_port = rsyncport
         self.start_port = startport
         self.port = None
 
         super().__init__(**kwargs)
+        self.set_role('destination', default=True)
+
+        loadlimits = {metric: limit for metric, limit in (loadlimits or {}).items() if limit is not None}
+        self.load_monitor = LoadMonitor(self.rsyncpath or list(self.rsyncroots.values())[0], loadlimits,
+                                        hysteresis=loadhysteresis)
+        self.locality = self.locality_labels(self.daemon_host, locality)
+        self.published_info = None
+        self.prewarm_pending = threading.Event()
+        self.prewarm_pool = None
+        self.prewarm_futures = []
+
+    def is_overloaded(self):
+        """ Check if this destination host is overloaded """
+        if not self.load_monitor.limits:
+            return False
+        return self.load_monitor.overloaded(self.port)
+
+    def leave_queue(self):
+        """
+        Take the entries of this destination out of the destination queue, so it can become idle.
+        Entries held by a source are left alone: the source consumes them when it sees this destination is paused,
+        or releases them, and then they are taken out the next time.
+        """
+        queuepath = self.dest_queue.path
+        destid = f'{int(self.port)}:{self.whoami}'.encode()
+        for entry in self.get_children(f'{queuepath}/entries'):
+            entrypath = f'{queuepath}/entries/{entry}'
+            try:
+                value, _ = self.get(entrypath)
+            except NoNodeError:
+                continue
+            if value != destid:
+                continue
+            lockpath = f'{queuepath}/taken/{entry}'
+            try:
+                self.create(lockpath, self.whoami.encode(), ephemeral=True)
+            except NodeExistsError:
+                self.log.debug('Destination queue entry %s is held by a source', entry)
+                continue
+            self.delete(entrypath)
+            self.delete(lockpath)
+            self.log.info('Took destination queue entry %s of %s out of the queue', entry, self.whoami)
+
+    def is_idle(self):
+        """ Check if this destination is no longer in the destination queue and has no connections """
+        entries = f'{self.dest_queue.path}/entries'
+        destid = f'{int(self.port)}:{self.whoami}'.encode()
+        for entry in self.get_children(entries):
+            try:
+                value, _ = self.get(f'{entries}/{entry}')
+            except NoNodeError:
+                continue
+            if value == destid:
+                return False
+        return not self.load_monitor.connections(self.port)
+
+    def watch_prewarm(self):
+        """ Watch for paths the sources announce they will send to this destination """
+        prewarmpath = self.znode_path(f'{self.session}/prewarm/{self.whoami}')
+        self.ensure_path(prewarmpath)
+
+        @self.ChildrenWatch(prewarmpath)
+        # pylint: disable=unused-variable
+        def prewarm_watcher(children):
+            if children:
+                self.prewarm_pending.set()
+
+    def process_prewarm(self):
+        """ Warm the metadata caches of the announced paths in the background, before their rsync arrives """
+        if not self.prewarm_pending.is_set():
+            return
+        self.prewarm_pending.clear()
+        prewarmpath = self.znode_path(f'{self.session}/prewarm/{self.whoami}')
+        for child in sorted(self.get_children(prewarmpath)):
+            try:
+                data, _ = self.get(f'{prewarmpath}/{child}')
+                self.delete(f'{prewarmpath}/{child}')
+            except NoNodeError:
+                continue
+            announced = json.loads(data)
+            root = announced['root'] or self.DEFAULT_ROOT
+            if root not in self.rsyncroots:
+                self.log.warning('Announced path %s has unknown root %s', announced['path'], root)
+                continue
+            rootpath = self.root_path(root)
+            path = os.path.normpath(os.path.join(rootpath, announced['path']))
+            if path != rootpath and not path.startswith(rootpath + os.path.sep):
+                self.log.warning('Announced path %s is not in %s', announced['path'], rootpath)
+                continue
+            if self.prewarm_pool is None:
+                self.prewarm_pool = ThreadPoolExecutor(max_workers=self.PREWARM_POOL)
+            self.log.debug('Prewarming %s', path)
+            future = self.prewarm_pool.submit(warm_metadata, path, announced['recursive'],
+                                              threads=self.PREWARM_THREADS)
+            self.prewarm_futures = [fut for fut in self.prewarm_futures if not fut.done()] + [future]
+
+    def stop_prewarm(self):
+        """ Drop the announced paths that are not prewarmed yet, the running prewarms finish in the background """
+        if self.prewarm_pool is None:
+            return
+        for future in self.prewarm_futures:
+            future.cancel()
+        self.prewarm_futures = []
+        self.prewarm_pool.shutdown(wait=False)
+
+    def publish_info(self):
+        """ Publish the locality labels and load score of this destination, when changed """
+        info = json.dumps({'locality': self.locality, 'load': round(self.load_monitor.score(self.port), 2)})
+        if info == self.published_info:
+            return
+        infopath = f'{self.session}/destinfo/{self.whoami}'
+        if not self.exists_znode(infopath):
+            self.make_znode(infopath, ephemeral=True, makepath=True)
+        self.set_znode(infopath, info)
+        self.published_info = info
+        self.log.debug('Published destination info %s', info)
 
     def get_whoami(self, name=None):  # Override base method
         """Create a unique name for this client"""
@@ -126,43 +272,64 @@ class RsyncDestination(RsyncController):
         return hosts
 
     def generate_daemon_config(self):
-        """ Write config file for this session """
+        """ Write config file for this session, with a module for each rsync root """
         fd, name = tempfile.mkstemp(dir=self.RSDIR, text=True)
         wfile = os.fdopen(fd, "w")
         config = configparser.RawConfigParser()
-        config.add_section(self.module)
-        config.set(self.module, 'path', self.rsyncpath)
-        config.set(self.module, 'read only', 'no')
-        config.set(self.module, 'uid', 'root')
-        config.set(self.module, 'gid', 'root')
+        for root, path in self.rsyncroots.items():
+            module = self.module_name(root)
+            config.add_section(module)
+            config.set(module, 'path', path)
+            config.set(module, 'read only', 'no')
+            config.set(module, 'uid', 'root')
+            config.set(module, 'gid', 'root')
         config.write(wfile)
+        wfile.close()
         return name
 
+    @staticmethod
+    def port_bindable(port):
+        """ Check if port can be bound on this host """
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            try:
+                sock.bind(('', port))
+            except OSError:
+                return False
+        return True
+
+    def claim_port(self, portdir, port):
+        """ Claim port by creating its ephemeral znode, returns False if another destination was first """
+        try:
+            self.create(self.znode_path(f'{portdir}/{port}'), self.whoami.encode(), ephemeral=True)
+        except NodeExistsError:
+            return False
+        return True
+
     def reserve_port(self):
-        """ Search for an available port """
+        """
+        Search for an available port: not claimed by another destination on this host and bindable.
+        Creating the ephemeral znode of a port is the claim itself, so no session wide lock is needed.
+        """
         portdir = f'{self.session}/usedports/{self.daemon_host}'
         self.ensure_path(self.znode_path(portdir))
-        lock = self.Lock(self.znode_path(self.session + '/portlock'), self.whoami)
-        with lock:
-            if self.daemon_port:
-                port = self.daemon_port
-                portpath = f'{portdir}/{port}'
-                if self.exists_znode(portpath):
-                    self.log.raiseException('Port already in use: %s', port)
-
-            else:
-                port = self.start_port
-                portpath = f'{portdir}/{port}'
-                while self.exists_znode(portpath):
-                    port += 1
-                    portpath = f'{portdir}/{port}'
-
-            self.make_znode(portpath, ephemeral=True)
-            portmap = f'{self.session}/portmap/{self.whoami}'
-            if not self.exists_znode(portmap):
-                self.make_znode(portmap, ephemeral=True, makepath=True)
-            self.set_znode(portmap, str(port))
-
+        if self.daemon_port:
+            port = self.daemon_port
+            if not self.port_bindable(port) or not self.claim_port(portdir, port):
+                self.log.raiseException(f'Port already in use: {port}')
+        else:
+            claimed = {int(port) for port in self.get_children(self.znode_path(portdir))}
+            port = self.start_port
+            while port in claimed or not self.port_bindable(port) or not self.claim_port(portdir, port):
+                port += 1
+                if port > self.MAX_PORT:
+                    self.log.raiseException(f'No free port found from {self.start_port}')
+
+        portmap = f'{self.session}/portmap/{self.whoami}'
+        if not self.exists_znode(portmap):
+            self.make_znode(portmap, ephemeral=True, makepath=True)
+        self.set_znode(portmap, str(port))
+        self.log.debug('Reserved port %s', port)
         self.port = port
 
     def set_paused(self, destpath, old_state):
@@ -214,6 +381,8 @@ class RsyncDestination(RsyncController):
     def run(self, attempts=3):
         """Starts rsync daemon and add to the queue"""
         self.ready_with_stop_watch()
+        self.watch_drain()
+        self.watch_prewarm()
         attempt = 1
         while (attempt <= attempts and not self.is_ready()):
             self.reserve_port()
@@ -224,6 +393,7 @@ class RsyncDestination(RsyncController):
                 self.run_rsync()
 
             attempt += 1
+        self.stop_prewarm()
 
     def add_to_queue(self):
         """Add this destination to the destination queue """
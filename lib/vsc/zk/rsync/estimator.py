@@ -0,0 +1,143 @@
+#
+# Copyright 2013-2023 Ghent University
+#
+# This file is part of vsc-zk,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://www.vscentrum.be),
+# the Flemish Research Foundation (FWO) (http://www.fwo.be/en)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# https://github.com/hpcugent/vsc-zk
+#
+# vsc-zk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Library General Public License as
+# published by the Free Software Foundation, either version 2 of
+# the License, or (at your option) any later version.
+#
+# vsc-zk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with vsc-zk. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+zk.rsync estimator
+
+@author: Kenneth Waegeman (Ghent University)
+"""
+
+import time
+
+from vsc.utils import fancylogger
+
+FILES = 'files'
+SIZE = 'size'
+SENT = 'sent'
+# rsync stats that measure the work done on every dimension
+DIMENSION_STATS = {FILES: 'Number_of_files', SIZE: 'Total_file_size', SENT: 'Total_bytes_sent'}
+
+
+def format_duration(seconds):
+    """ Format a number of seconds as eg. 2d03h04m """
+    minutes = int(seconds) // 60
+    hours, minutes = divmod(minutes, 60)
+    days, hours = divmod(hours, 24)
+    if days:
+        return f'{days}d{hours:02d}h{minutes:02d}m'
+    if hours:
+        return f'{hours}h{minutes:02d}m'
+    return f'{minutes}m{int(seconds) % 60:02d}s'
+
+def format_estimate(estimate):
+    """ Format an estimate of ProgressEstimator in one line """
+    parts = []
+    for dimension in [SIZE, FILES]:
+        if estimate.get(f'{dimension}_pct') is not None:
+            parts.append(f"{estimate[f'{dimension}_pct']:.1f}% of {'bytes' if dimension == SIZE else dimension}")
+    if not parts and estimate.get('paths_pct') is not None:
+        parts.append(f"{estimate['paths_pct']:.1f}% of paths")
+    line = f"{', '.join(parts) or 'nothing'} done"
+    line += f", {estimate.get('sent_rate') or 0:.0f} bytes/s sent, {estimate.get('files_rate') or 0:.1f} files/s"
+    if estimate.get('eta') is not None:
+        line += f", ETA {format_duration(estimate['eta'])}"
+    return line
+
+
+class ProgressEstimator:
+    """
+    Estimate the progress and the remaining time of a session.
+    Every path has a predicted cost in files and size, from the previous run of the session or from
+    the number of entries seen during the walk. Paths without a prediction cost as much as the average path.
+    The fraction done is the predicted cost of the finished paths over the total predicted cost.
+    The remaining work is extrapolated from the actual work done for that fraction (the rsync stats),
+    and divided by the live throughput, a moving average of the rates between updates.
+    """
+
+    SMOOTHING = 0.3  # weight of the newest rate in the moving average
+
+    def __init__(self, costs):
+        self.log = fancylogger.getLogger(self.__class__.__name__, fname=False)
+        self.paths = len(costs)
+        self.predicted = {
+            FILES: self.fill([cost[0] for cost in costs]),
+            SIZE: self.fill([cost[1] for cost in costs]),
+        }
+        self.totals = {dimension: sum(values) if values else 0 for dimension, values in self.predicted.items()}
+        self.previous = None
+        self.rates = dict.fromkeys(DIMENSION_STATS)
+
+    @staticmethod
+    def fill(values):
+        """ Replace the unknown values by the average of the known ones, None if none are known """
+        known = [value for value in values if value is not None]
+        if not known:
+            return None
+        average = sum(known) / len(known)
+        return [average if value is None else value for value in values]
+
+    def update_rates(self, actual, now):
+        """ Update the moving average of the rates with the actual work done by now """
+        if self.previous is not None:
+            elapsed = now - self.previous[0]
+            if elapsed > 0:
+                for dimension, value in actual.items():
+                    rate = (value - self.previous[1][dimension]) / elapsed
+                    if self.rates[dimension] is None:
+                        self.rates[dimension] = rate
+                    else:
+                        self.rates[dimension] += self.SMOOTHING * (rate - self.rates[dimension])
+        self.previous = (now, actual)
+
+    def fraction(self, dimension, done):
+        """ The predicted fraction of the work on dimension done by the finished paths, None if unknown """
+        values = self.predicted.get(dimension)
+        if not values or not self.totals[dimension]:
+            return None
+        return sum(values[index] for index in done if index < self.paths) / self.totals[dimension]
+
+    def update(self, done, stats, now=None):
+        """ Estimate the progress from the indices of the finished paths and the rsync stats of the session """
+        if now is None:
+            now = time.time()
+        actual = {dimension: stats.get(stat) or 0 for dimension, stat in DIMENSION_STATS.items()}
+        self.update_rates(actual, now)
+
+        estimate = {'paths_done': len(done), 'paths': self.paths, 'eta': None,
+                    'paths_pct': 100 * len(done) / self.paths if self.paths else None}
+        for dimension in DIMENSION_STATS:
+            estimate[f'{dimension}_rate'] = self.rates[dimension]
+        for dimension in [SIZE, FILES]:
+            fraction = self.fraction(dimension, done)
+            estimate[f'{dimension}_pct'] = None if fraction is None else 100 * fraction
+            if estimate['eta'] is not None or fraction is None:
+                continue
+            if fraction >= 1:
+                estimate['eta'] = 0
+            elif fraction > 0 and actual[dimension] and self.rates[dimension]:
+                remaining = actual[dimension] * (1 - fraction) / fraction
+                estimate['eta'] = remaining / self.rates[dimension]
+        self.log.debug('Progress estimate: %s', estimate)
+        return estimate
@@ -0,0 +1,129 @@
+#
+# Copyright 2013-2023 Ghent University
+#
+# This file is part of vsc-zk,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://www.vscentrum.be),
+# the Flemish Research Foundation (FWO) (http://www.fwo.be/en)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# https://github.com/hpcugent/vsc-zk
+#
+# vsc-zk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Library General Public License as
+# published by the Free Software Foundation, either version 2 of
+# the License, or (at your option) any later version.
+#
+# vsc-zk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with vsc-zk. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+zk.rsync history
+
+@author: Kenneth Waegeman (Ghent University)
+"""
+
+import json
+import os
+import sqlite3
+import statistics
+import time
+from contextlib import closing
+
+from vsc.utils import fancylogger
+
+HISTORY_FIELDS = [
+    ('finished', 'REAL'), ('walltime', 'REAL'), ('walktime', 'REAL'), ('enqueuetime', 'REAL'),
+    ('throughput', 'REAL'), ('bytes', 'INTEGER'), ('files', 'INTEGER'), ('paths', 'INTEGER'),
+    ('completed', 'INTEGER'), ('failed', 'INTEGER'), ('quarantined', 'INTEGER'), ('unfinished', 'INTEGER'),
+    ('workers', 'INTEGER'), ('sources', 'INTEGER'), ('depth', 'INTEGER'), ('slowest', 'TEXT'),
+]
+# metrics checked for regressions, and if a higher value is worse
+REGRESSION_METRICS = {'walltime': True, 'walktime': True, 'enqueuetime': True, 'throughput': False}
+
+
+class RunHistory:
+    """
+    Append-only local database with a summary of every run of the sessions,
+    to follow the trends of a session and flag the runs that regressed.
+    A run is compared with the median of the runs before it.
+    It also keeps the cost (files and size) of every path of the last run of a session, to predict the next run.
+    """
+
+    def __init__(self, filename):
+        self.log = fancylogger.getLogger(self.__class__.__name__, fname=False)
+        self.filename = filename
+        dirname = os.path.dirname(filename)
+        if dirname:
+            os.makedirs(dirname, mode=0o700, exist_ok=True)
+        columns = ', '.join(f'{field} {sqltype}' for field, sqltype in HISTORY_FIELDS)
+        self.execute(f'CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                     f'session TEXT NOT NULL, {columns})')
+        self.execute('CREATE TABLE IF NOT EXISTS costs (session TEXT NOT NULL, path TEXT NOT NULL, '
+                     'files INTEGER, size INTEGER, PRIMARY KEY (session, path))')
+
+    def execute(self, query, params=()):
+        """ Execute a query in its own transaction, returns the rows """
+        with closing(sqlite3.connect(self.filename, timeout=30)) as conn:
+            conn.row_factory = sqlite3.Row
+            with conn:
+                return [dict(row) for row in conn.execute(query, params)]
+
+    def record(self, session, summary):
+        """ Add the summary of a run of session """
+        values = [summary.get(field) for field, _ in HISTORY_FIELDS]
+        values[0] = summary.get('finished', time.time())
+        values[-1] = json.dumps(summary.get('slowest', []))
+        fields = ', '.join(field for field, _ in HISTORY_FIELDS)
+        self.execute(f'INSERT INTO runs (session, {fields}) VALUES (?, {", ".join("?" * len(values))})',
+                     [session] + values)
+        self.log.info('Run of session %s added to history %s', session, self.filename)
+
+    def record_costs(self, session, costs):
+        """ Replace the path costs of session by costs, an iterable of (path, files, size) tuples """
+        with closing(sqlite3.connect(self.filename, timeout=30)) as conn:
+            with conn:
+                conn.execute('DELETE FROM costs WHERE session = ?', (session,))
+                conn.executemany('INSERT OR REPLACE INTO costs VALUES (?, ?, ?, ?)',
+                                 ((session, path, files, size) for path, files, size in costs))
+
+    def costs(self, session):
+        """ The path costs of the last run of session, as a dict of path: (files, size) """
+        rows = self.execute('SELECT path, files, size FROM costs WHERE session = ?', (session,))
+        return {row['path']: (row['files'], row['size']) for row in rows}
+
+    def runs(self, session):
+        """ All runs of session, oldest first """
+        runs = self.execute('SELECT * FROM runs WHERE session = ? ORDER BY finished, id', (session,))
+        for run in runs:
+            run['slowest'] = json.loads(run['slowest'] or '[]')
+        return runs
+
+    @staticmethod
+    def regressions(run, previous, threshold):
+        """
+        The metrics of run that are worse than the median of the previous runs by more than threshold,
+        with their relative change
+        """
+        flags = {}
+        for metric, higher_worse in REGRESSION_METRICS.items():
+            values = [prev[metric] for prev in previous if prev[metric]]
+            if not values or run[metric] is None:
+                continue
+            baseline = statistics.median(values)
+            change = (run[metric] - baseline) / baseline
+            if (change > threshold) if higher_worse else (change < -threshold):
+                flags[metric] = change
+        return flags
+
+    def trend(self, session, threshold=0.2, window=7):
+        """ The runs of session, oldest first, each with its regressions against up to window runs before it """
+        runs = self.runs(session)
+        return [(run, self.regressions(run, runs[max(0, idx - window):idx], threshold))
+                for idx, run in enumerate(runs)]
@@ -0,0 +1,101 @@
+#
+# Copyright 2013-2023 Ghent University
+#
+# This file is part of vsc-zk,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://www.vscentrum.be),
+# the Flemish Research Foundation (FWO) (http://www.fwo.be/en)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# https://github.com/hpcugent/vsc-zk
+#
+# vsc-zk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Library General Public License as
+# published by the Free Software Foundation, either version 2 of
+# the License, or (at your option) any later version.
+#
+# vsc-zk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with vsc-zk. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+zk.rsync ledger
+
+@author: Kenneth Waegeman (Ghent University)
+"""
+
+import json
+import os
+import threading
+import time
+
+from vsc.utils import fancylogger
+from vsc.zk.checkpoint import chunk_list, pack_indices, pack_list
+
+COMPLETED = 'completed'
+FAILED = 'failed'
+QUARANTINED = 'quarantined'
+LEDGER_STATUSES = [COMPLETED, FAILED, QUARANTINED]
+
+
+class Ledger:
+    """
+    Record of the paths finished by one source.
+    Every finished path is appended to a local log file with its details (exit code, output, stats),
+    and its index in the path list is kept per status. The indices are summarised as compressed bitmaps,
+    so the shared state of a source is one small znode per status, written at most every interval.
+    The details without the output are also kept until they are taken as report batches.
+    """
+
+    def __init__(self, filename, interval=60):
+        self.log = fancylogger.getLogger(self.__class__.__name__, fname=False)
+        self.filename = filename
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.indices = {status: set() for status in LEDGER_STATUSES}
+        self.pending = []
+        self.dirty = False
+        self.saved = time.time()
+
+    def record(self, status, path, index=None, **details):
+        """ Append a finished path to the local log, and keep its index """
+        entry = dict(details, time=time.time(), status=status, path=path, index=index)
+        with self.lock:
+            if index is not None:
+                self.indices[status].add(index)
+            self.pending.append({key: value for key, value in entry.items() if key != 'output'})
+            self.dirty = True
+            os.makedirs(os.path.dirname(self.filename), mode=0o700, exist_ok=True)
+            with open(self.filename, 'a', encoding='utf8') as logfile:
+                logfile.write(f'{json.dumps(entry)}\n')
+
+    def forget(self, status, indices):
+        """ Drop indices from the status, when their paths are run again """
+        with self.lock:
+            if self.indices[status] & indices:
+                self.indices[status] -= indices
+                self.dirty = True
+
+    def is_due(self, force=False, now=None):
+        """ Check if the summaries changed, and the interval passed or saving is forced """
+        if now is None:
+            now = time.time()
+        return self.dirty and (force or now - self.saved >= self.interval)
+
+    def summaries(self, now=None):
+        """ The compressed bitmap of the indices per status, marked as saved """
+        with self.lock:
+            self.dirty = False
+            self.saved = time.time() if now is None else now
+            return {status: pack_indices(indices) for status, indices in self.indices.items()}
+
+    def report_batches(self, size):
+        """ Take the details recorded since the previous call, as compressed batches of at most size entries """
+        with self.lock:
+            pending, self.pending = self.pending, []
+        return [pack_list(batch) for batch in chunk_list(pending, size)]
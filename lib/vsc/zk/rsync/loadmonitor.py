@@ -0,0 +1,170 @@
+#
+# Copyright 2013-2023 Ghent University
+#
+# This file is part of vsc-zk,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://www.vscentrum.be),
+# the Flemish Research Foundation (FWO) (http://www.fwo.be/en)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# https://github.com/hpcugent/vsc-zk
+#
+# vsc-zk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Library General Public License as
+# published by the Free Software Foundation, either version 2 of
+# the License, or (at your option) any later version.
+#
+# vsc-zk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with vsc-zk. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+zk.rsync loadmonitor
+
+@author: Kenneth Waegeman (Ghent University)
+"""
+
+import os
+
+from vsc.utils import fancylogger
+
+IOWAIT = 'iowait'  # percentage of cpu time waiting for I/O
+MEMPRESSURE = 'mempressure'  # percentage of time stalled on memory (PSI some avg10)
+WRITELATENCY = 'writelatency'  # average milliseconds per write on the device of the path
+CONNECTIONS = 'connections'  # established connections on the rsync daemon port
+LOAD_METRICS = [IOWAIT, MEMPRESSURE, WRITELATENCY, CONNECTIONS]
+
+
+class LoadMonitor:
+    """
+    Measure the load of a destination host and decide if it is overloaded.
+    It becomes overloaded when a metric goes over its limit, and is only back to normal
+    when all metrics are below hysteresis times their limit.
+    Metrics that can not be measured on this host are ignored.
+    """
+
+    PROC = '/proc'
+
+    def __init__(self, path, limits, hysteresis=0.8):
+        self.log = fancylogger.getLogger(self.__class__.__name__, fname=False)
+        self.path = path
+        self.limits = limits
+        self.hysteresis = hysteresis
+        self.overloaded_state = False
+        self.prev_cpu = None
+        self.prev_disk = None
+        self.last_metrics = {}
+        self.device = self.find_device()
+
+    def read_proc(self, name):
+        """ Return the lines of a proc file, None if not available """
+        try:
+            with open(os.path.join(self.PROC, name), encoding='utf8') as procfile:
+                return procfile.read().splitlines()
+        except OSError:
+            return None
+
+    def find_device(self):
+        """ Find the name of the block device the path is on, None for eg. network filesystems """
+        if WRITELATENCY not in self.limits:
+            return None
+        try:
+            dev = os.stat(self.path).st_dev
+        except OSError:
+            return None
+        for line in self.read_proc('diskstats') or []:
+            fields = line.split()
+            if int(fields[0]) == os.major(dev) and int(fields[1]) == os.minor(dev):
+                self.log.debug('path %s is on device %s', self.path, fields[2])
+                return fields[2]
+        self.log.info('No block device found for %s, not measuring write latency', self.path)
+        return None
+
+    def iowait(self):
+        """ Percentage of cpu time spent in iowait since the previous call """
+        lines = self.read_proc('stat')
+        if not lines:
+            return None
+        values = [int(val) for val in lines[0].split()[1:]]
+        current = (values[4], sum(values))
+        prev, self.prev_cpu = self.prev_cpu, current
+        if prev is None or current[1] == prev[1]:
+            return None
+        return 100.0 * (current[0] - prev[0]) / (current[1] - prev[1])
+
+    def mempressure(self):
+        """ Memory pressure stall percentage of the last 10 seconds """
+        for line in self.read_proc('pressure/memory') or []:
+            fields = line.split()
+            if fields[0] == 'some':
+                return float(dict(field.split('=') for field in fields[1:])['avg10'])
+        return None
+
+    def writelatency(self):
+        """ Average time in ms per completed write on the device since the previous call """
+        if not self.device:
+            return None
+        for line in self.read_proc('diskstats') or []:
+            fields = line.split()
+            if fields[2] == self.device:
+                current = (int(fields[7]), int(fields[10]))
+                prev, self.prev_disk = self.prev_disk, current
+                if prev is None:
+                    return None
+                writes = current[0] - prev[0]
+                return (current[1] - prev[1]) / writes if writes > 0 else 0.0
+        return None
+
+    def connections(self, port):
+        """ Number of established tcp connections on the local port """
+        if port is None:
+            return None
+        count = 0
+        for name in ['net/tcp', 'net/tcp6']:
+            for line in (self.read_proc(name) or [])[1:]:
+                fields = line.split()
+                if int(fields[1].split(':')[-1], 16) == int(port) and fields[3] == '01':
+                    count += 1
+        return count
+
+    def sample(self, port=None):
+        """ Measure all metrics with a limit """
+        metrics = {}
+        for metric in self.limits:
+            if metric == CONNECTIONS:
+                metrics[metric] = self.connections(port)
+            else:
+                metrics[metric] = getattr(self, metric)()
+        self.log.debug('load metrics: %s', metrics)
+        return metrics
+
+    def overloaded(self, port=None):
+        """ Check if the host is overloaded, with hysteresis """
+        metrics = self.sample(port)
+        measured = {metric: value for metric, value in metrics.items() if value is not None}
+        self.last_metrics = measured
+        if self.overloaded_state:
+            if all(value < self.limits[metric] * self.hysteresis for metric, value in measured.items()):
+                self.log.info('Load back to normal: %s', measured)
+                self.overloaded_state = False
+        else:
+            over = [metric for metric, value in measured.items() if value > self.limits[metric]]
+            if over:
+                self.log.info('Overloaded on %s: %s (limits %s)', ', '.join(over), measured, self.limits)
+                self.overloaded_state = True
+        return self.overloaded_state
+
+    def score(self, port=None):
+        """
+        Load score of the host, lower is less loaded: the highest fraction of a limit reached
+        in the last check, or the number of established connections when there are no limits
+        """
+        if not self.limits:
+            return self.connections(port) or 0
+        return max([value / self.limits[metric] for metric, value in self.last_metrics.items()
+                    if self.limits[metric]] or [0])
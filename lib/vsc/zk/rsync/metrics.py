@@ -0,0 +1,201 @@
+#
+# Copyright 2013-2023 Ghent University
+#
+# This file is part of vsc-zk,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://www.vscentrum.be),
+# the Flemish Research Foundation (FWO) (http://www.fwo.be/en)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# https://github.com/hpcugent/vsc-zk
+#
+# vsc-zk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Library General Public License as
+# published by the Free Software Foundation, either version 2 of
+# the License, or (at your option) any later version.
+#
+# vsc-zk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with vsc-zk. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+zk.rsync metrics
+
+@author: Kenneth Waegeman (Ghent University)
+"""
+
+import os
+import socketserver
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from vsc.utils import fancylogger
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+DURATION_BUCKETS = [1, 10, 60, 300, 900, 3600, 4 * 3600, 12 * 3600]
+LATENCY_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5]
+
+# name: (type, help, histogram buckets)
+METRICS = {
+    'zkrsync_paths_remaining': (GAUGE, 'Paths in the path queue', None),
+    'zkrsync_paths_retrying': (GAUGE, 'Paths waiting for a retry', None),
+    'zkrsync_paths_total': (COUNTER, 'Paths finished by this source, per status', None),
+    'zkrsync_sent_bytes_total': (COUNTER, 'Bytes sent by the rsyncs of this source, per destination', None),
+    'zkrsync_files_total': (COUNTER, 'Files handled by the rsyncs of this source, per destination', None),
+    'zkrsync_rsync_duration_seconds': (HISTOGRAM, 'Duration of the rsyncs of this source, per status',
+                                       DURATION_BUCKETS),
+    'zkrsync_destinations': (GAUGE, 'Destinations of the session, per state', None),
+    'zkrsync_party_members': (GAUGE, 'Members of the parties of the session', None),
+    'zkrsync_zk_operation_seconds': (HISTOGRAM, 'Latency of zookeeper operations, per operation', LATENCY_BUCKETS),
+}
+
+
+def format_labels(labels):
+    """ Format labels in the exposition format """
+    if not labels:
+        return ''
+    escaped = [(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for key, value in labels]
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+
+class _Server(socketserver.ThreadingMixIn, HTTPServer):
+    """ Http server answering every request in its own thread (ThreadingHTTPServer needs python 3.7) """
+    daemon_threads = True
+
+
+class Metrics:
+    """
+    Metrics of a zkrsync client in the Prometheus text format.
+    Updates only change a value in memory under a lock, so they can be done for every path.
+    The metrics are exported by writing them as a textfile for the node_exporter textfile collector,
+    or by serving them over http.
+    """
+
+    def __init__(self, labels=None):
+        self.log = fancylogger.getLogger(self.__class__.__name__, fname=False)
+        self.labels = labels or {}
+        self.lock = threading.Lock()
+        self.values = {}
+        self.server = None
+
+    def key(self, name, labels):
+        """ The key of a metric with labels, the constant labels included """
+        if name not in METRICS:
+            self.log.raiseException(f'Unknown metric {name}')
+        return name, tuple(sorted(dict(self.labels, **labels).items()))
+
+    def inc(self, name, value=1, **labels):
+        """ Increase a counter """
+        key = self.key(name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """ Set a gauge """
+        key = self.key(name, labels)
+        with self.lock:
+            self.values[key] = value
+
+    def clear(self, name):
+        """ Remove all values of a metric, for gauges of which the labels change """
+        with self.lock:
+            for key in [key for key in self.values if key[0] == name]:
+                del self.values[key]
+
+    def observe(self, name, value, **labels):
+        """ Add an observation to a histogram """
+        key = self.key(name, labels)
+        buckets = METRICS[name][2]
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = [0] * (len(buckets) + 2)  # the buckets, the sum and the count
+            histogram = self.values[key]
+            for idx, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[idx] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """ Observe the duration of the block in a histogram """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def render(self):
+        """ All metrics in the text exposition format """
+        with self.lock:
+            values = sorted((key, list(value) if isinstance(value, list) else value)
+                            for key, value in self.values.items())
+        lines = []
+        current = None
+        for (name, labels), value in values:
+            mtype, mhelp, buckets = METRICS[name]
+            if name != current:
+                lines.extend([f'# HELP {name} {mhelp}', f'# TYPE {name} {mtype}'])
+                current = name
+            if mtype == HISTOGRAM:
+                for bound, count in zip(buckets + ['+Inf'], value[:-2] + value[-1:]):
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {count}")
+                lines.append(f'{name}_sum{format_labels(labels)} {value[-2]}')
+                lines.append(f'{name}_count{format_labels(labels)} {value[-1]}')
+            else:
+                lines.append(f'{name}{format_labels(labels)} {value}')
+        return ''.join(f'{line}\n' for line in lines)
+
+    def write_textfile(self, filename):
+        """ Write the metrics to filename, replacing it at once so the collector never reads half a file """
+        tmpname = f'{filename}.{os.getpid()}.tmp'
+        try:
+            with open(tmpname, 'w', encoding='utf8') as textfile:
+                textfile.write(self.render())
+            os.replace(tmpname, filename)
+        except OSError as err:
+            self.log.warning('Could not write metrics to %s: %s', filename, err)
+
+    def serve(self, port, address=''):
+        """ Serve the metrics over http on port in a background thread """
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            """ Answer every GET with the metrics """
+
+            def do_GET(self):  # pylint: disable=invalid-name
+                """ Send the metrics """
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+                """ Log requests at debug level only """
+                metrics.log.debug(format, *args)
+
+        self.server = _Server((address, port), MetricsHandler)
+        thread = threading.Thread(target=self.server.serve_forever, name='metrics', daemon=True)
+        thread.start()
+        self.log.info('Serving metrics on port %s', self.server.server_address[1])
+        return self.server.server_address[1]
+
+    def shutdown(self):
+        """ Stop serving the metrics """
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
@@ -0,0 +1,136 @@
+#
+# Copyright 2013-2023 Ghent University
+#
+# This file is part of vsc-zk,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://www.vscentrum.be),
+# the Flemish Research Foundation (FWO) (http://www.fwo.be/en)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# https://github.com/hpcugent/vsc-zk
+#
+# vsc-zk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Library General Public License as
+# published by the Free Software Foundation, either version 2 of
+# the License, or (at your option) any later version.
+#
+# vsc-zk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with vsc-zk. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+zk.rsync outputlog
+
+@author: Kenneth Waegeman (Ghent University)
+"""
+
+import glob
+import json
+import os
+import time
+
+from vsc.utils import fancylogger
+
+
+class OutputLog:
+    """
+    Local files with the output of the rsyncs of one worker, so a verbose file list never has to be kept in memory.
+    The output is appended to numbered parts, a new part is started when the current one is larger than maxbytes,
+    and only the last backups parts are kept, like the rotating log files.
+    An index has a JSON line for every run with the path, the part and the offset where its output starts,
+    and only keeps the runs of the parts that are kept.
+    """
+
+    def __init__(self, filename, maxbytes=100 * 1024 * 1024, backups=5):
+        self.log = fancylogger.getLogger(self.__class__.__name__, fname=False)
+        self.filename = filename
+        self.indexname = f'{filename}.index'
+        self.maxbytes = maxbytes
+        self.backups = backups
+        self.outfile = None
+        self.part = max([self.part_number(name) for name in glob.glob(f'{glob.escape(filename)}.[0-9]*')] or [1])
+        self.offset = 0
+
+    @staticmethod
+    def part_number(name):
+        """ The number of an output part file """
+        return int(name.rsplit('.', 1)[1])
+
+    def part_name(self, part):
+        """ The file name of an output part """
+        return f'{self.filename}.{part}'
+
+    def rotate(self):
+        """ Continue in a new part, and remove the parts that are too old with their runs in the index """
+        self.close()
+        self.part += 1
+        oldest = self.part - self.backups
+        for name in glob.glob(f'{glob.escape(self.filename)}.[0-9]*'):
+            if self.part_number(name) <= oldest:
+                self.log.debug('Removing old output %s', name)
+                os.remove(name)
+        self.prune_index(oldest)
+
+    def prune_index(self, oldest):
+        """ Rewrite the index without the runs in parts up to oldest """
+        try:
+            with open(self.indexname, encoding='utf8') as indexfile:
+                lines = [line for line in indexfile if json.loads(line)['part'] > oldest]
+        except OSError:
+            return
+        tmpname = f'{self.indexname}.tmp'
+        with open(tmpname, 'w', encoding='utf8') as indexfile:
+            indexfile.writelines(lines)
+        os.replace(tmpname, self.indexname)
+
+    def start(self, path):
+        """ Start the output of a run of path, and add it to the index """
+        if self.outfile is not None and self.offset >= self.maxbytes:
+            self.rotate()
+        if self.outfile is None:
+            os.makedirs(os.path.dirname(self.filename), mode=0o700, exist_ok=True)
+            self.outfile = open(self.part_name(self.part), 'ab')  # pylint: disable=consider-using-with
+            self.offset = self.outfile.tell()
+        entry = {'path': path, 'part': self.part, 'offset': self.offset, 'time': time.time()}
+        with open(self.indexname, 'a', encoding='utf8') as indexfile:
+            indexfile.write(f'{json.dumps(entry)}\n')
+        self.log.debug('Output of %s goes to %s at offset %s', path, self.part_name(self.part), self.offset)
+
+    def write(self, output):
+        """ Append output of the current run """
+        data = output.encode('utf8', 'replace')
+        self.outfile.write(data)
+        self.outfile.flush()
+        self.offset += len(data)
+
+    def close(self):
+        """ Close the current part """
+        if self.outfile is not None:
+            self.outfile.close()
+            self.outfile = None
+
+    def read(self, path):
+        """ The output of the last run of path, None when it is not there (anymore) """
+        entries = []
+        try:
+            with open(self.indexname, encoding='utf8') as indexfile:
+                entries = [json.loads(line) for line in indexfile]
+        except OSError:
+            return None
+        for idx in reversed(range(len(entries))):
+            if entries[idx]['path'] == path:
+                entry = entries[idx]
+                following = [nxt['offset'] for nxt in entries[idx + 1:] if nxt['part'] == entry['part']]
+                try:
+                    with open(self.part_name(entry['part']), 'rb') as outfile:
+                        outfile.seek(entry['offset'])
+                        size = following[0] - entry['offset'] if following else -1
+                        return outfile.read(size).decode('utf8', 'replace')
+                except OSError:
+                    return None
+        return None
@@ -30,19 +30,146 @@ zk.rsync source
 @author: Kenneth Waegeman (Ghent University)
 """
 
+import gzip
+import hashlib
+import heapq
 import json
+import logging
 import os
 import re
+import sqlite3
 import tempfile
+import threading
 import time
 
 from vsc.utils.cache import FileCache
 from kazoo.recipe.counter import Counter
-from kazoo.recipe.queue import LockingQueue
-from vsc.utils.run import RunAsyncLoopLog
-from vsc.zk.base import ZKRS_NO_SUCH_SESSION_EXIT_CODE
-from vsc.zk.depthwalk import get_pathlist, encode_paths, decode_path
+from kazoo.recipe.party import Party
+from kazoo.exceptions import CancelledError, LockTimeout, NoNodeError
+from vsc.utils.run import RunAsyncLoopLog, RunLoopException
+from vsc.zk.base import ChildrenChanged, RankedLockingQueue, RevocableLockingQueue, ZKRS_NO_SUCH_SESSION_EXIT_CODE
+from vsc.zk.checkpoint import chunk_list, pack_indices, pack_list, unpack_indices, unpack_list
+from vsc.zk.depthwalk import (get_pathlist, encode_paths, decode_root_path, index_paths, path_index,
+                               unindexed_path, warm_metadata)
+from vsc.zk.topology import interleave_paths, parse_prefixmap, topology_key
+from vsc.zk.rsync.concurrency import ConcurrencyController
 from vsc.zk.rsync.controller import RsyncController
+from vsc.zk.rsync.estimator import ProgressEstimator, format_estimate
+from vsc.zk.rsync.history import RunHistory
+from vsc.zk.rsync.ledger import COMPLETED, FAILED, QUARANTINED, LEDGER_STATUSES, Ledger
+from vsc.zk.rsync.metrics import Metrics
+from vsc.zk.rsync.outputlog import OutputLog
+
+RSYNC_STALL_EXITCODE = 102
+RSYNC_REVOKED_EXITCODE = 103  # killed because the lease of the worker was revoked
+RSYNC_VANISHED_EXITCODE = 24  # some source files vanished: the path is done
+RSYNC_PERMANENT_EXITCODES = [1, 2, 3, 4]  # syntax, protocol incompatibility, file selection, unsupported action
+RSYNC_CONNECTION_EXITCODES = [5, 10, 12, 30, 35]  # connection, socket, protocol stream and timeout errors
+# a --info=progress2 record: bytes transferred, percentage, rate, time and the number of transferred files
+RSYNC_PROGRESS_RE = re.compile(r'^\s*(?P<bytes>[\d,]+)\s+\d+%\s+\S+\s+\S+(?:\s+\(xfr#(?P<files>\d+),)?')
+
+class RunRsync(RunAsyncLoopLog):
+    """
+    Runs the rsync of a source worker, renewing the lease of the worker while it runs.
+    A watchdog kills the rsync when it made no progress, or progressed slower than minrate bytes/s,
+    during the last stalltimeout seconds. Progress is the I/O of the process plus its output.
+    With live progress, the --info=progress2 records are parsed as they come and published by the worker.
+    Only the tail of the output, with the stats, is kept in memory. With an output log, all output goes there
+    instead of to the log.
+    """
+
+    PROC = '/proc'
+    OUTPUT_TAIL = 64 * 1024  # characters of output that are kept
+
+    def __init__(self, cmd, **kwargs):
+        self.watchclient = kwargs.pop('watchclient', None)
+        self.outputlog = kwargs.pop('outputlog', None)
+        super().__init__(cmd, **kwargs)
+        if self.outputlog:
+            self.LOOP_LOG_LEVEL = logging.DEBUG
+        self.window = None
+        self.output_bytes = 0
+        self.partial = ''
+        self.live = None
+
+    def io_bytes(self, keys):
+        """ The sum of the /proc io counters with keys of the process, 0 when they can not be read """
+        nbytes = 0
+        try:
+            with open(os.path.join(self.PROC, str(self._process.pid), 'io'), encoding='utf8') as iofile:
+                for line in iofile:
+                    key, value = line.split(':')
+                    if key in keys:
+                        nbytes += int(value)
+        except (OSError, ValueError):
+            pass
+        return nbytes
+
+    def progress(self):
+        """ Bytes read and written by the process (including the network), plus the size of its output """
+        return self.output_bytes + self.io_bytes(('rchar', 'wchar'))
+
+    def check_progress(self, now=None):
+        """ Kill the process when it stalled during the last stalltimeout seconds """
+        stalltimeout = self.watchclient.stalltimeout
+        if not stalltimeout:
+            return
+        if now is None:
+            now = time.time()
+        if self.window is None:
+            self.window = (now, self.progress())
+            return
+        start, startbytes = self.window
+        if now - start < stalltimeout:
+            return
+        current = self.progress()
+        rate = (current - startbytes) / (now - start)
+        if current == startbytes or rate < self.watchclient.minrate:
+            self.log.warning('rsync stalled: %.0f bytes/s during the last %s seconds, killing it', rate, stalltimeout)
+            self.stop_tasks()
+            raise RunLoopException(RSYNC_STALL_EXITCODE, self._process_output)
+        self.window = (now, current)
+
+    def parse_progress(self, output):
+        """
+        Parse the complete progress records in the output read so far, keeping the bytes and files transferred
+        of the last one. Records end with a carriage return, so they are split on that too.
+        """
+        records = re.split(r'[\r\n]', self.partial + output)
+        self.partial = records.pop()
+        for record in records:
+            match = RSYNC_PROGRESS_RE.match(record)
+            if match:
+                files = match.group('files')
+                if files is None:
+                    files = self.live[1] if self.live else 0
+                self.live = (int(match.group('bytes').replace(',', '')), int(files))
+        return self.live
+
+    def _loop_process_output(self, output):
+        """
+        Process the output that is read in blocks: write it to the output log and keep only its tail,
+        renew the lease, check and publish the progress
+        """
+        self.output_bytes += len(output)
+        if self.outputlog:
+            self.outputlog.write(output)
+        super()._loop_process_output(output)
+        if len(self._process_output) > 2 * self.OUTPUT_TAIL:
+            self._process_output = self._process_output[-self.OUTPUT_TAIL:]
+        if self.watchclient:
+            if self.watchclient.heartbeat():
+                self.log.warning('Lease of the worker was revoked, killing rsync: its path goes to another worker')
+                self.stop_tasks()
+                raise RunLoopException(RSYNC_REVOKED_EXITCODE, self._process_output)
+            self.check_progress()
+            if self.watchclient.progressinterval:
+                # a running rsync without a progress record yet is still building its file list
+                self.watchclient.publish_live(self.parse_progress(output) or (0, 0))
+            if self.watchclient.concurrency.metric:
+                # the bytes written by rsync are mostly sent to the destination
+                self.watchclient.credit_progress(self.io_bytes(('wchar',)), self.live[1] if self.live else 0)
+
 
 class RsyncSource(RsyncController):
     """
@@ -55,18 +182,41 @@ class RsyncSource(RsyncController):
     NC_RANGE = 15
     SLEEPTIME = 1  # For netcat stub
     TIME_OUT = 5  # waiting for destination
-    WAITTIME = 5  # check interval of closure of other clients
+    DEST_WAIT = 15  # waiting for a destination for a path
+    WAITTIME = 5  # maximum interval between progress reports
     CHECK_WAIT = 20  # wait for path to be available
+    PREFETCH_WAIT = 5  # maximum wait for the background claims between lease renewals
+    TOPO_PRIORITY = 150  # requeue priority of paths without free topology slot: after the new paths
+    STALL_PRIORITY = 200  # requeue priority of stalled paths: after all others
+    RETRY_PRIORITY = 50  # requeue priority of paths that are due for a retry: before the new paths
+    NODEST_PRIORITY = 50  # requeue priority of paths that got no destination: before the new paths
+    MAX_RETRY_DELAY = 3600
+    PREWARM_THREADS = 8
+    CHECKPOINT_CHUNK = 5000  # paths per checkpoint znode
+    CHECKPOINT_INTERVAL = 60  # maximum interval between saves of the ledger summaries of a source
+    REPORT_BATCH = 1000  # paths per report batch znode
+    REPORT_TOP = 10  # number of slowest and largest paths in the summary
+    ESTIMATE_INTERVAL = 30  # minimum interval between progress estimates
+    TOPOLOGY_RELOAD = 60  # minimum interval between attempts to read the topology keys of the checkpoint
+    METRICS_INTERVAL = 15  # minimum interval between metrics collections and textfile writes
     RSYNC_STATS = ['Number_of_files', 'Number_of_regular_files_transferred', 'Total_file_size',
                    'Total_transferred_file_size', 'Literal_data', 'Matched_data', 'File_list_size',
                    'Total_bytes_sent', 'Total_bytes_received']
+    DEST_FIFO = 'fifo'  # take the destinations in queue order
+    DEST_BEST = 'best'  # take the available destination closest to this source and least loaded
+    DEST_POLICIES = [DEST_FIFO, DEST_BEST]
 
 
     def __init__(self, hosts, session=None, name=None, default_acl=None,
                  auth_data=None, rsyncpath=None, rsyncdepth=-1, rsubpaths=None,
                  netcat=False, dryrun=False, delete=False, checksum=False,
                  hardlinks=False, inplace=False, verbose=False, dropcache=False, timeout=None,
-                 excludere=None, excl_usr=None, verifypath=True, done_file=None, arbitopts=None):
+                 excludere=None, excl_usr=None, verifypath=True, done_file=None, arbitopts=None,
+                 rsyncroots=None, topology=None, topomap=None, topocommand=None, topocap=0,
+                 workers=1, adaptive=None, adaptinterval=120, domain=None, locality=None, destpolicy=DEST_FIFO,
+                 leasetimeout=60, stalltimeout=0, minrate=0, maxstalls=3, maxretries=3, retrydelay=10,
+                 lookahead=0, prewarm=False, destprewarm=False, report=None, historydb=None, progressinterval=0,
+                 metricsfile=None, metricsport=0, zkstats=None):
 
         kwargs = {
             'hosts'       : hosts,
@@ -78,15 +228,16 @@ class RsyncSource(RsyncController):
             'verifypath'  : verifypath,
             'netcat'      : netcat,
             'dropcache'   : dropcache,
+            'rsyncroots'  : rsyncroots,
+            'zkstats'     : zkstats,
         }
         super().__init__(**kwargs)
+        self.set_role('source', default=True)
 
         self.lockpath = self.znode_path(self.session + '/lock')
         self.lock = None
-        self.path_queue = LockingQueue(self, self.znode_path(self.session + '/pathQueue'))
-        self.completed_queue = LockingQueue(self, self.znode_path(self.session + '/completedQueue'))
-        self.failed_queue = LockingQueue(self, self.znode_path(self.session + '/failedQueue'))
-        self.output_queue = LockingQueue(self, self.znode_path(self.session + '/outputQueue'))
+        self.takeover = None
+        self.promoted = False
 
         self.stats_path = f'{self.session}/stats'
         self.init_stats()
@@ -107,6 +258,87 @@ class RsyncSource(RsyncController):
         self.excludere = excludere
         self.excl_usr = excl_usr
         self.rsubpaths = rsubpaths
+        self.topology = topology
+        self.topomap = parse_prefixmap(topomap)
+        self.topocommand = topocommand
+        self.topocap = topocap
+        self.topology_keys = None  # the topology keys of the walked paths, by index
+        self.topology_loaded = 0
+        self.topology_lock = threading.Lock()
+        self.bwlimit_path = f'{self.session}/bwlimit'
+        self.bw_budget = 0
+        self.bw_share = None
+        self.workers = workers
+        self.concurrency = ConcurrencyController(workers, metric=adaptive, interval=adaptinterval)
+        if destpolicy not in self.DEST_POLICIES:
+            self.log.raiseException(f'Unknown destination policy {destpolicy}')
+        self.destpolicy = destpolicy
+        self.locality = self.locality_labels(self.local_host(domain), locality)
+        self.leasetimeout = leasetimeout
+        self.lease_interval = leasetimeout / 4
+        self.lease_versions = {}
+        self.stalltimeout = stalltimeout
+        self.minrate = minrate
+        self.maxstalls = maxstalls
+        self.maxretries = maxretries
+        self.retrydelay = retrydelay
+        self.retries_path = f'{self.session}/retries'
+        self.retries_checked = 0
+        self.lookahead = lookahead
+        if netcat and (prewarm or destprewarm):
+            self.log.warning('Not prewarming with netcat: its paths are only numbers')
+        self.prewarm = prewarm and not netcat
+        self.destprewarm = destprewarm and not netcat
+        self.checkpoint_path = f'{self.session}/checkpoint'
+        self.report = report
+        self.historydb = historydb
+        self.peak_workers = 0
+        self.peak_sources = 0
+        self.run_costs = None
+        self.estimator = None
+        self.estimate = None
+        self.estimated = 0
+        self.progressinterval = progressinterval
+        self.live_path = f'{self.session}/live'
+        self.live_output = 0
+        self.metrics = Metrics({'session': self.session, 'client': self.whoami})
+        self.metricsfile = metricsfile
+        self.metricsport = metricsport
+        self.metrics_exported = 0
+        self.metrics_collected = 0
+        self.ledger = Ledger(os.path.join(self.RSDIR, f'{self.session}-{self.whoami}.ledger'),
+                             interval=self.CHECKPOINT_INTERVAL)
+
+    @property
+    def path_queue(self):
+        """ The path queue. Every thread has its own, so it can hold its own path """
+        if not hasattr(self.local, 'path_queue'):
+            queue = RevocableLockingQueue(self, self.znode_path(self.session + '/pathQueue'))
+            self.local.path_queue = self.instrumented('queue', queue)
+        return self.local.path_queue
+
+    def new_dest_queue(self):
+        """ Create a handle on the destination queue, ranking the destinations with the best policy """
+        if self.destpolicy == self.DEST_BEST:
+            queue = RankedLockingQueue(self, self.znode_path(self.session + '/destQueue'), rank=self.dest_rank)
+            return self.instrumented('queue', queue)
+        return super().new_dest_queue()
+
+    def dest_rank(self, value):
+        """
+        Rank of a destination queue entry, lower is better: destinations sharing the most specific
+        locality labels with this source first, then the least loaded.
+        Destinations without published info come last.
+        The info is read from the local cache, so ranking needs no zookeeper calls.
+        """
+        whoami = value.decode().split(':', 1)[1]
+        try:
+            info = json.loads(self.start_caches()['destinfo'].get(whoami))
+        except (TypeError, ValueError):
+            return (1, 0, float('inf'))
+        shared = set(self.locality) & set(info.get('locality', []))
+        best = min([self.locality.index(label) for label in shared] or [len(self.locality)])
+        return (0, best, info.get('load', 0))
 
     def init_stats(self):
         self.ensure_path(self.znode_path(self.stats_path))
@@ -120,6 +352,39 @@ class RsyncSource(RsyncController):
         self.log.info('progress stats: %s', jstring)
         return jstring
 
+    def set_bwlimit(self, bwlimit):
+        """ Set the bandwidth budget in KiB/s of the session, 0 is unlimited """
+        bwlimit_path = self.znode_path(self.bwlimit_path)
+        if not self.exists(bwlimit_path):
+            self.make_znode(bwlimit_path, makepath=True)
+        self.set_znode(bwlimit_path, str(int(bwlimit)))
+        self.log.info('Bandwidth budget of session %s set to %s KiB/s', self.session, bwlimit)
+
+    def watch_bwlimit(self):
+        """ Keep track of the bandwidth budget of the session, it can be changed while running """
+        @self.DataWatch(self.znode_path(self.bwlimit_path))
+        # pylint: disable=unused-variable,unused-argument
+        def bwlimit_watcher(data, stat):
+            budget = int(data.decode() or 0) if data else 0
+            if budget != self.bw_budget:
+                self.log.info('Bandwidth budget changed to %s KiB/s', budget or 'unlimited')
+            self.bw_budget = budget
+
+    def bwlimit_share(self):
+        """
+        The part of the bandwidth budget in KiB/s for one rsync:
+        the budget is split among the active workers of all sources.
+        Returns None when unlimited.
+        """
+        if not self.bw_budget:
+            return None
+        workers = max(1, len(self.get_workers()))
+        share = max(1, self.bw_budget // workers)
+        if share != self.bw_share:
+            self.log.info('Bandwidth share is now %s KiB/s for %s workers', share, workers)
+            self.bw_share = share
+        return share
+
     def get_sources(self):
         """ Get all zookeeper clients in this session registered as clients """
         hosts = []
@@ -127,15 +392,301 @@ class RsyncSource(RsyncController):
             hosts.append(host)
         return hosts
 
+    def get_workers(self):
+        """ Get all active rsync workers of the sources in this session """
+        return list(Party(self, f'{self.BASE_ZNODE}/{self.session}/parties/workers'))
+
+    def join_workers(self, idx):
+        """ Register the worker of the current thread as active """
+        if getattr(self.local, 'worker_party', None) is None:
+            self.local.worker_party = Party(self, f'{self.BASE_ZNODE}/{self.session}/parties/workers',
+                                            f'{self.whoami}:{idx}')
+            self.local.worker_party.join()
+            if self.leasetimeout:
+                self.local.lease = f'{self.session}/leases/{self.whoami}:{idx}'
+                self.make_znode(self.local.lease, value=json.dumps({}), ephemeral=True, makepath=True)
+                self.local.lease_renewed = time.time()
+            if self.progressinterval:
+                self.local.live = f'{self.live_path}/{self.whoami}:{idx}'
+                self.make_znode(self.local.live, value=json.dumps({}), ephemeral=True, makepath=True)
+            if self.rsync_verbose and getattr(self.local, 'outputlog', None) is None:
+                self.local.outputlog = OutputLog(os.path.join(self.RSDIR, f'{self.session}-{self.whoami}-{idx}.output'))
+
+    def leave_workers(self):
+        """ Unregister the worker of the current thread, and release its destination for other sources """
+        if getattr(self.local, 'worker_party', None) is not None:
+            self.local.worker_party.leave()
+            self.local.worker_party = None
+            self.dest_queue.release()
+            self.release_lookahead()
+            if getattr(self.local, 'outputlog', None) is not None:
+                self.local.outputlog.close()
+            for attr in ['lease', 'live']:
+                if getattr(self.local, attr, None) is not None:
+                    try:
+                        self.delete(self.znode_path(getattr(self.local, attr)))
+                    except NoNodeError:
+                        pass
+                    setattr(self.local, attr, None)
+
+    @staticmethod
+    def held_entry(queue):
+        """ The id of the entry of queue that is held, if any """
+        if queue.processing_element is None:
+            return None
+        return queue.processing_element[0]
+
+    def heartbeat(self, now=None):
+        """
+        Renew the lease of the worker of the current thread, with the ids of the path and destination entries
+        it holds, at most every lease interval.
+        When the lease was revoked by the master, the worker lets go of these entries and true is returned.
+        """
+        lease = getattr(self.local, 'lease', None)
+        if lease is None:
+            return False
+        if now is None:
+            now = time.time()
+        if now - self.local.lease_renewed < self.lease_interval:
+            return False
+        revoked = False
+        lookahead = self.local_lookahead()
+        held = {
+            'path': self.held_entry(self.path_queue),
+            'dest': self.held_entry(self.dest_queue),
+            'lookahead': [self.held_entry(queue) for queue in list(lookahead)],
+        }
+        try:
+            with self.metrics.timer('zkrsync_zk_operation_seconds', op='heartbeat'):
+                self.set_znode(lease, json.dumps(held))
+        except NoNodeError:
+            self.log.warning('Lease %s was revoked, letting go of path entry %s and destination entry %s',
+                             lease, held['path'], held['dest'])
+            self.path_queue.processing_element = None
+            self.dest_queue.processing_element = None
+            for queue in lookahead:
+                queue.processing_element = None
+            del lookahead[:]
+            self.make_znode(lease, value=json.dumps({}), ephemeral=True, makepath=True)
+            revoked = True
+        self.local.lease_renewed = now
+        return revoked
+
+    def credit_progress(self, nbytes, nfiles):
+        """
+        Credit the bytes sent and files transferred so far by the rsync of the current thread
+        to the concurrency controller, as they are transferred
+        """
+        credited = self.local.credited
+        self.concurrency.progress(max(0, nbytes - credited[0]), max(0, nfiles - credited[1]))
+        self.local.credited = (max(nbytes, credited[0]), max(nfiles, credited[1]))
+
+    def publish_live(self, live, now=None, force=False):
+        """
+        Publish the live progress of the rsync of the current thread, at most every progressinterval seconds.
+        live is a tuple of the bytes and files transferred by the rsync so far, or None when it is not running.
+        The elapsed time is counted from the start of the rsync, set by run_rsync.
+        """
+        if getattr(self.local, 'live', None) is None:
+            return
+        if now is None:
+            now = time.time()
+        started, published, prevbytes = getattr(self.local, 'live_state', (now, now, 0))
+        if not force and now - published < self.progressinterval:
+            return
+        if live is None:
+            values = {}
+            self.local.live_state = (now, now, 0)
+        else:
+            nbytes, files = live
+            rate = (nbytes - prevbytes) / (now - published) if now > published else 0
+            values = {'bytes': nbytes, 'files': files, 'rate': rate, 'elapsed': now - started}
+            self.local.live_state = (started, now, nbytes)
+        try:
+            self.set_znode(self.local.live, json.dumps(values))
+        except NoNodeError:
+            self.make_znode(self.local.live, value=json.dumps(values), ephemeral=True, makepath=True)
+
+    def live_progress(self):
+        """ Sum the live progress of the running rsyncs of all workers """
+        total = {'rsyncs': 0, 'bytes': 0, 'files': 0, 'rate': 0}
+        for _, data in self.get_many(self.children_many([self.znode_path(self.live_path)])):
+            live = json.loads(data or '{}')
+            if live:
+                total['rsyncs'] += 1
+                for key in ['bytes', 'files', 'rate']:
+                    total[key] += live[key]
+        return total
+
+    def output_live(self, now=None):
+        """ Log the aggregated live throughput of the session, at most every progressinterval seconds """
+        if not self.progressinterval:
+            return None
+        if now is None:
+            now = time.time()
+        if now - self.live_output < self.progressinterval:
+            return None
+        self.live_output = now
+        live = self.live_progress()
+        self.log.info('Live: %s running rsyncs transferred %s bytes and %s files so far, at %.0f bytes/s',
+                      live['rsyncs'], live['bytes'], live['files'], live['rate'])
+        return live
+
+    def reap_leases(self, now=None):
+        """
+        Revoke the leases that were not renewed for leasetimeout seconds, as seen by this client.
+        This unlocks the path and destination entries they hold, so other workers can take them
+        without waiting for the zookeeper session of a hanging source to expire.
+        """
+        if not self.leasetimeout:
+            return
+        if now is None:
+            now = time.time()
+        leasedir = f'{self.session}/leases'
+        try:
+            leases = self.get_children(self.znode_path(leasedir))
+        except NoNodeError:
+            return
+        versions = {}
+        for lease in leases:
+            leasepath = f'{leasedir}/{lease}'
+            try:
+                data, stat = self.get_znode(leasepath)
+            except NoNodeError:
+                continue
+            version, since = self.lease_versions.get(lease, (None, now))
+            if stat.version != version:
+                since = now
+            elif now - since > self.leasetimeout:
+                self.revoke_lease(leasepath, data)
+                continue
+            versions[lease] = (stat.version, since)
+        self.lease_versions = versions
+
+    def revoke_lease(self, leasepath, data):
+        """ Unlock the entries held by a lease and remove it """
+        held = json.loads(data or '{}')
+        entries = [(self.path_queue, held.get('path')), (self.dest_queue, held.get('dest'))]
+        entries += [(self.path_queue, entry) for entry in held.get('lookahead', [])]
+        for queue, entry in entries:
+            if entry:
+                try:
+                    self.delete(f'{queue.path}/taken/{entry}')
+                except NoNodeError:
+                    pass
+        try:
+            self.delete(self.znode_path(leasepath))
+        except NoNodeError:
+            pass
+        self.log.warning('Lease %s expired, released path entry %s and destination entry %s',
+                         leasepath, held.get('path'), held.get('dest'))
+
+    def path_lost(self):
+        """ Check if the path entry of the current thread was handed to another worker by revoking its lease """
+        if not self.leasetimeout:
+            return False
+        try:
+            return not self.path_queue.holds_lock()
+        except NoNodeError:
+            return True
+
+    def worker(self, idx, timeout=None):
+        """ Process paths until ready or draining, while this worker is allowed to be active """
+        while not self.is_ready() and not self.draining:
+            if not self.concurrency.is_active(idx):
+                if getattr(self.local, 'worker_party', None) is not None:
+                    self.log.info('Pausing worker %s', idx)
+                    self.leave_workers()
+                self.concurrency.wait_active(idx, timeout)
+                continue
+            self.join_workers(idx)
+            self.heartbeat()
+            self.promote_retries()
+            self.log.debug('worker %s trying to get a path out of Queue', idx)
+            self.rsync(timeout)
+        self.leave_workers()
+        self.save_ledger(force=True)
+
+    def run_workers(self, timeout=None):
+        """ Start the rsync workers and adjust how many are active until ready """
+        threads = []
+        for idx in range(self.workers):
+            thread = threading.Thread(target=self.worker, args=(idx, timeout), name=f'worker-{idx}')
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        while any(thread.is_alive() for thread in threads):
+            threads[0].join(self.SLEEPTIME)
+            self.concurrency.adjust()
+        self.log.debug('All %s workers stopped', self.workers)
+
     def acq_lock(self):
         """ Try to acquire lock. Returns true if lock is acquired """
         self.lock = self.Lock(self.lockpath, "")
-        return self.lock.acquire(False)
+        locked = self.lock.acquire(False)
+        if locked:
+            self.set_role('master')
+        return locked
 
     def release_lock(self):
         """ Release the acquired lock """
         return self.lock.release()
 
+    def watch_master(self):
+        """ Contend for the session lock in the background, to take over when the master is gone """
+        self.lock = self.Lock(self.lockpath, self.whoami)
+        self.takeover = threading.Thread(target=self.contend_lock, name='takeover')
+        self.takeover.daemon = True
+        self.takeover.start()
+
+    def contend_lock(self):
+        """ Wait for the session lock, and take over as master if the session is still running """
+        try:
+            self.lock.acquire()
+        except CancelledError:
+            return
+        if not self.session_running():
+            self.log.debug('Got the lock of session %s, but it is not running anymore', self.session)
+            self.release_lock()
+            return
+        self.take_over()
+
+    def stop_contending(self):
+        """ Stop contending for the session lock, or wait until the session is cleaned up if this source took over """
+        if self.takeover is None:
+            return
+        if not self.promoted:
+            self.lock.cancel()
+        self.takeover.join()
+        self.takeover = None
+
+    def session_running(self):
+        """ Check if the session was started and not stopped yet """
+        try:
+            return self.get(f'{self.watchpath}/ready')[0] == b'start'
+        except NoNodeError:
+            return False
+
+    def take_over(self):
+        """
+        Continue as master of the running session, from the state in zookeeper.
+        The paths are only walked again when the master was gone before it finished the walk.
+        The workers of this source go on until the session is done.
+        """
+        self.promoted = True
+        self.set_role('master')
+        self.log.warning('Master of session %s is gone, %s takes over', self.session, self.whoami)
+        marker = self.checkpoint_marker()
+        if marker is None:
+            self.log.warning('The previous master did not finish building the path queue, building it again')
+            self.build_pathqueue()
+        else:
+            self.paths_total = marker['total']
+            self.output_progress(self.len_paths())
+        self.wait_and_keep_progress()
+        self.shutdown_all()
+
     def start_ready_rwatch(self):
         """ Start a watch other clients can register to, but release lock and exit on error """
         watch = self.start_ready_watch()
@@ -148,25 +699,483 @@ class RsyncSource(RsyncController):
         else:
             return watch
 
-    def build_pathqueue(self):
-        """ Build a queue of paths that needs to be rsynced """
+    def build_pathqueue(self, checkpoint=True):
+        """ Build a queue of paths that needs to be rsynced, and checkpoint it unless told otherwise """
         self.log.info('removing old queue and building new queue')
+        started = time.time()
+        counts = {}
         if self.exists(self.path_queue.path):
             self.delete(self.path_queue.path, recursive=True)
         if self.netcat:
             paths = [str(i) for i in range(self.NC_RANGE)]
             time.sleep(self.SLEEPTIME)
         else:
-            tuplpaths = get_pathlist(self.rsyncpath, self.rsyncdepth, exclude_re=self.excludere,
-                                    # By default don't exclude user files
-                                    exclude_usr=self.excl_usr, rsubpaths=self.rsubpaths)
-            paths = encode_paths(tuplpaths)
+            paths = []
+            for root, rootpath in self.rsyncroots.items():
+                tuplpaths = get_pathlist(rootpath, self.rsyncdepth, exclude_re=self.excludere,
+                                        # By default don't exclude user files
+                                        exclude_usr=self.excl_usr, rsubpaths=self.root_rsubpaths(root),
+                                        counts=counts)
+                paths.extend(encode_paths(tuplpaths, root))
+            if self.topology:
+                keys = {path: self.path_topology_key(path) for path in paths}
+                paths = interleave_paths(paths, keys.get)
+                self.topology_keys = [keys[path] for path in paths]
+        paths = index_paths(paths)
         self.paths_total = len(paths)
+        walked = time.time()
         for path in paths:
             self.path_queue.put(self.encoded_path(path)) # Put_all can issue a zookeeper connection error with big lists
-        self.log.info('pathqueue building finished')
+        self.log.info('pathqueue building finished: walk took %.1f seconds, enqueueing %.1f seconds',
+                      walked - started, time.time() - walked)
+        if checkpoint:
+            self.write_checkpoint(paths, costs=self.predict_costs(paths, counts), topology=self.topology_keys,
+                                  started=started, walktime=walked - started, enqueuetime=time.time() - walked)
         return self.paths_total
 
+    def predict_costs(self, paths, counts):
+        """
+        Predict the cost of every path as [files, size]: from the last run of the session in the history,
+        or else the number of entries seen during the walk. Unknown values are None.
+        """
+        previous = {}
+        if self.historydb:
+            try:
+                previous = RunHistory(self.historydb).costs(self.session)
+            except (OSError, sqlite3.Error) as err:
+                self.log.warning('Could not read the path costs from history %s: %s', self.historydb, err)
+        costs = []
+        for encpath in paths:
+            key = unindexed_path(encpath)
+            if key in previous:
+                costs.append(list(previous[key]))
+            elif self.netcat:
+                costs.append([None, None])
+            else:
+                costs.append([counts.get(decode_root_path(encpath)[1]), None])
+        self.log.debug('Predicted the cost of %s of %s paths from the history', len(previous), len(paths))
+        return costs
+
+    def write_checkpoint(self, paths, costs=None, topology=None, **timings):
+        """
+        Replace the checkpoint of the session by the walked paths, with their costs and topology keys,
+        in compressed chunks. The walk marker is written last, so a checkpoint without it is never used.
+        """
+        checkpoint = self.znode_path(self.checkpoint_path)
+        if self.exists(checkpoint):
+            self.delete(checkpoint, recursive=True)
+        chunks = chunk_list(paths, self.CHECKPOINT_CHUNK)
+        for idx, chunk in enumerate(chunks):
+            self.create(f'{checkpoint}/paths/{idx:06d}', pack_list(chunk), makepath=True)
+        for idx, chunk in enumerate(chunk_list(costs or [], self.CHECKPOINT_CHUNK)):
+            self.create(f'{checkpoint}/costs/{idx:06d}', pack_list(chunk), makepath=True)
+        for idx, chunk in enumerate(chunk_list(topology or [], self.CHECKPOINT_CHUNK)):
+            self.create(f'{checkpoint}/topology/{idx:06d}', pack_list(chunk), makepath=True)
+        marker = dict(timings, total=len(paths), chunks=len(chunks), time=time.time())
+        self.create(f'{checkpoint}/walk', json.dumps(marker).encode(), makepath=True)
+        self.log.info('Checkpoint of %s paths written in %s chunks', len(paths), len(chunks))
+
+    def checkpoint_marker(self):
+        """ The walk marker of the checkpoint, None when the walk was not finished """
+        try:
+            return json.loads(self.get(self.znode_path(f'{self.checkpoint_path}/walk'))[0])
+        except NoNodeError:
+            return None
+
+    def checkpoint_paths(self):
+        """ The walked paths of the checkpoint, None if incomplete """
+        checkpoint = self.znode_path(self.checkpoint_path)
+        marker = self.checkpoint_marker()
+        if marker is None:
+            return None
+        try:
+            paths = []
+            for idx in range(marker['chunks']):
+                paths.extend(unpack_list(self.get(f'{checkpoint}/paths/{idx:06d}')[0]))
+        except NoNodeError:
+            return None
+        if len(paths) != marker['total']:
+            self.log.error('Checkpoint has %s paths instead of %s, not using it', len(paths), marker['total'])
+            return None
+        return paths
+
+    def checkpoint_costs(self):
+        """ The predicted costs of the paths of the checkpoint, None without a checkpoint """
+        marker = self.checkpoint_marker()
+        if marker is None:
+            return None
+        costspath = self.znode_path(f'{self.checkpoint_path}/costs')
+        costs = []
+        for _, data in self.get_many(sorted(self.children_many([costspath]))):
+            costs.extend(unpack_list(data))
+        if len(costs) != marker['total']:
+            costs = [[None, None]] * marker['total']
+        return costs
+
+    def checkpoint_topology(self):
+        """ The topology keys of the paths of the checkpoint, None without a checkpoint or keys """
+        marker = self.checkpoint_marker()
+        if marker is None:
+            return None
+        keyspath = self.znode_path(f'{self.checkpoint_path}/topology')
+        keys = []
+        for _, data in self.get_many(sorted(self.children_many([keyspath]))):
+            keys.extend(unpack_list(data))
+        if len(keys) != marker['total']:
+            return None
+        return keys
+
+    def walked_topology_key(self, index, now=None):
+        """
+        The topology key of the path with index, as computed during the walk. The keys are read from
+        the checkpoint once, at most every TOPOLOGY_RELOAD seconds until there are. None when unknown.
+        """
+        if index is None:
+            return None
+        if now is None:
+            now = time.time()
+        with self.topology_lock:
+            if self.topology_keys is None and now - self.topology_loaded >= self.TOPOLOGY_RELOAD:
+                self.topology_loaded = now
+                self.topology_keys = self.checkpoint_topology()
+            keys = self.topology_keys
+        if keys is None or index >= len(keys):
+            return None
+        return keys[index]
+
+    def estimate_progress(self, now=None):
+        """
+        Update the progress estimate at most every ESTIMATE_INTERVAL seconds, and publish it for the state.
+        Returns the latest estimate, None without a checkpoint.
+        """
+        if now is None:
+            now = time.time()
+        if now - self.estimated < self.ESTIMATE_INTERVAL:
+            return self.estimate
+        if self.estimator is None:
+            costs = self.checkpoint_costs()
+            if costs is None:
+                return None
+            self.estimator = ProgressEstimator(costs)
+        done = set().union(*[self.ledger_indices(status) for status in LEDGER_STATUSES])
+        self.estimate = self.estimator.update(done, self.stats, now)
+        self.estimated = now
+        progresspath = self.znode_path(f'{self.session}/progress')
+        data = json.dumps(self.estimate).encode()
+        try:
+            self.set(progresspath, data)
+        except NoNodeError:
+            self.create(progresspath, data, makepath=True)
+        return self.estimate
+
+    def read_estimate(self):
+        """ The last published progress estimate, None if there is none """
+        try:
+            data, _ = self.get(self.znode_path(f'{self.session}/progress'))
+        except NoNodeError:
+            return None
+        return json.loads(data)
+
+    def read_checkpoint(self):
+        """ Return the walked paths and the indices of the completed paths of the checkpoint, None if incomplete """
+        paths = self.checkpoint_paths()
+        if paths is None:
+            return None
+        return paths, self.ledger_indices(COMPLETED)
+
+    def resume_pathqueue(self):
+        """
+        Rebuild the queue from the checkpoint of an interrupted run of the session, without walking again.
+        Only the paths not completed by then are queued. The stats of the interrupted run are carried over.
+        Returns the number of paths, or None when there is no usable checkpoint.
+        """
+        checkpoint = self.read_checkpoint()
+        if checkpoint is None:
+            self.log.warning('No complete checkpoint found for session %s', self.session)
+            return None
+        paths, done = checkpoint
+        if self.exists(self.path_queue.path):
+            self.delete(self.path_queue.path, recursive=True)
+        self.paths_total = len(paths)
+        todo = [path for idx, path in enumerate(paths) if idx not in done]
+        self.requeue_ledger({idx for idx in range(len(paths)) if idx not in done})
+        for path in todo:
+            self.path_queue.put(self.encoded_path(path))
+        self.restore_stats()
+        self.log.info('Resumed session %s from checkpoint: %s of %s paths were completed, %s queued',
+                      self.session, self.paths_total - len(todo), self.paths_total, len(todo))
+        return self.paths_total
+
+    def requeue_ledger(self, requeued):
+        """
+        Drop the indices of the requeued paths from the failed and quarantined summaries of all sources,
+        so a path that finishes on its next run is only counted with its new status.
+        """
+        for status in LEDGER_STATUSES:
+            if status == COMPLETED:
+                continue
+            self.ledger.forget(status, requeued)
+            statuspath = self.znode_path(f'{self.checkpoint_path}/{status}')
+            for znode, data in list(self.get_many(self.children_many([statuspath]))):
+                indices = unpack_indices(data)
+                if indices & requeued:
+                    self.set(znode, pack_indices(indices - requeued))
+
+    def finish_path(self, path, status, code=None, output=None):
+        """ Record a finished path in the ledger of this source, with the details of the last run of this thread """
+        details = getattr(self.local, 'run_details', {})
+        self.ledger.record(status, path, index=path_index(path), code=code, output=output, source=self.whoami,
+                           attempts=self.path_attempts(path), **details)
+        self.save_ledger()
+        self.metrics.inc('zkrsync_paths_total', status=status)
+        if 'dest' in details:
+            self.metrics.inc('zkrsync_sent_bytes_total', details.get('bytes', 0), dest=details['dest'])
+            self.metrics.inc('zkrsync_files_total', details.get('files', 0), dest=details['dest'])
+            self.metrics.observe('zkrsync_rsync_duration_seconds', details['duration'], status=status)
+        self.export_metrics()
+
+    def paths_done(self):
+        """ Paths finished by the session for the master, or by the workers of this source """
+        if self.estimate:
+            return self.estimate['paths_done']
+        return sum(len(indices) for indices in self.ledger.indices.values()) or None
+
+    def start_metrics(self):
+        """ Serve the metrics of this client over http when a metrics port is set """
+        if self.metricsport:
+            self.metrics.serve(self.metricsport)
+
+    def collect_metrics(self, todo, now=None):
+        """ Update the metrics of the session state, at most every METRICS_INTERVAL seconds """
+        if now is None:
+            now = time.time()
+        if now - self.metrics_collected < self.METRICS_INTERVAL:
+            return
+        self.metrics_collected = now
+        self.metrics.set('zkrsync_paths_remaining', todo)
+        self.metrics.set('zkrsync_paths_retrying', self.len_retries())
+        for party, members in [('allsd', self.get_all_hosts()), ('sources', self.get_sources()),
+                               ('workers', self.get_workers())]:
+            self.metrics.set('zkrsync_party_members', len(members), party=party)
+        states = dict.fromkeys([self.STATE_ACTIVE, self.STATE_PAUSED, self.STATE_DISABLED], 0)
+        with self.metrics.timer('zkrsync_zk_operation_seconds', op='dest_states'):
+            for _, state in self.get_many(self.children_many([self.znode_path(f'{self.session}/dests')])):
+                state = state.decode()
+                states[state] = states.get(state, 0) + 1
+        self.metrics.clear('zkrsync_destinations')
+        for state, count in states.items():
+            self.metrics.set('zkrsync_destinations', count, state=state)
+        self.export_metrics(now=now)
+
+    def export_metrics(self, force=False, now=None):
+        """ Write the metrics textfile, at most every METRICS_INTERVAL seconds unless forced """
+        if not self.metricsfile:
+            return
+        if now is None:
+            now = time.time()
+        if force or now - self.metrics_exported >= self.METRICS_INTERVAL:
+            self.metrics_exported = now
+            self.metrics.write_textfile(self.metricsfile)
+
+    def exit(self):
+        """ Export the metrics a last time, stop serving them, and close the connection """
+        self.export_metrics(force=True)
+        self.metrics.shutdown()
+        super().exit()
+
+    def path_attempts(self, path):
+        """ Number of runs of a path: its retries and the current one """
+        try:
+            retries, _ = self.get(self.znode_path(
+                f'{self.session}/retrycounts/{hashlib.sha1(self.encoded_path(path)).hexdigest()}'))
+        except NoNodeError:
+            return 1
+        return int(retries or 0) + 1
+
+    def save_ledger(self, force=False, now=None):
+        """
+        Save the summaries of the ledger of this source in the checkpoint,
+        at most every CHECKPOINT_INTERVAL seconds, or now when forced.
+        Every source has its own summaries, so sources never contend on them.
+        """
+        if not self.ledger.is_due(force, now):
+            return
+        if self.checkpoint_marker() is None:
+            return  # no checkpoint (yet), or removed at the end of the session
+        checkpoint = self.znode_path(self.checkpoint_path)
+        for status, data in self.ledger.summaries(now).items():
+            try:
+                self.set(f'{checkpoint}/{status}/{self.whoami}', data)
+            except NoNodeError:
+                self.create(f'{checkpoint}/{status}/{self.whoami}', data, makepath=True)
+        for batch in self.ledger.report_batches(self.REPORT_BATCH):
+            self.create(f'{checkpoint}/report/{self.whoami}-', batch, sequence=True, makepath=True)
+
+    def ledger_indices(self, status):
+        """ The indices of the paths with status, merged over the ledger summaries of all sources """
+        statuspath = self.znode_path(f'{self.checkpoint_path}/{status}')
+        indices = set()
+        for _, data in self.get_many(self.children_many([statuspath])):
+            indices |= unpack_indices(data)
+        return indices
+
+    def report_ledger(self):
+        """
+        Report the paths finished by all sources in bulk, from the ledger summaries.
+        Returns the number of paths per status.
+        """
+        paths = self.checkpoint_paths() or []
+        counts = {}
+        for status in LEDGER_STATUSES:
+            indices = self.ledger_indices(status)
+            counts[status] = len(indices)
+            if status == COMPLETED:
+                continue
+            for index in sorted(indices):
+                self.log.error('%s Path %s', status.capitalize(), paths[index] if index < len(paths) else index)
+        self.log.info('Completed paths: %s, failed: %s, quarantined: %s. The details are in the ledgers of the sources',
+                      counts[COMPLETED], counts[FAILED], counts[QUARANTINED])
+        return counts
+
+    def write_report(self, unfinished):
+        """
+        Stream the details of all finished paths, and the unfinished paths, to the report file as gzipped JSONL,
+        and summarise them: totals, throughput since the walk, and the slowest and largest paths.
+        """
+        reportpath = self.znode_path(f'{self.checkpoint_path}/report')
+        batches = sorted(self.children_many([reportpath]), key=lambda batch: batch.rsplit('-', 1)[1])
+        report = gzip.open(self.report, 'wt', encoding='utf8') if self.report else None
+        summary = {'bytes': 0, 'files': 0}
+        slowest, largest = [], []
+        self.run_costs = [] if self.historydb else None
+        for _, data in self.get_many(batches):
+            for entry in unpack_list(data):
+                if self.run_costs is not None and entry['status'] == COMPLETED:
+                    self.run_costs.append((unindexed_path(entry['path']), entry.get('files'), entry.get('size')))
+                summary['bytes'] += entry.get('bytes', 0)
+                summary['files'] += entry.get('files', 0)
+                for top, key in [(slowest, 'duration'), (largest, 'bytes')]:
+                    if key in entry:
+                        item = (entry[key], entry['path'])
+                        if len(top) < self.REPORT_TOP:
+                            heapq.heappush(top, item)
+                        else:
+                            heapq.heappushpop(top, item)
+                if report:
+                    report.write(f'{json.dumps(entry)}\n')
+        if report:
+            for path in unfinished:
+                report.write(f'{json.dumps({"status": "unfinished", "path": path})}\n')
+            report.close()
+            self.log.info('Report of the paths written to %s', self.report)
+
+        marker = self.checkpoint_marker()
+        summary['elapsed'] = time.time() - marker['time'] if marker else 0
+        summary['throughput'] = summary['bytes'] / summary['elapsed'] if summary['elapsed'] > 0 else 0
+        summary['slowest'] = [[path, duration] for duration, path in sorted(slowest, reverse=True)]
+        summary['largest'] = [[path, nbytes] for nbytes, path in sorted(largest, reverse=True)]
+        self.log.info('Sent %s bytes of %s files in %.0f seconds (%.0f bytes/s)', summary['bytes'], summary['files'],
+                      summary['elapsed'], summary['throughput'])
+        return summary
+
+    def record_history(self, values):
+        """ Add the summary of this run, with the timings of the walk, to the local run history """
+        marker = self.checkpoint_marker() or {}
+        summary = dict(values, paths=getattr(self, 'paths_total', 0), workers=self.peak_workers,
+                       sources=self.peak_sources, depth=self.rsyncdepth, walktime=marker.get('walktime'),
+                       enqueuetime=marker.get('enqueuetime'))
+        if 'started' in marker:
+            summary['walltime'] = time.time() - marker['started']
+        try:
+            history = RunHistory(self.historydb)
+            history.record(self.session, summary)
+            if self.run_costs:
+                history.record_costs(self.session, self.run_costs)
+        except (OSError, sqlite3.Error) as err:
+            self.log.error('Could not add the run to history %s: %s', self.historydb, err)
+
+    def checkpoint_stats(self):
+        """ Save a snapshot of the session stats in the checkpoint """
+        statspath = self.znode_path(f'{self.checkpoint_path}/stats')
+        data = json.dumps(self.stats).encode()
+        try:
+            self.set(statspath, data)
+        except NoNodeError:
+            self.create(statspath, data, makepath=True)
+
+    def restore_stats(self):
+        """ Add the stats snapshot of the checkpoint to the session stats """
+        try:
+            stats = json.loads(self.get(self.znode_path(f'{self.checkpoint_path}/stats'))[0])
+        except NoNodeError:
+            return
+        for stat, value in stats.items():
+            if stat in self.counters and value:
+                self.counters[stat] += value
+
+    def root_rsubpaths(self, root):
+        """
+        Return the rsubpaths that belong to the given root.
+        Absolute subpaths belong to the root they are a subpath of, all others to the default root.
+        """
+        if not self.rsubpaths:
+            return None
+        rsubpaths = []
+        for encsubpath in self.rsubpaths:
+            subpath = encsubpath.split('_', 1)[1]
+            owner = self.DEFAULT_ROOT
+            for rootid, rootpath in self.rsyncroots.items():
+                if rootid and subpath.startswith(f'{rootpath}{os.path.sep}'):
+                    owner = rootid
+            if owner == root:
+                rsubpaths.append(encsubpath)
+        return rsubpaths
+
+    def path_topology_key(self, encpath):
+        """
+        Return the topology key of an encoded path, None when not using topology.
+        The key computed during the walk is used when known, so the topology command runs once per path.
+        """
+        if not self.topology or self.netcat:
+            return None
+        key = self.walked_topology_key(path_index(encpath))
+        if key is None:
+            _, path, _ = decode_root_path(encpath)
+            key = topology_key(path, self.topology, prefixmap=self.topomap, command=self.topocommand)
+        return key
+
+    def topology_semaphore(self, key):
+        """ Return the semaphore limiting the concurrent rsyncs of a topology key, for the current thread """
+        if not hasattr(self.local, 'topo_semaphores'):
+            self.local.topo_semaphores = {}
+        if key not in self.local.topo_semaphores:
+            sempath = self.znode_path(f'{self.session}/topology/{key}')
+            self.local.topo_semaphores[key] = self.Semaphore(sempath, self.whoami, max_leases=self.topocap)
+        return self.local.topo_semaphores[key]
+
+    def acquire_topology_slot(self, path):
+        """
+        Acquire a slot on the topology key of the path when the rsyncs per key are capped.
+        Returns the semaphore to release when done, None when not capped, or False when no slot was freed
+        in time. In that case the path is put back after the other paths in the queue.
+        """
+        if not self.topocap:
+            return None
+        key = self.path_topology_key(path)
+        if key is None:
+            return None
+        semaphore = self.topology_semaphore(key)
+        try:
+            semaphore.acquire(timeout=self.TIME_OUT)
+            self.log.debug('Got slot for topology key %s', key)
+            return semaphore
+        except LockTimeout:
+            pass
+        self.log.debug('No free slot for topology key %s, requeueing %s', key, path)
+        self.path_queue.put(self.encoded_path(path), priority=self.TOPO_PRIORITY)
+        self.path_queue.consume()
+        return False
+
     def encoded_path(self, path):
         """ Encode a path """
         try:
@@ -188,35 +1197,53 @@ class RsyncSource(RsyncController):
         return dpath
 
     def isempty_pathqueue(self):
-        """ Returns true if all paths in pathqueue are done """
-        return len(self.path_queue) == 0
+        """ Returns true if all paths in pathqueue are done, and no path is waiting for a retry """
+        return len(self.path_queue) == 0 and self.len_retries() == 0
 
     def output_progress(self, todo):
         self.log.info('Progress: %s of %s paths remaining, %s failed',
-            todo, self.paths_total, len(self.failed_queue))
+            todo, self.paths_total, len(self.ledger_indices(FAILED)))
         self.output_stats()
+        estimate = self.estimate_progress()
+        if estimate:
+            self.log.info('Progress: %s', format_estimate(estimate))
+        self.checkpoint_stats()
 
     def output_clients(self, total, sources):
         dests = total - sources
         sources = sources - 1
         self.log.info('Connected source (slave) clients: %s, connected destination clients: %s', sources, dests)
+        self.log.info('Connected clients: %s', ', '.join(sorted(self.get_all_hosts())))
 
     def wait_and_keep_progress(self):
         todo_paths = self.paths_total
         total_clients = len(self.get_all_hosts())
         total_sources = len(self.get_sources())
+        # a fleet that never changes is counted too, the master itself is not a source of the run
+        self.peak_sources = max(self.peak_sources, total_sources - 1)
+        self.peak_workers = max(self.peak_workers, len(self.get_workers()))
+        # wake up when the paths change, with one watch for the whole session
+        entries_changed = ChildrenChanged(self, f'{self.path_queue.path}/entries')
         while not self.isempty_pathqueue():
-            todo_new = self.len_paths()
+            self.reap_leases()
+            self.promote_retries()
+            self.output_live()
+            with self.metrics.timer('zkrsync_zk_operation_seconds', op='len_paths'):
+                todo_new = self.len_paths()
+            self.collect_metrics(todo_new)
             if todo_paths != todo_new:  # Output progress state
                 todo_paths = todo_new
                 self.output_progress(todo_paths)
+                self.peak_workers = max(self.peak_workers, len(self.get_workers()))
             tot_clients_new = len(self.get_all_hosts())
             src_clients_new = len(self.get_sources())
             if total_clients != tot_clients_new or total_sources != src_clients_new:
                 total_clients = tot_clients_new
                 total_sources = src_clients_new
+                self.peak_sources = max(self.peak_sources, total_sources - 1)
                 self.output_clients(total_clients, total_sources)
-            time.sleep(self.WAITTIME)
+            entries_changed.wait(self.WAITTIME)
+        entries_changed.stop()
 
     def len_paths(self):
         """ Returns how many elements still in pathQueue """
@@ -228,17 +1255,21 @@ class RsyncSource(RsyncController):
         self.stop_ready_watch()
         self.log.debug('watch set to stop')
 
-        while len(self.get_all_hosts()) > 1:
-        #    self.log.debug("clients still connected: %s" % self.get_all_hosts())
-            time.sleep(self.WAITTIME)
+        # wait until this is the last member of the session
+        self.wait_for_children(f'{self.session}/parties/allsd', lambda children: len(children) <= 1)
         self.cleanup()
 
     def get_state(self):
         """Get the state of a running session"""
         remain = self.len_paths()
-        if remain > 0:
+        retries = self.len_retries()
+        if remain + retries > 0:
             code = 0
-            self.log.info('Remaining: %s, Failed: %s', remain, len(self.failed_queue))
+            self.log.info('Remaining: %s, Waiting for retry: %s, Failed: %s',
+                          remain, retries, len(self.ledger_indices(FAILED)))
+            estimate = self.read_estimate()
+            if estimate:
+                self.log.info('Progress: %s', format_estimate(estimate))
         else:
             code = ZKRS_NO_SUCH_SESSION_EXIT_CODE
             self.log.info('No active session')
@@ -252,38 +1283,42 @@ class RsyncSource(RsyncController):
         cache_file.close()
 
     def cleanup(self):
-        """ Remove all session nodes in zookeeper after first logging the output queues """
+        """
+        Remove all session nodes in zookeeper after reporting the finished and unfinished paths.
+        Everything is read and deleted in bulk, with batches of asynchronous requests.
+        """
 
+        finished = len(self.path_queue) == 0 and self.len_retries() == 0
+        # pylint: disable=protected-access
+        unfinished = [self.decoded_path(value)
+                      for _, value in self.get_many(sorted(self.children_many([self.path_queue._entries_path])))]
+        if unfinished:
+            self.log.warning('%s paths were not finished', len(unfinished))
+            self.log.debug('Unfinished paths: %s', unfinished)
+        counts = self.report_ledger()
         values = {
-            'unfinished' : len(self.path_queue),
-            'failed' : len(self.failed_queue),
-            'completed' : len(self.completed_queue)
+            'unfinished' : len(unfinished),
+            'failed' : counts[FAILED],
+            'quarantined' : counts[QUARANTINED],
+            'completed' : counts[COMPLETED],
         }
-        while len(self.path_queue) > 0:
-            self.log.warning('Unfinished Path %s', self.decoded_path(self.path_queue.get()))
-            self.path_queue.consume()
-        self.delete(self.dest_queue.path, recursive=True)
-        self.delete(self.path_queue.path, recursive=True)
+        values.update(self.write_report(unfinished))
+        if self.historydb:
+            if finished and not unfinished:
+                self.record_history(values)
+            else:
+                self.log.info('Session %s was not finished, not adding the run to history %s',
+                              self.session, self.historydb)
 
         self.output_stats()
-        self.delete(self.znode_path(self.stats_path), recursive=True)
-
-        while len(self.failed_queue) > 0:
-            self.log.error('Failed Path %s', self.decoded_path(self.failed_queue.get()))
-            self.failed_queue.consume()
-
-        while len(self.completed_queue) > 0:
-            self.log.info('Completed Path %s', self.decoded_path(self.completed_queue.get()))
-            self.completed_queue.consume()
-
-        self.log.info('Output:')
-        while len(self.output_queue) > 0:
-            self.log.info(self.output_queue.get().decode())
-            self.output_queue.consume()
-
-        self.delete(self.completed_queue.path, recursive=True)
-        self.delete(self.failed_queue.path, recursive=True)
-        self.delete(self.output_queue.path, recursive=True)
+        trees = [self.dest_queue.path, self.path_queue.path, self.stats_path, self.retries_path, self.bwlimit_path]
+        trees.extend(f'{self.session}/{tree}' for tree in ['topology', 'destinfo', 'drain', 'leases', 'stalls',
+                                                           'retrycounts', 'prewarm', 'progress', 'live'])
+        if finished:
+            trees.append(self.checkpoint_path)
+        else:
+            self.log.warning('Session %s was not finished, keeping its checkpoint to resume', self.session)
+        self.delete_trees(trees)
         self.remove_ready_watch()
         self.release_lock()
         self.log.info('Cleanup done: Lock, Queues and watch removed')
@@ -292,16 +1327,17 @@ class RsyncSource(RsyncController):
             self.write_donefile(values)
 
 
-    def generate_file(self, path):
+    def generate_file(self, path, root=None):
         """
         Writes the relative path used for the rsync of this path,
         for use by --files-from.
         """
-        if not path.startswith(self.rsyncpath):
-            self.log.raiseException('Invalid path! %s is not a subpath of %s!', path, self.rsyncpath)
+        rootpath = self.root_path(root)
+        if not path.startswith(rootpath):
+            self.log.raiseException('Invalid path! %s is not a subpath of %s!', path, rootpath)
             return None
         else:
-            subpath = path[len(self.rsyncpath):]
+            subpath = path[len(rootpath):]
             subpath = f'{subpath.strip(os.path.sep)}/'
             try:
                 fd, name = tempfile.mkstemp(dir=self.RSDIR, text=True)
@@ -318,44 +1354,159 @@ class RsyncSource(RsyncController):
                     wfile.write(subpath.encode('utf-8', "surrogateescape"))
             return name
 
-    def attempt_run(self, path, attempts=3):
-        """ Try to run a command x times, on failure add to failed queue """
-
-        attempt = 1
-        while attempt <= attempts:
+    def attempt_run(self, path):
+        """
+        Run the command for a path once.
+        On failure the path is, depending on the exit code, retried later or quarantined.
+        Either way the path is handed back to the queue right away, so this worker can go on.
+        """
+        dest = self.get_a_dest(self.DEST_WAIT)  # Keeps it if not consuming
+        if not dest or not self.basepath_ok():
+            self.path_queue.put(self.encoded_path(path), priority=self.NODEST_PRIORITY)  # Keep path in queue
+            self.path_queue.consume()  # But stop locking it
+            return 1, None
+        port, host, _ = tuple(dest.split(':', 2))
+        if self.destprewarm:
+            self.announce_paths(dest, path)
 
-            dest = self.get_a_dest(attempts)  # Keeps it if not consuming
-            if not dest or not self.basepath_ok():
-                self.path_queue.put(self.encoded_path(path), priority=50)  # Keep path in queue
-                self.path_queue.consume()  # But stop locking it
-                time.sleep(self.TIME_OUT)  # Wait before new attempt
-                return 1, None
-            port, host, _ = tuple(dest.split(':', 2))
+        starttime = time.time()
+        self.local.run_stats = {}
+        if self.netcat:
+            code, output = self.run_netcat(path, host, port)
+        else:
+            code, output = self.run_rsync(path, host, port)
+        self.local.run_details = dict(self.local.run_stats, duration=time.time() - starttime, dest=dest)
+        if code == RSYNC_REVOKED_EXITCODE or self.path_lost():
+            self.log.warning('Lease on path %s was revoked while it ran, dropping it: another worker took it', path)
+            self.path_queue.processing_element = None
+            return code, output
 
-            if self.netcat:
-                code, output = self.run_netcat(path, host, port)
+        if code == RSYNC_VANISHED_EXITCODE:
+            self.log.warning('Some files of path %s vanished during the transfer', path)
+            code = 0
+        if code == 0:
+            self.finish_path(path, COMPLETED, code, output)
+        elif code == RSYNC_STALL_EXITCODE:
+            self.handle_stall(path)
+        else:
+            if code in RSYNC_CONNECTION_EXITCODES:
+                self.log.warning('Connection to destination %s failed, releasing it', dest)
+                self.dest_queue.release()
+            if code in RSYNC_PERMANENT_EXITCODES:
+                self.log.error('Path %s failed with permanent error %s, quarantined', path, code)
+                self.finish_path(path, QUARANTINED, code, output)
             else:
-                code, output = self.run_rsync(path, host, port)
-            if code == 0:
-                self.completed_queue.put(self.encoded_path(path))
-                return code, output
-            attempt += 1
-            time.sleep(self.WAITTIME)  # Wait before new attempt
+                self.schedule_retry(path, code)
+            self.path_queue.consume()
+        return code, output
+
+    def announce_paths(self, dest, path):
+        """
+        Announce the current path and the paths claimed ahead to the destination, relative to their root,
+        so it can warm its metadata caches before the rsyncs arrive. Every path is announced once per destination:
+        only the announced paths that are still current or claimed ahead are remembered.
+        """
+        destid = dest.split(':', 1)[1]
+        announced = getattr(self.local, 'announced', None)
+        if announced is None or announced[0] != destid:
+            announced = self.local.announced = (destid, set())
+        paths = [path] + [self.decoded_path(queue.processing_element[1])
+                          for queue in list(self.local_lookahead()) if queue.processing_element]
+        for encpath in paths:
+            if encpath in announced[1]:
+                continue
+            root, subpath, recursive = decode_root_path(encpath)
+            value = {'root': root or '', 'path': os.path.relpath(subpath, self.root_path(root)), 'recursive': recursive}
+            self.create(self.znode_path(f'{self.session}/prewarm/{destid}/path-'), json.dumps(value).encode(),
+                        sequence=True, makepath=True)
+            announced[1].add(encpath)
+        announced[1].intersection_update(paths)
+
+    def path_counter(self, kind, encpath):
+        """ A counter of kind for the encoded path """
+        return Counter(self, self.znode_path(f'{self.session}/{kind}/{hashlib.sha1(encpath).hexdigest()}'))
+
+    def schedule_retry(self, path, code):
+        """
+        Schedule a retry of a failed path with exponential backoff, or give up after maxretries retries.
+        The retry is a znode named after the time it is due, any source promotes it back to the queue.
+        """
+        encpath = self.encoded_path(path)
+        counter = self.path_counter('retrycounts', encpath)
+        counter += 1
+        if counter.value > self.maxretries:
+            self.log.error('There were issues with path %s! Exit code %s, gave up after %s retries',
+                           path, code, self.maxretries)
+            self.finish_path(path, FAILED, code)
+            return
+        delay = min(self.MAX_RETRY_DELAY, self.retrydelay * 2 ** (counter.value - 1))
+        due = time.time() + delay
+        self.create(self.znode_path(f'{self.retries_path}/{int(due * 1000):015d}-'), encpath,
+                    sequence=True, makepath=True)
+        self.log.warning('Path %s failed with exit code %s, retry %s in %s seconds', path, code, counter.value, delay)
+
+    def len_retries(self):
+        """ Number of paths waiting for a retry """
+        if not self.exists(self.znode_path(self.retries_path)):
+            return 0
+        return len(self.get_children(self.znode_path(self.retries_path)))
+
+    def promote_retries(self, now=None):
+        """ Put the paths whose retry is due back in the path queue, at most every SLEEPTIME """
+        if now is None:
+            now = time.time()
+        if now - self.retries_checked < self.SLEEPTIME:
+            return
+        self.retries_checked = now
+        retries_path = self.znode_path(self.retries_path)
+        try:
+            retries = sorted(self.get_children(retries_path))
+        except NoNodeError:
+            return
+        queue = self.path_queue
+        for retry in retries:
+            if int(retry.split('-')[0]) > now * 1000:
+                break  # sorted by due time
+            try:
+                encpath, _ = self.get(f'{retries_path}/{retry}')
+            except NoNodeError:
+                continue  # promoted by another client
+            # Same entry as LockingQueue.put, but atomically with the removal of the retry,
+            # so the path is never lost or queued twice, and never absent from both
+            transaction = self.transaction()
+            transaction.delete(f'{retries_path}/{retry}')
+            # pylint: disable=protected-access
+            transaction.create(f'{queue._entries_path}/{queue.entry}-{self.RETRY_PRIORITY:03d}-', encpath,
+                               sequence=True)
+            if any(isinstance(result, Exception) for result in transaction.commit()):
+                continue  # promoted by another client
+            self.log.debug('Retry of path %s is due', self.decoded_path(encpath))
 
-        self.log.error('There were issues with path %s!', path)
-        self.failed_queue.put(self.encoded_path(path))
-        return 0, output  # otherwise client get stuck
+    def handle_stall(self, path):
+        """
+        Put a stalled path back in the queue after all other paths, or quarantine it
+        when it stalled maxstalls times, so it can be split or handled by hand.
+        """
+        encpath = self.encoded_path(path)
+        counter = self.path_counter('stalls', encpath)
+        counter += 1
+        if counter.value >= self.maxstalls:
+            self.log.error('Path %s stalled %s times, quarantined', path, counter.value)
+            self.finish_path(path, QUARANTINED, RSYNC_STALL_EXITCODE)
+        else:
+            self.log.warning('Path %s stalled (%s times), requeued', path, counter.value)
+            self.path_queue.put(encpath, priority=self.STALL_PRIORITY)
+        self.path_queue.consume()
 
     def parse_output(self, output):
         """
-        Parse the rsync output stats, and when verbose, print the files marked for transmission
+        Parse the rsync output stats. When verbose, the stats come after the file list, which is in the output log.
+        Returns the parsed stats of this output
         """
+        stats = {}
 
         if self.rsync_verbose:
-            outp = output.split(f"{os.linesep}{os.linesep}")
-            self.log.info('Verbose file list output is: %s', outp[0])
-            del outp[0]
-            output = os.linesep.join(outp)
+            output = output.partition(f"{os.linesep}{os.linesep}")[2]
 
         lines = output.splitlines()
         for line in lines:
@@ -369,7 +1520,9 @@ class RsyncSource(RsyncController):
             if key not in self.RSYNC_STATS:
                 self.log.debug('output metric not recognised: %s', key)
                 continue
+            stats[key] = int(val)
             self.counters[key] += int(val)
+        return stats
 
     def get_flags(self, files, recursive):
         """
@@ -391,8 +1544,13 @@ class RsyncSource(RsyncController):
             flags.append('--inplace')
         if self.rsync_timeout:
             flags.extend(['--timeout', str(self.rsync_timeout)])
+        bwlimit = self.bwlimit_share()
+        if bwlimit:
+            flags.append(f'--bwlimit={bwlimit}')
         if self.rsync_verbose:
             flags.append('--verbose')
+        if self.progressinterval:
+            flags.append('--info=progress2')
         if self.rsync_dry:
             flags.append('-n')
         # This should always be processed last
@@ -410,16 +1568,27 @@ class RsyncSource(RsyncController):
         Runs the rsync command with or without recursion, delete or dry-run option.
         It uses the destination module linked with this session.
         """
-        path, recursive = decode_path(encpath)
-        gfile = self.generate_file(path)
+        root, path, recursive = decode_root_path(encpath)
+        gfile = self.generate_file(path, root)
         flags = self.get_flags(gfile, recursive)
 
         self.log.info('%s is sending path %s to %s %s', self.whoami, path, host, port)
         self.log.debug('Used flags: "%s"', ' '.join(flags))
-        command = f"rsync {' '.join(flags)} {self.rsyncpath}/ rsync://{host}:{port}/{self.module}"
-        code, output = RunAsyncLoopLog.run(command)
+        command = f"rsync {' '.join(flags)} {self.root_path(root)}/ rsync://{host}:{port}/{self.module_name(root)}"
+        starttime = time.time()
+        self.local.live_state = (starttime, starttime, 0)
+        self.local.credited = (0, 0)
+        outputlog = getattr(self.local, 'outputlog', None)
+        if outputlog:
+            outputlog.start(encpath)
+        code, output = RunRsync.run(command, watchclient=self, outputlog=outputlog)
+        self.publish_live(None, force=True)
         os.remove(gfile)
-        self.parse_output(output)
+        stats = self.parse_output(output)
+        self.local.run_stats = {'bytes': stats.get('Total_bytes_sent', 0), 'files': stats.get('Number_of_files', 0),
+                                'size': stats.get('Total_file_size', 0)}
+        self.concurrency.record(self.local.run_stats['bytes'], self.local.run_stats['files'], time.time() - starttime,
+                                credited=self.local.credited)
         return code, None
 
     def run_netcat(self, path, host, port):
@@ -439,24 +1608,32 @@ class RsyncSource(RsyncController):
             self.log.raiseException(f'Invalid path: {path} !')
             return None
         else:
-            code, output = self.attempt_run(path)
-            if output:
-                self.output_queue.put(output.encode())
+            code, _ = self.attempt_run(path)
             return code == 0
 
 
-    def get_a_dest(self, attempts):
-        """ Try to get a destination x times """
-        attempt = 1
-        while attempt <= attempts:
-            dest = self.try_a_dest(self.TIME_OUT)  # Keeps it if not consuming
+    def get_a_dest(self, timeout):
+        """
+        Wait up to timeout seconds for a valid destination.
+        The destination queue wakes us up as soon as a destination is added or released.
+        """
+        deadline = time.time() + timeout
+        remaining = timeout
+        while remaining > 0:
+            dest = self.try_a_dest(remaining)  # Keeps it if not consuming
             if dest:  # We locked a rsync daemon
                 self.log.debug('Got destination %s', dest)
                 return dest
-            attempt += 1
-            time.sleep(self.WAITTIME)
+            if self.dest_queue.processing_element is not None:
+                # An invalid destination that was not removed: let it go and wait for a change of the queue
+                self.dest_queue.release()
+                entries = f'{self.dest_queue.path}/entries'
+                current = self.retry(self.get_children, entries)
+                self.wait_for_children(entries, lambda children, current=current: children != current,
+                                       deadline - time.time())
+            remaining = deadline - time.time()
 
-        self.log.warning('Still no destination after %s tries', attempts)
+        self.log.warning('Still no destination after %s seconds', timeout)
         return None
 
     def dest_is_sane(self, dest):
@@ -482,7 +1659,8 @@ class RsyncSource(RsyncController):
     def try_a_dest(self, timeout):
         """
         Try to get a destination.
-        check if destination is still running, otherwise remove
+        check if destination is still running, otherwise remove.
+        An active destination is validated with the local caches, otherwise with zookeeper itself.
         """
         if len(self.dest_queue) == 0:
             self.log.debug('Destinations not yet available')
@@ -491,6 +1669,8 @@ class RsyncSource(RsyncController):
             dest = dest.decode()
         if dest:
             port, whoami = tuple(dest.split(':', 1))
+            if self.cached_dest_ok(whoami, port):
+                return dest
             if not self.member_of_party(whoami, 'allsd'):
                 self.log.debug('destination is not found in party')
                 self.dest_queue.consume()
@@ -507,6 +1687,68 @@ class RsyncSource(RsyncController):
                     return None
         return dest
 
+    def local_lookahead(self):
+        """ The path queues of the current thread holding the paths claimed ahead, in order """
+        if not hasattr(self.local, 'lookahead'):
+            self.local.lookahead = []
+            self.local.prefetcher = None
+        return self.local.lookahead
+
+    def claim_ahead(self, lookahead, count):
+        """ Claim up to count more paths without waiting, each with its own queue, and warm their metadata """
+        for _ in range(count):
+            queue = RevocableLockingQueue(self, self.znode_path(self.session + '/pathQueue'))
+            queue = self.instrumented('queue', queue)
+            encpath = queue.get(0)
+            if encpath is None:
+                break
+            lookahead.append(queue)
+            self.log.debug('Claimed path %s ahead', self.decoded_path(encpath))
+            if self.prewarm:
+                _, path, recursive = decode_root_path(self.decoded_path(encpath))
+                warm_metadata(path, recursive, threads=self.PREWARM_THREADS)
+
+    def prefetch(self):
+        """ Fill the lookahead of the current thread in the background, while the current path is transferred """
+        lookahead = self.local_lookahead()
+        count = self.lookahead - len(lookahead)
+        if count > 0 and not self.is_ready() and not self.draining:
+            self.local.prefetcher = threading.Thread(target=self.claim_ahead, args=(lookahead, count),
+                                                     name=f'{threading.current_thread().name}-prefetch')
+            self.local.prefetcher.daemon = True
+            self.local.prefetcher.start()
+
+    def wait_prefetch(self):
+        """
+        Wait until the background claims of the current thread are done.
+        Prewarming the claimed paths can take long, so the lease of the worker is renewed while waiting.
+        """
+        self.local_lookahead()
+        prefetcher = self.local.prefetcher
+        if prefetcher is not None:
+            while prefetcher.is_alive():
+                prefetcher.join(self.PREFETCH_WAIT)
+                self.heartbeat()
+            self.local.prefetcher = None
+
+    def next_path(self, timeout=None):
+        """
+        Get the next path: the one still held, the first path claimed ahead, or a new one from the queue.
+        The queue holding a path claimed ahead becomes the path queue of this thread, so it is consumed as usual.
+        """
+        self.wait_prefetch()
+        lookahead = self.local_lookahead()
+        if lookahead and self.path_queue.processing_element is None:
+            self.local.path_queue = lookahead.pop(0)
+        return self.path_queue.get(timeout)
+
+    def release_lookahead(self):
+        """ Hand back the paths claimed ahead by the current thread """
+        self.wait_prefetch()
+        lookahead = self.local_lookahead()
+        while lookahead:
+            lookahead.pop(0).release()
+
     def rsync(self, timeout=None):
         """ Get a destination, a path and call a new rsync iteration """
         if self.verifypath:
@@ -514,8 +1756,17 @@ class RsyncSource(RsyncController):
                 self.log.warning('Basepath not available, waiting')
                 time.sleep(self.CHECK_WAIT)
                 return None
-        path = self.decoded_path(self.path_queue.get(timeout))
+        path = self.decoded_path(self.next_path(timeout))
         if path:
-            if self.rsync_path(path):
-                self.path_queue.consume()
+            semaphore = self.acquire_topology_slot(path)
+            if semaphore is False:
+                return None
+            if self.lookahead:
+                self.prefetch()
+            try:
+                if self.rsync_path(path):
+                    self.path_queue.consume()
+            finally:
+                if semaphore:
+                    semaphore.release()
         return None
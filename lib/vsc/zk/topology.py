@@ -0,0 +1,116 @@
+#
+# Copyright 2013-2023 Ghent University
+#
+# This file is part of vsc-zk,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://www.vscentrum.be),
+# the Flemish Research Foundation (FWO) (http://www.fwo.be/en)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# https://github.com/hpcugent/vsc-zk
+#
+# vsc-zk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Library General Public License as
+# published by the Free Software Foundation, either version 2 of
+# the License, or (at your option) any later version.
+#
+# vsc-zk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with vsc-zk. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+vsc-zk topology
+
+Tag paths with the storage unit (device, fileset, pool, ...) they live on,
+so work can be spread over the storage units.
+
+@author: Kenneth Waegeman (Ghent University)
+"""
+
+import os
+import re
+import shlex
+
+from vsc.utils import fancylogger
+from vsc.utils.run import RunAsync
+
+logger = fancylogger.getLogger()
+
+TOPO_DEV = 'dev'
+TOPO_PREFIX = 'prefix'
+TOPO_COMMAND = 'command'
+TOPO_MODES = [TOPO_DEV, TOPO_PREFIX, TOPO_COMMAND]
+DEFAULT_KEY = 'default'
+
+def parse_prefixmap(topomap):
+    """
+    Parse a list of <prefix>:<key> strings into a list of (prefix, key) tuples, longest prefix first
+    """
+    prefixmap = []
+    for prefixkey in topomap or []:
+        prefix, _, key = prefixkey.rpartition(':')
+        if not prefix or not key:
+            logger.raiseException(f'Invalid topology map entry {prefixkey}, should be <prefix>:<key>')
+        prefixmap.append((prefix.rstrip(os.path.sep), key))
+    prefixmap.sort(key=lambda prefkey: len(prefkey[0]), reverse=True)
+    logger.debug("prefixmap is %s", prefixmap)
+    return prefixmap
+
+def prefix_key(path, prefixmap):
+    """Return the key of the longest prefix in prefixmap that contains path"""
+    for prefix, key in prefixmap:
+        if path == prefix or path.startswith(f'{prefix}{os.path.sep}'):
+            return key
+    return DEFAULT_KEY
+
+def command_key(path, command):
+    """
+    Return the output of command as key, command is a template with %(path)s
+    eg. a GPFS lookup like "mmlsattr -L %(path)s | awk '/^fileset name:/ {print $3}'"
+    """
+    code, output = RunAsync.run(command % {'path': shlex.quote(path)})
+    if code != 0 or not output.strip():
+        logger.warning('topology command for %s failed (code %s): %s', path, code, output)
+        return DEFAULT_KEY
+    return output.strip().splitlines()[-1]
+
+def topology_key(path, mode, prefixmap=None, command=None):
+    """
+    Return the topology key of path, depending on mode:
+     - dev: the device id of the path
+     - prefix: the key of the longest matching prefix from prefixmap
+     - command: the output of the command template
+    The key is safe to use as a znode name.
+    """
+    if mode == TOPO_DEV:
+        key = str(os.stat(path).st_dev)
+    elif mode == TOPO_PREFIX:
+        key = prefix_key(path, prefixmap or [])
+    elif mode == TOPO_COMMAND:
+        key = command_key(path, command)
+    else:
+        logger.raiseException(f'Unknown topology mode {mode}')
+        return None
+    return re.sub(r'[^\w.-]', '_', key)
+
+def interleave_paths(paths, keyfunc):
+    """
+    Reorder paths round robin over their keys, keeping the original order for paths with the same key.
+    """
+    groups = {}
+    for path in paths:
+        groups.setdefault(keyfunc(path), []).append(path)
+    logger.info('paths are spread over %d topology keys', len(groups))
+
+    interleaved = []
+    grouplists = list(groups.values())
+    for idx in range(max([len(group) for group in grouplists] or [0])):
+        for group in grouplists:
+            if idx < len(group):
+                interleaved.append(group[idx])
+    return interleaved
@@ -0,0 +1,55 @@
+#
+# Copyright 2012-2023 Ghent University
+#
+# This file is part of vsc-zk,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://www.vscentrum.be),
+# the Flemish Research Foundation (FWO) (http://www.fwo.be/en)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# https://github.com/hpcugent/vsc-zk
+#
+# vsc-zk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Library General Public License as
+# published by the Free Software Foundation, either version 2 of
+# the License, or (at your option) any later version.
+#
+# vsc-zk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with vsc-zk. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Unit tests for checkpoint
+
+@author: Kenneth Waegeman (Ghent University)
+"""
+import vsc.zk.checkpoint as cp
+
+from vsc.install.testing import TestCase
+
+class CheckpointTest(TestCase):
+    """Tests for checkpoint"""
+
+    def test_paths(self):
+        """ Test packing chunks of paths """
+        paths = [f'{idx}:0_/tree/a{idx}' for idx in range(7)] + ['7:1_/tree/b\udcff']
+        chunks = cp.chunk_list(paths, 3)
+        self.assertEqual([len(chunk) for chunk in chunks], [3, 3, 2])
+        unpacked = []
+        for chunk in chunks:
+            unpacked.extend(cp.unpack_list(cp.pack_list(chunk)))
+        self.assertEqual(unpacked, paths)
+
+    def test_indices(self):
+        """ Test packing indices into a bitmap """
+        indices = {0, 7, 8, 9, 100, 12345}
+        data = cp.pack_indices(indices)
+        self.assertEqual(cp.unpack_indices(data), indices)
+        self.assertTrue(len(data) < 100)
+        self.assertEqual(cp.unpack_indices(cp.pack_indices(set())), set())
+        self.assertEqual(cp.unpack_indices(cp.pack_indices(range(10000))), set(range(10000)))
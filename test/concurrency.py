@@ -0,0 +1,104 @@
+#
+# Copyright 2012-2023 Ghent University
+#
+# This file is part of vsc-zk,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://www.vscentrum.be),
+# the Flemish Research Foundation (FWO) (http://www.fwo.be/en)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# https://github.com/hpcugent/vsc-zk
+#
+# vsc-zk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Library General Public License as
+# published by the Free Software Foundation, either version 2 of
+# the License, or (at your option) any later version.
+#
+# vsc-zk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with vsc-zk. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Unit tests for the adaptive concurrency controller
+
+@author: Kenneth Waegeman (Ghent University)
+"""
+from vsc.install.testing import TestCase
+from vsc.zk.rsync.concurrency import ConcurrencyController, METRIC_BYTES, METRIC_FILES
+
+class ConcurrencyTest(TestCase):
+    """Tests for ConcurrencyController"""
+
+    def test_fixed(self):
+        """ Without a metric all workers stay active """
+        ctrl = ConcurrencyController(4)
+        self.assertEqual(ctrl.adjust(now=ctrl.interval_start + 1000), 4)
+        self.assertTrue(ctrl.is_active(3))
+        self.assertFalse(ctrl.is_active(4))
+
+    def test_aimd(self):
+        """ Test the additive increase and multiplicative decrease """
+        ctrl = ConcurrencyController(8, metric=METRIC_BYTES, interval=10)
+        self.assertEqual(ctrl.limit, 4)
+        now = ctrl.interval_start
+
+        # not a full interval yet
+        ctrl.record(1000, 10, 5)
+        self.assertEqual(ctrl.adjust(now=now + 5), 4)
+
+        now += 10
+        self.assertEqual(ctrl.adjust(now=now), 5)
+        self.assertFalse(ctrl.is_active(5))
+        self.assertTrue(ctrl.wait_active(4, 0))
+
+        ctrl.record(2000, 10, 5)
+        now += 10
+        self.assertEqual(ctrl.adjust(now=now), 6)
+
+        ctrl.record(2010, 10, 5)
+        now += 10
+        self.assertEqual(ctrl.adjust(now=now), 6)
+
+        ctrl.record(500, 10, 5)
+        now += 10
+        self.assertEqual(ctrl.adjust(now=now), 3)
+        self.assertFalse(ctrl.wait_active(3, 0))
+
+    def test_progress(self):
+        """ Test crediting running rsyncs, and holding when nothing progressed """
+        ctrl = ConcurrencyController(8, metric=METRIC_BYTES, interval=10)
+        now = ctrl.interval_start
+        ctrl.progress(600, 0)
+        now += 10
+        self.assertEqual(ctrl.adjust(now=now), 5)
+        self.assertEqual(ctrl.previous, 60)
+
+        # no path finished and nothing transferred: no reason to decrease
+        now += 10
+        self.assertEqual(ctrl.adjust(now=now), 5)
+        self.assertEqual(ctrl.previous, 60)
+
+        # only the rest of a path that ran for many intervals is credited when it finishes
+        ctrl.progress(600, 0)
+        ctrl.record(1000, 10, 100, credited=(400, 0))
+        now += 10
+        self.assertEqual(ctrl.adjust(now=now), 6)
+        self.assertEqual(ctrl.previous, 120)
+
+    def test_files_metric_and_probe(self):
+        """ Test the files metric and probing after a plateau """
+        ctrl = ConcurrencyController(3, metric=METRIC_FILES, interval=1)
+        now = ctrl.interval_start
+        limits = []
+        for _ in range(ctrl.PROBE_INTERVALS + 3):
+            ctrl.record(0, 100, 1)
+            now += 1
+            limits.append(ctrl.adjust(now=now))
+        self.assertEqual(limits[0], 2)
+        self.assertEqual(limits[1:ctrl.PROBE_INTERVALS + 1], [2] * ctrl.PROBE_INTERVALS)
+        self.assertEqual(limits[ctrl.PROBE_INTERVALS + 1], 3)
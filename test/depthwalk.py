@@ -141,3 +141,49 @@ class DepthWalkTest(TestCase):
         """ Test the decoding of a path """
         self.assertEqual(dw.decode_path('0_/tree/c1'), ('/tree/c1', 0))
         self.assertEqual(dw.decode_path('1_/tree/b1/bb2/.snapshots'), ('/tree/b1/bb2/.snapshots', 1))
+
+    def test_encode_decode_root_paths(self):
+        """ Test the encoding and decoding of paths with a root id """
+        arrin = [('/tree/c1', 0), ('/tree/b1/b_b2', 1)]
+        enclist = dw.encode_paths(arrin, 'home')
+        self.assertEqual(enclist, ['0_home_/tree/c1', '1_home_/tree/b1/b_b2'])
+        self.assertEqual(dw.decode_root_path(enclist[1]), ('home', '/tree/b1/b_b2', 1))
+        self.assertEqual(dw.decode_path(enclist[1]), ('/tree/b1/b_b2', 1))
+        self.assertEqual(dw.decode_root_path('0_/tree/c1'), (None, '/tree/c1', 0))
+
+    def test_warm_metadata(self):
+        """ Test stat-ing a tree to warm the caches """
+        self.assertEqual(dw.warm_metadata(self.basedir, 0), 3)
+        self.assertEqual(dw.warm_metadata(f'{self.basedir}/a1', 0, threads=2), 5)
+        self.assertEqual(dw.warm_metadata(self.basedir, 1), 42)
+        self.assertEqual(dw.warm_metadata(self.basedir, 1, maxentries=10), 14)
+        self.assertEqual(dw.warm_metadata(f'{self.basedir}/missing', 1), 0)
+
+    def test_index_paths(self):
+        """ Test the index prefix of encoded paths """
+        enclist = dw.index_paths(['0_/tree/c1', '1_home_/tree/b1/b_b2:x'])
+        self.assertEqual(enclist, ['0:0_/tree/c1', '1:1_home_/tree/b1/b_b2:x'])
+        self.assertEqual(dw.path_index(enclist[1]), 1)
+        self.assertEqual(dw.path_index('1_home_/tree/b1/b_b2:x'), None)
+        self.assertEqual(dw.decode_root_path(enclist[1]), ('home', '/tree/b1/b_b2:x', 1))
+        self.assertEqual(dw.decode_path(enclist[0]), ('/tree/c1', 0))
+
+    def test_pathlist_counts(self):
+        """ Test the entry counts of the walked paths """
+        regex = re.compile(r'/\.snapshots(/.*|$)')
+        counts = {}
+        pathlist = dw.get_pathlist(self.basedir, 3, exclude_re=regex, counts=counts)
+        self.assertEqual(counts[self.basedir], 3)
+        self.assertEqual(counts[f'{self.basedir}/a1'], 5)
+        self.assertEqual(counts[f'{self.basedir}/a1/ab2'], 3)
+        self.assertEqual(sorted(counts), sorted(path for path, _ in pathlist))
+        # recursive paths are counted too, with the entries directly in them
+        for path, rec in pathlist:
+            if rec:
+                self.assertEqual(counts[path], len(os.listdir(path)))
+        counts = {}
+        dw.get_pathlist(self.basedir, 0, counts=counts)
+        self.assertEqual(counts, {self.basedir: 3})
+        self.assertEqual(dw.count_entries(f'{self.basedir}/none'), None)
+        self.assertEqual(dw.unindexed_path('3:1_home_/tree/b1'), '1_home_/tree/b1')
+        self.assertEqual(dw.unindexed_path('1_home_/tree/b1:x'), '1_home_/tree/b1:x')
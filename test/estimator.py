@@ -0,0 +1,78 @@
+#
+# Copyright 2012-2023 Ghent University
+#
+# This file is part of vsc-zk,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://www.vscentrum.be),
+# the Flemish Research Foundation (FWO) (http://www.fwo.be/en)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# https://github.com/hpcugent/vsc-zk
+#
+# vsc-zk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Library General Public License as
+# published by the Free Software Foundation, either version 2 of
+# the License, or (at your option) any later version.
+#
+# vsc-zk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with vsc-zk. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Unit tests for the progress estimator
+
+@author: Kenneth Waegeman (Ghent University)
+"""
+
+from vsc.install.testing import TestCase
+
+from vsc.zk.rsync.estimator import ProgressEstimator, format_duration, format_estimate
+
+
+class EstimatorTest(TestCase):
+    """ Test the progress estimator """
+
+    def test_estimate(self):
+        """ Test weighting the finished paths by their predicted cost and the eta """
+        estimator = ProgressEstimator([[10, 1000], [30, None], [None, 3000]])
+        self.assertEqual(estimator.predicted, {'files': [10, 30, 20], 'size': [1000, 2000, 3000]})
+
+        estimate = estimator.update(set(), {}, now=0)
+        self.assertEqual(estimate['size_pct'], 0)
+        self.assertEqual(estimate['eta'], None)
+
+        stats = {'Number_of_files': 12, 'Total_file_size': 1200, 'Total_bytes_sent': 600}
+        estimate = estimator.update({0}, stats, now=100)
+        self.assertAlmostEqual(estimate['size_pct'], 100 / 6)
+        self.assertAlmostEqual(estimate['files_pct'], 100 / 6)
+        self.assertEqual(estimate['sent_rate'], 6)
+        # 1200 bytes for a sixth of the work, 6000 bytes left at 12 bytes/s
+        self.assertAlmostEqual(estimate['eta'], 500)
+
+        stats = {'Number_of_files': 72, 'Total_file_size': 7200, 'Total_bytes_sent': 600}
+        estimate = estimator.update({0, 1, 2}, stats, now=200)
+        self.assertAlmostEqual(estimator.rates['size'], 12 + 0.3 * (60 - 12))
+        self.assertEqual(estimate['eta'], 0)
+        self.assertEqual(estimate['paths_pct'], 100)
+
+    def test_unknown_costs(self):
+        """ Test falling back to the number of paths without any prediction """
+        estimator = ProgressEstimator([[None, None]] * 4)
+        estimate = estimator.update({1}, {}, now=0)
+        self.assertEqual(estimate['size_pct'], None)
+        self.assertEqual(estimate['eta'], None)
+        self.assertEqual(format_estimate(estimate), '25.0% of paths done, 0 bytes/s sent, 0.0 files/s')
+
+    def test_format(self):
+        """ Test formatting durations and estimates """
+        self.assertEqual(format_duration(59), '0m59s')
+        self.assertEqual(format_duration(3 * 3600 + 240), '3h04m')
+        self.assertEqual(format_duration(2 * 86400 + 3600), '2d01h00m')
+        estimate = {'size_pct': 50, 'files_pct': 25.25, 'sent_rate': 1000, 'files_rate': 2.5, 'eta': 90}
+        self.assertEqual(format_estimate(estimate),
+                         '50.0% of bytes, 25.2% of files done, 1000 bytes/s sent, 2.5 files/s, ETA 1m30s')
@@ -0,0 +1,80 @@
+#
+# Copyright 2012-2023 Ghent University
+#
+# This file is part of vsc-zk,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://www.vscentrum.be),
+# the Flemish Research Foundation (FWO) (http://www.fwo.be/en)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# https://github.com/hpcugent/vsc-zk
+#
+# vsc-zk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Library General Public License as
+# published by the Free Software Foundation, either version 2 of
+# the License, or (at your option) any later version.
+#
+# vsc-zk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with vsc-zk. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Unit tests for the run history
+
+@author: Kenneth Waegeman (Ghent University)
+"""
+import os
+import shutil
+import tempfile
+
+from vsc.install.testing import TestCase
+from vsc.zk.rsync.history import RunHistory
+
+
+class RunHistoryTest(TestCase):
+    """Tests for the run history"""
+
+    def setUp(self):
+        """ Set up a temporary directory """
+        super().setUp()
+        self.historydir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """ Remove the temporary directory """
+        shutil.rmtree(self.historydir)
+        super().tearDown()
+
+    def test_trend(self):
+        """ Test recording runs and flagging regressions """
+        history = RunHistory(os.path.join(self.historydir, 'sub', 'history.db'))
+        for idx, (walltime, throughput) in enumerate([(100, 50), (110, 45), (90, 55), (150, 40), (95, 30)]):
+            history.record('nightly', {'finished': 1000 + idx, 'walltime': walltime, 'throughput': throughput,
+                                       'walktime': 10, 'paths': 20, 'slowest': [['0:0_/tmp/a', 5]]})
+        history.record('other', {'finished': 2000, 'walltime': 1000})
+
+        runs = history.runs('nightly')
+        self.assertEqual(len(runs), 5)
+        self.assertEqual(runs[0]['slowest'], [['0:0_/tmp/a', 5]])
+        self.assertEqual(runs[0]['enqueuetime'], None)
+
+        trend = history.trend('nightly', threshold=0.2, window=3)
+        self.assertEqual([flags for _, flags in trend[:3]], [{}, {}, {}])
+        self.assertEqual(set(trend[3][1]), {'walltime'})
+        self.assertAlmostEqual(trend[3][1]['walltime'], 0.5)
+        self.assertEqual(set(trend[4][1]), {'throughput'})  # median of 45, 55 and 40 is 45
+        self.assertEqual(history.trend('none'), [])
+
+    def test_costs(self):
+        """ Test keeping the path costs of the last run """
+        history = RunHistory(os.path.join(self.historydir, 'history.db'))
+        history.record_costs('nightly', [('0_/tmp/a', 10, 1000), ('1_/tmp/b', 2, None)])
+        history.record_costs('other', [('0_/tmp/a', 1, 1)])
+        self.assertEqual(history.costs('nightly'), {'0_/tmp/a': (10, 1000), '1_/tmp/b': (2, None)})
+        history.record_costs('nightly', [('0_/tmp/c', 3, 30)])
+        self.assertEqual(history.costs('nightly'), {'0_/tmp/c': (3, 30)})
+        self.assertEqual(history.costs('none'), {})
@@ -0,0 +1,174 @@
+#
+# Copyright 2012-2023 Ghent University
+#
+# This file is part of vsc-zk,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://www.vscentrum.be),
+# the Flemish Research Foundation (FWO) (http://www.fwo.be/en)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# https://github.com/hpcugent/vsc-zk
+#
+# vsc-zk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Library General Public License as
+# published by the Free Software Foundation, either version 2 of
+# the License, or (at your option) any later version.
+#
+# vsc-zk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with vsc-zk. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Unit tests for the zookeeper instrumentation
+
+@author: Kenneth Waegeman (Ghent University)
+"""
+
+import sys
+import threading
+
+import mock
+
+# same as in zkclient
+sys.modules['kazoo.client'] = __import__('mocky')
+sys.modules['kazoo.recipe.queue'] = __import__('mocky')
+sys.modules['kazoo.recipe.party'] = __import__('mocky')
+sys.modules['kazoo.recipe.counter'] = __import__('mocky')
+
+from vsc.install.testing import TestCase
+
+import vsc.zk.instrument
+from vsc.zk.instrument import ZkInstrument
+from vsc.zk.rsync.source import RsyncSource
+
+
+class Recipe:
+    """ A recipe that makes client calls """
+
+    def __init__(self, client):
+        self.client = client
+
+    def get(self):
+        """ Two calls """
+        self.client.exists('/a')
+        return self.client.exists('/b')
+
+    put = consume = release = get
+
+
+class Client:
+    """ A client whose synchronous calls go through the asynchronous ones, like the kazoo client """
+
+    def get(self, path):
+        """ One zookeeper call """
+        return self.get_async(path)
+
+    def get_async(self, path):
+        """ The call itself """
+        return path
+
+
+class Watch:
+    """ A watch that makes client calls from its own thread, like the kazoo watches """
+
+    def __init__(self, client, func):
+        self.client = client
+        self._func = func
+
+    def run(self):
+        """ Check the watched node """
+        self.client.exists('/watched')
+
+
+def watcher(data, stat):
+    """ A watch function """
+
+
+class InstrumentTest(TestCase):
+    """ Test the zookeeper instrumentation """
+
+    def test_instrument(self):
+        """ Test counting calls per role, operation and call site """
+        zkclient = RsyncSource('dummy', session='new', netcat=True, rsyncpath='/tmp', rsyncdepth=2, zkstats=0)
+        instrument = zkclient.zk_instrument
+        instrument.paths = lambda: 2
+        self.assertEqual(instrument.role, 'source')
+
+        # the calls of the base class are attributed to their callers
+        zkclient.stats = {'Number_of_files': 10}
+        zkclient.checkpoint_stats()
+        zkclient.get_znode('new/checkpoint/stats')
+        zkclient.ensure_path('/admin/rsync/new')
+        self.assertEqual(instrument.stats[('source', 'set', 'source.checkpoint_stats')][0], 1)
+        self.assertEqual(instrument.stats[('source', 'get', 'instrument.test_instrument')][0], 1)
+        self.assertEqual(instrument.stats[('source', 'ensure_path', 'instrument.test_instrument')][0], 1)
+
+        # the role is kept per thread
+        def master():
+            zkclient.set_role('master')
+            zkclient.checkpoint_stats()
+        thread = threading.Thread(target=master)
+        thread.start()
+        thread.join()
+        zkclient.checkpoint_stats()
+        self.assertEqual(instrument.stats[('master', 'set', 'source.checkpoint_stats')][0], 1)
+        self.assertEqual(instrument.stats[('source', 'set', 'source.checkpoint_stats')][0], 2)
+        self.assertEqual(instrument.role, 'source')
+
+        zkclient.exists = lambda path: True
+        queue = zkclient.instrumented('queue', Recipe(zkclient))
+        zkclient.set_role('worker')
+        self.assertTrue(queue.get())
+        self.assertEqual(instrument.recipe_stats[('worker', 'queue.get', 'instrument.test_instrument')][0], 1)
+
+        # the recipe operations are not in the totals
+        summary = instrument.summary()
+        self.assertTrue(summary[0].startswith('Zookeeper calls: 6 calls in '))
+        self.assertTrue('3.0 calls and' in summary[0])
+        self.assertEqual(summary[1].split(), ['role', 'operation', 'call', 'site', 'calls', 'total', 's', 'mean',
+                                              'ms', 'max', 'ms'])
+        self.assertTrue(summary[7].startswith('Recipe operations: 1 operations in '))
+        self.assertEqual(len(summary), 9)
+
+    def test_nested_calls(self):
+        """ Test counting a call that goes through another timed call once """
+        instrument = ZkInstrument('source')
+        client = Client()
+        instrument.instrument_client(client)
+        self.assertEqual(client.get('/a'), '/a')
+        self.assertEqual(instrument.stats, {('source', 'get', 'instrument.test_nested_calls'): mock.ANY})
+        self.assertEqual(instrument.stats[('source', 'get', 'instrument.test_nested_calls')][0], 1)
+        client.get_async('/a')
+        self.assertEqual(instrument.stats[('source', 'get_async', 'instrument.test_nested_calls')][0], 1)
+        self.assertTrue(instrument.summary()[0].startswith('Zookeeper calls: 2 calls in '))
+
+    def test_watch(self):
+        """ Test attributing the calls of the kazoo threads to the watch function """
+        instrument = ZkInstrument('source')
+        client = mock.Mock()
+        instrument.instrument_client(client)
+        watch = Watch(client, watcher)
+        with mock.patch.object(vsc.zk.instrument, 'SKIP_PREFIXES', vsc.zk.instrument.SKIP_PREFIXES + (__file__,)):
+            thread = threading.Thread(target=watch.run)
+            thread.start()
+            thread.join()
+        self.assertEqual(list(instrument.stats), [('source', 'exists', 'watch.instrument.watcher')])
+
+        # transactions are counted when committed
+        client.transaction().commit()
+        self.assertEqual(instrument.stats[('source', 'transaction.commit', 'instrument.test_watch')][0], 1)
+
+    def test_report(self):
+        """ Test logging the summary every interval """
+        instrument = ZkInstrument('source', interval=60)
+        instrument.summary = lambda now=None: ['summary']
+        instrument.record('get', 'base.get_znode', 0.5, now=instrument.started + 30)
+        self.assertEqual(instrument.reported, instrument.started)
+        instrument.record('get', 'base.get_znode', 0.1, now=instrument.started + 60)
+        self.assertEqual(instrument.reported, instrument.started + 60)
+        self.assertEqual(instrument.stats[('source', 'get', 'base.get_znode')], [2, 0.6, 0.5])
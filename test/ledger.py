@@ -0,0 +1,75 @@
+#
+# Copyright 2012-2023 Ghent University
+#
+# This file is part of vsc-zk,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://www.vscentrum.be),
+# the Flemish Research Foundation (FWO) (http://www.fwo.be/en)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# https://github.com/hpcugent/vsc-zk
+#
+# vsc-zk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Library General Public License as
+# published by the Free Software Foundation, either version 2 of
+# the License, or (at your option) any later version.
+#
+# vsc-zk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with vsc-zk. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Unit tests for the ledger of finished paths
+
+@author: Kenneth Waegeman (Ghent University)
+"""
+import json
+import os
+import shutil
+import tempfile
+
+from vsc.install.testing import TestCase
+from vsc.zk.checkpoint import unpack_indices
+from vsc.zk.rsync.ledger import COMPLETED, FAILED, QUARANTINED, Ledger
+
+
+class LedgerTest(TestCase):
+    """Tests for the ledger"""
+
+    def setUp(self):
+        """ Set up a temporary directory """
+        super().setUp()
+        self.ledgerdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """ Remove the temporary directory """
+        shutil.rmtree(self.ledgerdir)
+        super().tearDown()
+
+    def test_record(self):
+        """ Test the local log and the summaries """
+        filename = os.path.join(self.ledgerdir, 'sub', 'session.ledger')
+        ledger = Ledger(filename, interval=60)
+        self.assertFalse(ledger.is_due(force=True))
+        ledger.record(COMPLETED, '0:0_/tmp/a', index=0, code=0, output=None)
+        ledger.record(FAILED, '3:0_/tmp/d', index=3, code=23)
+        ledger.record(QUARANTINED, '0_/tmp/x', code=3)
+        self.assertFalse(ledger.is_due(now=ledger.saved + 10))
+        self.assertTrue(ledger.is_due(now=ledger.saved + 60))
+        self.assertTrue(ledger.is_due(force=True))
+
+        summaries = ledger.summaries(now=1000)
+        self.assertEqual({status: unpack_indices(data) for status, data in summaries.items()},
+                         {COMPLETED: {0}, FAILED: {3}, QUARANTINED: set()})
+        self.assertEqual(ledger.saved, 1000)
+        self.assertFalse(ledger.is_due(force=True))
+
+        with open(filename, encoding='utf8') as logfile:
+            entries = [json.loads(line) for line in logfile]
+        self.assertEqual([(entry['status'], entry['path'], entry['code']) for entry in entries],
+                         [(COMPLETED, '0:0_/tmp/a', 0), (FAILED, '3:0_/tmp/d', 23), (QUARANTINED, '0_/tmp/x', 3)])
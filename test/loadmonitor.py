@@ -0,0 +1,90 @@
+#
+# Copyright 2012-2023 Ghent University
+#
+# This file is part of vsc-zk,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://www.vscentrum.be),
+# the Flemish Research Foundation (FWO) (http://www.fwo.be/en)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# https://github.com/hpcugent/vsc-zk
+#
+# vsc-zk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Library General Public License as
+# published by the Free Software Foundation, either version 2 of
+# the License, or (at your option) any later version.
+#
+# vsc-zk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with vsc-zk. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Unit tests for the destination load monitor
+
+@author: Kenneth Waegeman (Ghent University)
+"""
+import os
+import shutil
+import tempfile
+
+from vsc.install.testing import TestCase
+from vsc.zk.rsync.loadmonitor import LoadMonitor, IOWAIT, MEMPRESSURE, CONNECTIONS
+
+TCP = """  sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode
+   0: 00000000:115C 00000000:0000 0A 00000000:00000000 00:00000000 00000000     0        0 1 1 0 100 0
+   1: 0100007F:115C 0100007F:D2F0 01 00000000:00000000 00:00000000 00000000     0        0 2 1 0 20 4 30 10 -1
+   2: 0100007F:115C 0100007F:D2F2 01 00000000:00000000 00:00000000 00000000     0        0 3 1 0 20 4 30 10 -1
+   3: 0100007F:115D 0100007F:D2F4 01 00000000:00000000 00:00000000 00000000     0        0 4 1 0 20 4 30 10 -1
+"""
+
+class LoadMonitorTest(TestCase):
+    """Tests for LoadMonitor"""
+
+    def setUp(self):
+        """ Create a fake proc directory """
+        super().setUp()
+        self.proc = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.proc, 'net'))
+        os.makedirs(os.path.join(self.proc, 'pressure'))
+        self.write('net/tcp', TCP)
+        self.write('pressure/memory', "some avg10=12.50 avg60=3.00 avg300=1.00 total=100\n"
+                                      "full avg10=1.00 avg60=0.00 avg300=0.00 total=10\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.proc)
+        super().tearDown()
+
+    def write(self, name, text):
+        with open(os.path.join(self.proc, name), 'w', encoding='utf8') as procfile:
+            procfile.write(text)
+
+    def test_metrics(self):
+        """ Test the parsing of the proc files """
+        monitor = LoadMonitor('/tmp', {IOWAIT: 50, MEMPRESSURE: 10, CONNECTIONS: 4})
+        monitor.PROC = self.proc
+        self.assertEqual(monitor.connections(4444), 2)
+        self.assertEqual(monitor.mempressure(), 12.5)
+        self.write('stat', "cpu  100 0 100 700 100 0 0 0 0 0\n")
+        self.assertEqual(monitor.iowait(), None)
+        self.write('stat', "cpu  200 0 200 800 200 0 0 0 0 0\n")
+        self.assertEqual(monitor.iowait(), 25.0)
+        self.assertEqual(monitor.sample(4444), {IOWAIT: None, MEMPRESSURE: 12.5, CONNECTIONS: 2})
+
+    def test_hysteresis(self):
+        """ Test going to overloaded and back """
+        monitor = LoadMonitor('/tmp', {MEMPRESSURE: 10}, hysteresis=0.5)
+        monitor.PROC = self.proc
+        self.assertTrue(monitor.overloaded())
+        self.write('pressure/memory', "some avg10=8.00 avg60=3.00 avg300=1.00 total=100\n")
+        self.assertTrue(monitor.overloaded())
+        self.write('pressure/memory', "some avg10=4.00 avg60=3.00 avg300=1.00 total=100\n")
+        self.assertFalse(monitor.overloaded())
+        self.write('pressure/memory', "some avg10=8.00 avg60=3.00 avg300=1.00 total=100\n")
+        self.assertFalse(monitor.overloaded())
+        os.remove(os.path.join(self.proc, 'pressure/memory'))
+        self.assertFalse(monitor.overloaded())
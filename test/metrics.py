@@ -0,0 +1,83 @@
+#
+# Copyright 2012-2023 Ghent University
+#
+# This file is part of vsc-zk,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://www.vscentrum.be),
+# the Flemish Research Foundation (FWO) (http://www.fwo.be/en)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# https://github.com/hpcugent/vsc-zk
+#
+# vsc-zk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Library General Public License as
+# published by the Free Software Foundation, either version 2 of
+# the License, or (at your option) any later version.
+#
+# vsc-zk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with vsc-zk. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Unit tests for the zkrsync metrics
+
+@author: Kenneth Waegeman (Ghent University)
+"""
+
+import os
+import shutil
+import tempfile
+from urllib.request import urlopen
+
+from vsc.install.testing import TestCase
+
+from vsc.zk.rsync.metrics import Metrics
+
+
+class MetricsTest(TestCase):
+    """ Test the zkrsync metrics """
+
+    def test_render(self):
+        """ Test updating metrics and rendering them in the exposition format """
+        metrics = Metrics({'session': 'new'})
+        metrics.inc('zkrsync_paths_total', status='completed')
+        metrics.inc('zkrsync_paths_total', 2, status='completed')
+        metrics.set('zkrsync_destinations', 1, state='paused')
+        metrics.observe('zkrsync_rsync_duration_seconds', 5, status='completed')
+        metrics.observe('zkrsync_rsync_duration_seconds', 100000, status='completed')
+        self.assertErrorRegex(Exception, 'Unknown metric', metrics.inc, 'zkrsync_nothing')
+
+        lines = metrics.render().splitlines()
+        self.assertTrue('# TYPE zkrsync_paths_total counter' in lines)
+        self.assertTrue('zkrsync_paths_total{session="new",status="completed"} 3' in lines)
+        self.assertTrue('zkrsync_destinations{session="new",state="paused"} 1' in lines)
+        self.assertTrue('zkrsync_rsync_duration_seconds_bucket{session="new",status="completed",le="1"} 0' in lines)
+        self.assertTrue('zkrsync_rsync_duration_seconds_bucket{session="new",status="completed",le="10"} 1' in lines)
+        self.assertTrue('zkrsync_rsync_duration_seconds_bucket{session="new",status="completed",le="+Inf"} 2' in lines)
+        self.assertTrue('zkrsync_rsync_duration_seconds_sum{session="new",status="completed"} 100005' in lines)
+        self.assertTrue('zkrsync_rsync_duration_seconds_count{session="new",status="completed"} 2' in lines)
+
+        metrics.clear('zkrsync_destinations')
+        self.assertFalse('zkrsync_destinations' in metrics.render())
+
+    def test_export(self):
+        """ Test writing the metrics textfile and serving the metrics """
+        metrics = Metrics()
+        metrics.set('zkrsync_paths_remaining', 7)
+        metricsdir = tempfile.mkdtemp()
+        textfile = os.path.join(metricsdir, 'zkrsync.prom')
+        metrics.write_textfile(textfile)
+        with open(textfile, encoding='utf8') as metricsfile:
+            self.assertTrue('zkrsync_paths_remaining 7\n' in metricsfile.read())
+        self.assertEqual(os.listdir(metricsdir), ['zkrsync.prom'])
+        shutil.rmtree(metricsdir)
+
+        port = metrics.serve(0, '127.0.0.1')
+        with urlopen(f'http://127.0.0.1:{port}/metrics') as response:
+            self.assertTrue(b'zkrsync_paths_remaining 7\n' in response.read())
+        metrics.shutdown()
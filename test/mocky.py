@@ -84,11 +84,14 @@ class Party:
 
 class LockingQueue:
     def __init__(self, thingy, name, **kwargs):
-        pass
+        self.path = name
+        self.processing_element = None
     def put(self, something):
         pass
     def consume(self):
         pass
+    def release(self):
+        pass
     def __len__(self):
         return 0
 
@@ -0,0 +1,86 @@
+#
+# Copyright 2012-2023 Ghent University
+#
+# This file is part of vsc-zk,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://www.vscentrum.be),
+# the Flemish Research Foundation (FWO) (http://www.fwo.be/en)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# https://github.com/hpcugent/vsc-zk
+#
+# vsc-zk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Library General Public License as
+# published by the Free Software Foundation, either version 2 of
+# the License, or (at your option) any later version.
+#
+# vsc-zk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with vsc-zk. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Unit tests for the rsync output log
+
+@author: Kenneth Waegeman (Ghent University)
+"""
+
+import json
+import os
+import shutil
+import tempfile
+
+from vsc.install.testing import TestCase
+
+from vsc.zk.rsync.outputlog import OutputLog
+
+
+class OutputLogTest(TestCase):
+    """ Test the rsync output log """
+
+    def setUp(self):
+        """ Create a directory for the output """
+        super().setUp()
+        self.outputdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """ Remove the output """
+        shutil.rmtree(self.outputdir)
+        super().tearDown()
+
+    def test_output(self):
+        """ Test writing, finding and rotating the output of runs """
+        filename = os.path.join(self.outputdir, 'worker.output')
+        outputlog = OutputLog(filename, maxbytes=20, backups=2)
+        self.assertEqual(outputlog.read('0_/a'), None)
+
+        outputlog.start('0_/a')
+        outputlog.write('a1\na2\n')
+        outputlog.start('0_/b')
+        outputlog.write('b1\n')
+        self.assertEqual(outputlog.read('0_/a'), 'a1\na2\n')
+        self.assertEqual(outputlog.read('0_/b'), 'b1\n')
+
+        outputlog.write('b2' * 10)
+        outputlog.start('0_/a')  # over maxbytes: a new part
+        outputlog.write('a3\n')
+        self.assertEqual(outputlog.part, 2)
+        self.assertEqual(outputlog.read('0_/a'), 'a3\n')
+        self.assertEqual(outputlog.read('0_/b'), 'b1\n' + 'b2' * 10)
+
+        outputlog.write('c' * 20)
+        outputlog.start('0_/c')
+        outputlog.close()
+        self.assertEqual(sorted(os.listdir(self.outputdir)),
+                         ['worker.output.2', 'worker.output.3', 'worker.output.index'])
+        self.assertEqual(outputlog.read('0_/b'), None)
+        # the index only has the runs of the parts that are kept
+        with open(f'{filename}.index', encoding='utf8') as indexfile:
+            self.assertEqual([json.loads(line)['path'] for line in indexfile], ['0_/a', '0_/c'])
+
+        # a new output log goes on in the last part
+        self.assertEqual(OutputLog(filename).part, 3)
@@ -0,0 +1,67 @@
+#
+# Copyright 2012-2023 Ghent University
+#
+# This file is part of vsc-zk,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://www.vscentrum.be),
+# the Flemish Research Foundation (FWO) (http://www.fwo.be/en)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# https://github.com/hpcugent/vsc-zk
+#
+# vsc-zk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Library General Public License as
+# published by the Free Software Foundation, either version 2 of
+# the License, or (at your option) any later version.
+#
+# vsc-zk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU Library General Public License
+# along with vsc-zk. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Unit tests for topology
+
+@author: Kenneth Waegeman (Ghent University)
+"""
+import os
+import shutil
+import tempfile
+
+import vsc.zk.topology as topo
+
+from vsc.install.testing import TestCase
+
+class TopologyTest(TestCase):
+    """Tests for topology"""
+
+    def test_prefix_key(self):
+        """ Test the topology keys from a prefix map """
+        prefixmap = topo.parse_prefixmap(['/gpfs/home:home', '/gpfs/home/vo:vo/pool', '/gpfs/data/:data'])
+        self.assertEqual(prefixmap[0], ('/gpfs/home/vo', 'vo/pool'))
+        self.assertEqual(topo.topology_key('/gpfs/home/vo/sub', topo.TOPO_PREFIX, prefixmap), 'vo_pool')
+        self.assertEqual(topo.topology_key('/gpfs/home/vol', topo.TOPO_PREFIX, prefixmap), 'home')
+        self.assertEqual(topo.topology_key('/gpfs/data', topo.TOPO_PREFIX, prefixmap), 'data')
+        self.assertEqual(topo.topology_key('/scratch', topo.TOPO_PREFIX, prefixmap), topo.DEFAULT_KEY)
+        self.assertRaises(Exception, topo.parse_prefixmap, ['/gpfs/home'])
+
+    def test_dev_and_command_key(self):
+        """ Test the device and command topology keys """
+        basedir = tempfile.mkdtemp()
+        try:
+            self.assertEqual(topo.topology_key(basedir, topo.TOPO_DEV), str(os.stat(basedir).st_dev))
+            self.assertEqual(topo.topology_key(basedir, topo.TOPO_COMMAND, command='basename %(path)s'),
+                             os.path.basename(basedir))
+            self.assertEqual(topo.topology_key(basedir, topo.TOPO_COMMAND, command='false'), topo.DEFAULT_KEY)
+        finally:
+            shutil.rmtree(basedir)
+
+    def test_interleave_paths(self):
+        """ Test the round robin ordering of paths over their keys """
+        paths = ['a1', 'a2', 'a3', 'b1', 'c1', 'c2']
+        self.assertEqual(topo.interleave_paths(paths, lambda path: path[0]), ['a1', 'b1', 'c1', 'a2', 'c2', 'a3'])
+        self.assertEqual(topo.interleave_paths([], lambda path: path[0]), [])
@@ -28,12 +28,19 @@ Unit tests for VscKazooClient and childs
 
 @author: Kenneth Waegeman (Ghent University)
 """
+import gzip
+import json
+import os
+import shutil
 import sys
+import tempfile
+import threading
 import mock
 
 from pathlib import Path
 
 from kazoo.client import KazooClient
+from kazoo.exceptions import CancelledError, LockTimeout, NodeExistsError, NoNodeError
 from kazoo.recipe.party import Party
 from kazoo.recipe.queue import LockingQueue
 
@@ -45,10 +52,67 @@ sys.modules['kazoo.recipe.counter'] = __import__('mocky')
 
 from vsc.install.testing import TestCase
 from vsc.utils.cache import FileCache
-from vsc.zk.base import VscKazooClient, RunWatchLoopLog, ZKRS_NO_SUCH_SESSION_EXIT_CODE
+from vsc.zk.base import (ChildrenCache, ChildrenChanged, RankedLockingQueue, RevocableLockingQueue, VscKazooClient,
+                         RunWatchLoopLog, ZKRS_NO_SUCH_SESSION_EXIT_CODE)
 from vsc.zk.rsync.controller import RsyncController
-from vsc.zk.rsync.destination import RsyncDestination
-from vsc.zk.rsync.source import RsyncSource
+from vsc.zk.rsync.destination import RsyncDestination, RunDestination
+from vsc.utils.run import RunLoopException
+from vsc.zk.rsync.ledger import COMPLETED, FAILED, QUARANTINED, Ledger
+from vsc.zk.rsync.source import RsyncSource, RunRsync, RSYNC_REVOKED_EXITCODE, RSYNC_STALL_EXITCODE
+
+def fake_znodes(zkclient):
+    """ Back the znode operations of a mocked client with a dict, returns the dict """
+    znodes = {}
+    sequence = [0]
+
+    def create(path, value=b'', makepath=False, sequence_node=False):
+        if sequence_node:
+            path = f'{path}{sequence[0]:010d}'
+            sequence[0] += 1
+        if path in znodes:
+            raise NodeExistsError()
+        znodes[path] = value
+        return path
+
+    def get(path):
+        if path not in znodes:
+            raise NoNodeError()
+        return znodes[path], None
+
+    def set_value(path, value):
+        get(path)
+        znodes[path] = value
+
+    def get_children(path):
+        if not zkclient.exists(path):
+            raise NoNodeError()
+        return sorted({znode[len(path) + 1:].split('/')[0] for znode in znodes if znode.startswith(f'{path}/')})
+
+    def delete(path, recursive=False):
+        for znode in list(znodes):
+            if znode == path or (recursive and znode.startswith(f'{path}/')):
+                del znodes[znode]
+
+    def async_result(func, *args):
+        result = mock.Mock()
+        try:
+            result.get.return_value = func(*args)
+        except NoNodeError as err:
+            result.get.side_effect = err
+        return result
+
+    zkclient.create = lambda path, value=b'', makepath=False, sequence=False, **kwargs: create(path, value, makepath,
+                                                                                         sequence)
+    zkclient.get = get
+    zkclient.set = set_value
+    zkclient.exists = lambda path: path in znodes or any(znode.startswith(f'{path}/') for znode in znodes)
+    zkclient.get_children = get_children
+    zkclient.delete = delete
+    zkclient.get_async = lambda path: async_result(get, path)
+    zkclient.get_children_async = lambda path: async_result(get_children, path)
+    zkclient.delete_async = lambda path: async_result(delete, path)
+    return znodes
+
 
 class zkClientTest(TestCase):
 
@@ -66,6 +130,49 @@ class zkClientTest(TestCase):
         zkclient.set_ready()
         self.assertTrue(zkclient.is_ready())
 
+    def test_wait_for_children(self):
+        """ Test waiting on a condition on the children of a znode """
+        zkclient = VscKazooClient('dummy')
+        zkclient.handler = mock.Mock(event_object=threading.Event)
+        zkclient.retry = lambda func, *args, **kwargs: func(*args, **kwargs)
+        states = [['a', 'b'], ['a'], []]
+        watches = []
+
+        def get_children(path, watch=None):
+            self.assertEqual(path, '/admin/new/children')
+            watches.append(watch)
+            children = states.pop(0)
+            if states:
+                watch('changed')  # the watch fires on the next change
+            return children
+        zkclient.get_children = get_children
+        self.assertEqual(zkclient.wait_for_children('new/children', lambda children: not children), [])
+        self.assertEqual(len(watches), 3)
+        self.assertEqual(len(set(watches)), 1)  # one watcher per call, kazoo keeps it only once
+
+        zkclient.get_children = mock.Mock(side_effect=NoNodeError)
+        zkclient.exists = mock.Mock(return_value=None)
+        self.assertEqual(zkclient.wait_for_children('new/children', lambda children: not children), [])
+        self.assertEqual(zkclient.wait_for_children('new/children', lambda children: children, 0.1), None)
+
+    @mock.patch('vsc.zk.base.ChildrenWatch')
+    def test_children_changed(self, mock_watch):
+        """ Test waiting again and again for changes of the children with one persistent watch """
+        zkclient = VscKazooClient('dummy')
+        zkclient.handler = mock.Mock(event_object=threading.Event)
+        changed = ChildrenChanged(zkclient, '/admin/new/children')
+        mock_watch.assert_called_once_with(zkclient, '/admin/new/children', changed.update)
+        self.assertEqual(changed.update(['a']), None)
+        self.assertTrue(changed.wait(0.1))
+        self.assertFalse(changed.wait(0.1))  # cleared by the previous wait
+        changed.update([])
+        changed.update(['b'])
+        self.assertTrue(changed.wait(0.1))
+        changed.stop()
+        self.assertEqual(changed.update(['c']), False)  # removes the watch
+        self.assertFalse(changed.wait(0.1))
+        self.assertEqual(mock_watch.call_count, 1)
+
     def test_rsync_params(self):
         """ Test some parameters of Source, Destination and Controller classes """
         # Path check failed test
@@ -102,6 +209,28 @@ class zkClientTest(TestCase):
         filec = Path(filen).read_text(encoding='utf8')
         self.assertEqual(filec, res)
 
+    def test_rsync_roots(self):
+        """ Test multiple rsync roots and the generation of the daemon config file for them"""
+        res = ("[zkrs-new]\npath = /tmp\nread only = no\nuid = root\ngid = root\n\n"
+               "[zkrs-new-scratch]\npath = /tmp\nread only = no\nuid = root\ngid = root\n\n")
+        zkclient = RsyncDestination('dummy', rsyncpath='/tmp', session='new', rsyncroots=['scratch:/tmp/'])
+        self.assertEqual(zkclient.rsyncroots, {'': '/tmp', 'scratch': '/tmp'})
+        self.assertEqual(zkclient.module_name('scratch'), 'zkrs-new-scratch')
+        filen = zkclient.generate_daemon_config()
+        filec = Path(filen).read_text(encoding='utf8')
+        self.assertEqual(filec, res)
+
+        self.assertRaises(Exception, RsyncController, 'dummy', rsyncroots=['sc_ratch:/tmp'])
+        self.assertRaises(Exception, RsyncController, 'dummy', rsyncroots=['scratch:/tmp', 'scratch:/tmp'])
+        self.assertRaises(Exception, RsyncController, 'dummy')
+
+        zkclient = RsyncSource('dummy', netcat=True, rsyncpath='/path/dummy', rsyncdepth=2,
+                               rsyncroots=['data:/path/data'], rsubpaths=['3_a1', '2_/path/data/b1'])
+        self.assertEqual(zkclient.root_rsubpaths(''), ['3_a1'])
+        self.assertEqual(zkclient.root_rsubpaths('data'), ['2_/path/data/b1'])
+        filen = zkclient.generate_file('/path/data/some/path', 'data')
+        self.assertEqual(Path(filen).read_text(encoding='utf8'), 'some/path/')
+
     def test_activate_and_pausing_dests(self):
         """ Test the pausing , disabling and activation of destinations """
         zkclient = RsyncDestination('dummy', rsyncpath='/tmp', session='new')
@@ -128,6 +257,77 @@ class zkClientTest(TestCase):
         val, _ = zkclient.getstr('/admin/rsync/new/dests/test')
         self.assertEqual(val, 'disabled')
 
+    @mock.patch('vsc.zk.rsync.destination.RsyncDestination.port_bindable')
+    def test_reserve_port(self, mock_bindable):
+        """ Test the lock free port reservation """
+        zkclient = RsyncDestination('dummy', rsyncpath='/tmp', session='new', startport=4444)
+        portdir = f'/admin/rsync/new/usedports/{zkclient.daemon_host}'
+        zkclient.get_children = mock.Mock(return_value=['4444'])
+        mock_bindable.side_effect = lambda port: port != 4445
+        create = zkclient.create
+
+        def create_port(path, value, **kwargs):
+            if path == f'{portdir}/4446':
+                raise NodeExistsError  # claimed by another destination in the meantime
+            return create(path, value, **kwargs)
+        zkclient.create = create_port
+        zkclient.reserve_port()
+        self.assertEqual(zkclient.port, 4447)
+        self.assertTrue(zkclient.exists(f'{portdir}/4447'))
+        self.assertEqual(zkclient.getstr(f'/admin/rsync/new/portmap/{zkclient.whoami}')[0], '4447')
+
+        zkclient.daemon_port = 4446
+        self.assertRaises(Exception, zkclient.reserve_port)
+        zkclient.daemon_port = 4448
+        zkclient.reserve_port()
+        self.assertEqual(zkclient.port, 4448)
+
+    @mock.patch('vsc.zk.rsync.destination.RsyncDestination.dest_queue', new_callable=mock.PropertyMock)
+    def test_drain(self, mock_queue):
+        """ Test requesting a drain and the idle check of a draining destination """
+        zkclient = RsyncDestination('dummy', rsyncpath='/tmp', session='new')
+        zkclient.drain(['host1:123'])
+        self.assertTrue(zkclient.exists('/admin/rsync/new/drain/host1:123'))
+
+        zkclient.port = 4444
+        mock_queue.return_value.path = '/admin/rsync/new/destQueue'
+        zkclient.get_children = mock.Mock(return_value=['entry1'])
+        zkclient.set('/admin/rsync/new/destQueue/entries/entry1', f'4444:{zkclient.whoami}'.encode())
+        zkclient.load_monitor.connections = mock.Mock(return_value=0)
+        self.assertFalse(zkclient.is_idle())
+        zkclient.set('/admin/rsync/new/destQueue/entries/entry1', b'4445:otherdest')
+        self.assertTrue(zkclient.is_idle())
+        zkclient.load_monitor.connections.return_value = 2
+        self.assertFalse(zkclient.is_idle())
+
+        # the draining destination takes its own entries out of the queue, unless a source holds them
+        znodes = fake_znodes(zkclient)
+        entries = '/admin/rsync/new/destQueue/entries'
+        zkclient.create(f'{entries}/entry1', f'4444:{zkclient.whoami}'.encode(), makepath=True)
+        zkclient.create(f'{entries}/entry2', f'4444:{zkclient.whoami}'.encode())
+        zkclient.create(f'{entries}/entry3', b'4445:otherdest')
+        zkclient.create('/admin/rsync/new/destQueue/taken/entry2', b'source', makepath=True)
+        zkclient.load_monitor.connections.return_value = 0
+        zkclient.leave_queue()
+        self.assertEqual(sorted(znodes), [f'{entries}/entry2', f'{entries}/entry3',
+                                          '/admin/rsync/new/destQueue/taken/entry2'])
+        self.assertFalse(zkclient.is_idle())
+        zkclient.delete('/admin/rsync/new/destQueue/taken/entry2')  # released by the source
+        zkclient.leave_queue()
+        self.assertEqual(list(znodes), [f'{entries}/entry3'])
+        self.assertTrue(zkclient.is_idle())
+
+        # the run loop of a draining destination pauses it, empties its queue entries and stops when idle
+        watchclient = mock.Mock(draining=True, prewarm=False)
+        watchclient.is_ready.return_value = False
+        watchclient.is_idle.return_value = True
+        runner = RunDestination('rsync', watchclient=watchclient)
+        runner._loop_count = RunDestination.WAITLOOPS
+        runner._loop_process_output('')
+        watchclient.pause.assert_called_once()
+        watchclient.leave_queue.assert_called_once()
+        watchclient.set_ready.assert_called_once()
+
     def test_wirte_donefile(self):
         """ Test the writing of the values to a cache file when done"""
         donefile = "/tmp/done"
@@ -144,10 +344,618 @@ class zkClientTest(TestCase):
         self.assertEqual(values, stats)
 
 
+    @mock.patch('vsc.zk.rsync.source.RsyncSource.get_workers')
+    def test_bwlimit_share(self, mock_workers):
+        """ Test the division of the bandwidth budget among the workers """
+        zkclient = RsyncSource('dummy', session='new', netcat=True, rsyncpath='/path/dummy', rsyncdepth=2)
+        mock_workers.return_value = ['src1:0', 'src2:0']
+        self.assertFalse([flag for flag in zkclient.get_flags('nofile', 0) if flag.startswith('--bwlimit')])
+        zkclient.bw_budget = 1000
+        self.assertTrue('--bwlimit=500' in zkclient.get_flags('nofile', 0))
+        mock_workers.return_value = ['src1:0', 'src1:1', 'src2:0', 'src2:1']
+        self.assertEqual(zkclient.bwlimit_share(), 250)
+        mock_workers.return_value = []
+        self.assertEqual(zkclient.bwlimit_share(), 1000)
+
+    def test_dest_rank(self):
+        """ Test the ranking of destinations by locality and load """
+        zkclient = RsyncSource('dummy', session='new', netcat=True, rsyncpath='/path/dummy', rsyncdepth=2,
+                               locality=['rack1', 'row1', 'dc1'], destpolicy='best')
+        self.assertEqual(zkclient.locality_labels('host1.rack1.dc1.example.org'),
+                         ['rack1.dc1.example.org', 'dc1.example.org', 'example.org', 'org'])
+        self.assertEqual(zkclient.locality_labels('host1', ['rack2']), ['rack2'])
+
+        zkclient.caches = {'destinfo': ChildrenCache(zkclient, '/admin/rsync/new/destinfo')}
+        infos = {
+            'near': b'{"locality": ["rack1", "row1", "dc1"], "load": 0.9}',
+            'idle': b'{"locality": ["rack3", "row1", "dc1"], "load": 0.1}',
+            'busy': b'{"locality": ["rack4", "row1", "dc1"], "load": 0.7}',
+            'far': b'{"locality": ["rack9", "row9", "dc2"], "load": 0.0}',
+        }
+        for whoami, info in infos.items():
+            zkclient.caches['destinfo'].update_child(whoami, info, 'stat')
+
+        dests = [b'4444:far', b'4445:unknown', b'4446:busy', b'4447:idle', b'4448:near']
+        ranked = sorted(dests, key=zkclient.dest_rank)
+        self.assertEqual(ranked, [b'4448:near', b'4447:idle', b'4446:busy', b'4444:far', b'4445:unknown'])
+
+        # the queue caches the values of its entries, as long as they are in the queue
+        queue = RankedLockingQueue(mock.Mock(), '/admin/rsync/new/destQueue', rank=zkclient.dest_rank)
+        queue._entries_path = '/admin/rsync/new/destQueue/entries'
+        values = dict(zip(['e1', 'e2', 'e3'], [b'4444:far', b'4448:near', b'4447:idle']))
+        queue.client = mock.Mock()
+        queue.client.get.side_effect = lambda path: (values[path.split('/')[-1]], None)
+        with mock.patch.object(RevocableLockingQueue.__bases__[0], '_filter_locked', create=True,
+                               side_effect=lambda entries, taken: [entry for entry in entries if entry not in taken]):
+            self.assertEqual(queue._filter_locked(['e1', 'e2', 'e3'], ['e3']), ['e2', 'e1'])
+            self.assertEqual(set(queue.entry_values), {'e1', 'e2'})
+            self.assertEqual(queue._filter_locked(['e2', 'e3'], []), ['e2', 'e3'])
+            self.assertEqual(set(queue.entry_values), {'e2', 'e3'})
+        self.assertRaises(Exception, RsyncSource, 'dummy', session='new', rsyncpath='/path/dummy',
+                          destpolicy='random')
+
+    @mock.patch('vsc.zk.rsync.source.RsyncSource.dest_is_sane')
+    @mock.patch('vsc.zk.rsync.source.RsyncSource.dest_queue', new_callable=mock.PropertyMock)
+    def test_cached_dest(self, mock_queue, mock_sane):
+        """ Test validating destinations with the local caches """
+        zkclient = RsyncSource('dummy', session='new', netcat=True, rsyncpath='/path/dummy', rsyncdepth=2)
+        zkclient.caches = {name: ChildrenCache(zkclient, name) for name in ['allsd', 'dests', 'portmap']}
+        zkclient.caches['allsd'].update_child('uuid1__party__', b'dest1', 'stat')
+        zkclient.caches['dests'].update_child('dest1', b'active', 'stat')
+        zkclient.caches['portmap'].update_child('dest1', b'4444', 'stat')
+        self.assertTrue(zkclient.cached_dest_ok('dest1', '4444'))
+        self.assertFalse(zkclient.cached_dest_ok('dest1', '4445'))
+        self.assertFalse(zkclient.cached_dest_ok('dest2', '4444'))
+
+        mock_queue.return_value.get.return_value = b'4444:dest1'
+        self.assertEqual(zkclient.try_a_dest(1), '4444:dest1')
+        mock_sane.assert_not_called()
+
+        # a paused destination is handled with zookeeper itself
+        zkclient.caches['dests'].update_child('dest1', b'paused', 'stat')
+        self.assertFalse(zkclient.cached_dest_ok('dest1', '4444'))
+        zkclient.caches['allsd'].update_children([])
+        self.assertEqual(zkclient.caches['allsd'].get('uuid1__party__'), None)
+        zkclient.caches['portmap'].update_child('dest1', None, None)
+        self.assertEqual(zkclient.caches['portmap'].get('dest1'), None)
+
+    @mock.patch('vsc.zk.rsync.source.RsyncSource.path_queue', new_callable=mock.PropertyMock)
+    def test_topology_slot(self, mock_paths):
+        """ Test acquiring a topology slot, and requeueing the path when the key is at its cap """
+        zkclient = RsyncSource('dummy', session='new', netcat=True, rsyncpath='/tmp', rsyncdepth=2,
+                               topology='prefix', topomap=['/tmp:tmp'], topocap=1)
+        zkclient.path_topology_key = mock.Mock(return_value='tmp')  # netcat clients have no topology
+        zkclient.Semaphore = mock.Mock()
+        semaphore = zkclient.Semaphore.return_value
+        self.assertEqual(zkclient.acquire_topology_slot('0_/tmp/a'), semaphore)
+        zkclient.Semaphore.assert_called_once_with('/admin/rsync/new/topology/tmp', zkclient.whoami, max_leases=1)
+        mock_paths.return_value.put.assert_not_called()
+
+        semaphore.acquire.side_effect = LockTimeout()
+        self.assertEqual(zkclient.acquire_topology_slot('0_/tmp/a'), False)
+        mock_paths.return_value.put.assert_called_once_with(b'0_/tmp/a', priority=zkclient.TOPO_PRIORITY)
+        mock_paths.return_value.consume.assert_called_once()
+
+    @mock.patch('vsc.zk.rsync.source.topology_key')
+    def test_topology_keys(self, mock_key):
+        """ Test reusing the topology keys computed during the walk """
+        zkclient = RsyncSource('dummy', session='new', netcat=True, rsyncpath='/tmp', rsyncdepth=2,
+                               topology='command', topocommand='echo %(path)s', topocap=1)
+        zkclient.netcat = False
+        znodes = fake_znodes(zkclient)
+        mock_key.return_value = 'computed'
+        marker = '/admin/rsync/new/checkpoint/walk'
+        zkclient.write_checkpoint(['0:0_/tmp/a', '1:0_/tmp/b'], topology=['k1', 'k2'])
+        walk = znodes.pop(marker)
+        self.assertEqual(zkclient.walked_topology_key(1, now=100), None)  # no checkpoint yet
+        znodes[marker] = walk
+        self.assertEqual(zkclient.walked_topology_key(1, now=130), None)  # not read again yet
+        self.assertEqual(zkclient.walked_topology_key(1, now=160), 'k2')
+        self.assertEqual(zkclient.path_topology_key('1:0_/tmp/b'), 'k2')
+        mock_key.assert_not_called()
+        self.assertEqual(zkclient.path_topology_key('0_/tmp/c'), 'computed')  # not walked
+        self.assertEqual(zkclient.path_topology_key('5:0_/tmp/c'), 'computed')
+
+    @mock.patch('vsc.zk.rsync.source.RsyncSource.dest_queue', new_callable=mock.PropertyMock)
+    @mock.patch('vsc.zk.rsync.source.RsyncSource.path_queue', new_callable=mock.PropertyMock)
+    def test_leases(self, mock_paths, mock_dests):
+        """ Test renewing leases and reaping the expired ones """
+        zkclient = RsyncSource('dummy', session='new', netcat=True, rsyncpath='/path/dummy', rsyncdepth=2,
+                               leasetimeout=60)
+        mock_paths.return_value = mock.Mock(path='/admin/rsync/new/pathQueue', processing_element=('p1', b'0_/a'))
+        mock_dests.return_value = mock.Mock(path='/admin/rsync/new/destQueue', processing_element=None)
+        lease = '/admin/rsync/new/leases/src:0'
+        zkclient.local.lease = 'new/leases/src:0'
+        zkclient.local.lease_renewed = 100
+        zkclient.heartbeat(now=110)
+        self.assertFalse(zkclient.exists(lease))  # not yet renewed
+        zkclient.heartbeat(now=120)
+        self.assertEqual(json.loads(zkclient.getstr(lease)[0]), {'path': 'p1', 'dest': None, 'lookahead': []})
+        self.assertFalse(zkclient.heartbeat(now=140))
+        with mock.patch.object(zkclient, 'set_znode', side_effect=NoNodeError()):
+            self.assertTrue(zkclient.heartbeat(now=160))  # revoked
+        self.assertEqual(mock_paths.return_value.processing_element, None)
+        mock_paths.return_value.processing_element = ('p1', b'0_/a')
+        zkclient.heartbeat(now=180)
+
+        versions = {'src:0': 1}
+        zkclient.get_children = mock.Mock(return_value=['src:0'])
+        zkclient.get_znode = mock.Mock(side_effect=lambda path: (zkclient.getstr(f'/admin/rsync/{path}')[0],
+                                                                  mock.Mock(version=versions['src:0'])))
+        zkclient.delete = mock.Mock()
+        zkclient.reap_leases(now=200)
+        zkclient.reap_leases(now=250)
+        versions['src:0'] = 2
+        zkclient.reap_leases(now=300)
+        zkclient.delete.assert_not_called()
+        zkclient.reap_leases(now=370)
+        zkclient.delete.assert_has_calls([mock.call('/admin/rsync/new/pathQueue/taken/p1'), mock.call(lease)])
+        self.assertEqual(zkclient.lease_versions, {})
+
+    @mock.patch('vsc.zk.rsync.source.RsyncSource.run_netcat')
+    @mock.patch('vsc.zk.rsync.source.RsyncSource.get_a_dest')
+    @mock.patch('vsc.zk.rsync.source.RsyncSource.path_queue', new_callable=mock.PropertyMock)
+    def test_revoked_worker(self, mock_paths, mock_dest, mock_run):
+        """ Test a worker that resumes after the master revoked its lease """
+        queue = RevocableLockingQueue(mock.Mock(), '/admin/rsync/new/pathQueue')
+        for method in ['consume', 'release']:
+            queue.processing_element = ('p1', b'0_/a')
+            with mock.patch.object(RevocableLockingQueue.__bases__[0], method, side_effect=NoNodeError()):
+                self.assertFalse(getattr(queue, method)())
+            self.assertEqual(queue.processing_element, None)
+        queue.processing_element = ('p1', b'0_/a')
+        with mock.patch.object(RevocableLockingQueue.__bases__[0], 'consume', return_value=False):
+            self.assertFalse(queue.consume())  # taken by another worker
+        self.assertEqual(queue.processing_element, None)
+
+        zkclient = RsyncSource('dummy', session='new', netcat=True, rsyncpath='/tmp', rsyncdepth=2, leasetimeout=60)
+        zkclient.finish_path = mock.Mock()
+        mock_dest.return_value = '4444:dest1:1'
+        mock_run.return_value = (0, 'output')
+        mock_paths.return_value.holds_lock.side_effect = NoNodeError()
+        self.assertEqual(zkclient.attempt_run('0:0_/tmp/a'), (0, 'output'))
+        zkclient.finish_path.assert_not_called()
+        self.assertEqual(mock_paths.return_value.processing_element, None)
+        mock_paths.return_value.holds_lock.side_effect = None
+        mock_paths.return_value.holds_lock.return_value = True
+        zkclient.attempt_run('0:0_/tmp/a')
+        zkclient.finish_path.assert_called_once_with('0:0_/tmp/a', COMPLETED, 0, 'output')
+
+    def test_rsync_watchdog(self):
+        """ Test killing rsyncs that stall """
+        procdir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(procdir, '1234'))
+        iofile = os.path.join(procdir, '1234', 'io')
+        Path(iofile).write_text('rchar: 1000\nwchar: 2000\nread_bytes: 0\n', encoding='utf8')
+
+        watchclient = mock.Mock(stalltimeout=60, minrate=10)
+        runner = RunRsync('rsync', watchclient=watchclient)
+        runner.PROC = procdir
+        runner._process = mock.Mock(pid=1234)
+        runner.output_bytes = 6
+        runner.stop_tasks = mock.Mock()
+        self.assertEqual(runner.progress(), 3006)
+
+        runner.check_progress(now=100)
+        Path(iofile).write_text('rchar: 2000\nwchar: 2000\n', encoding='utf8')
+        runner.check_progress(now=150)  # window not yet over
+        runner.check_progress(now=160)  # 1000 bytes in 60 seconds is fast enough
+        self.assertEqual(runner.window, (160, 4006))
+        Path(iofile).write_text('rchar: 2100\nwchar: 2000\n', encoding='utf8')
+        self.assertRaises(RunLoopException, runner.check_progress, now=220)
+        runner.stop_tasks.assert_called_once()
+        shutil.rmtree(procdir)
+
+        # the rsync of a worker whose lease was revoked is killed right away
+        watchclient.heartbeat.return_value = True
+        runner._process_output = ''
+        with self.assertRaises(RunLoopException) as killed:
+            runner._loop_process_output('output')
+        self.assertEqual(killed.exception.code, RSYNC_REVOKED_EXITCODE)
+        self.assertEqual(runner.stop_tasks.call_count, 2)
+
+    @mock.patch('vsc.zk.rsync.source.RsyncSource.dest_queue', new_callable=mock.PropertyMock)
+    @mock.patch('vsc.zk.rsync.source.Party')
+    def test_live_progress(self, mock_party, mock_dests):
+        """ Test parsing, publishing and aggregating the live progress of running rsyncs """
+        runner = RunRsync('rsync')
+        self.assertEqual(runner.parse_progress('sending incremental file list\n     32,768   1%   1.00MB/s    0:0'),
+                         None)
+        self.assertEqual(runner.parse_progress('0:01\r  1,048,576  10%'), (32768, 0))
+        self.assertEqual(runner.parse_progress('  2.00MB/s    0:00:02 (xfr#3, to-chk=5/10)\r'), (1048576, 3))
+        self.assertEqual(runner.parse_progress('\nNumber of files: 10 (reg: 8, dir: 2)\n'), (1048576, 3))
+
+        # only the tail of the output is kept, all of it goes to the output log
+        outputlog = mock.Mock()
+        runner = RunRsync('rsync', outputlog=outputlog)
+        runner.OUTPUT_TAIL = 10
+        runner._process_output = ''
+        for _ in range(10):
+            runner._process_output += 'file list\n'
+            runner._loop_process_output('file list\n')
+        self.assertTrue(len(runner._process_output) <= 20)
+        self.assertEqual(runner.output_bytes, 100)
+        self.assertEqual(outputlog.write.call_count, 10)
+
+        zkclient = RsyncSource('dummy', session='new', netcat=True, rsyncpath='/tmp', rsyncdepth=2,
+                               progressinterval=10, leasetimeout=0)
+        znodes = fake_znodes(zkclient)
+        self.assertTrue('--info=progress2' in zkclient.get_flags('files', False))
+        zkclient.join_workers(0)
+        zkclient.local.live_state = (100, 100, 0)
+        zkclient.publish_live((1000, 1), now=105)  # too soon
+        self.assertEqual(zkclient.live_progress()['rsyncs'], 0)
+        zkclient.publish_live((2000, 2), now=110)
+        self.assertEqual(zkclient.live_progress(), {'rsyncs': 1, 'bytes': 2000, 'files': 2, 'rate': 200})
+        self.assertEqual(zkclient.output_live(now=110)['rate'], 200)
+        self.assertEqual(zkclient.output_live(now=115), None)
+        zkclient.publish_live(None, now=112, force=True)
+        self.assertEqual(zkclient.live_progress()['rsyncs'], 0)
+
+        # an rsync that has no progress record yet is running since it started
+        zkclient.local.live_state = (200, 200, 0)
+        runner = RunRsync('rsync', watchclient=zkclient)
+        runner._process_output = ''
+        with mock.patch('time.time', return_value=215):
+            runner._loop_process_output('sending incremental file list\n')
+        self.assertEqual(zkclient.live_progress(), {'rsyncs': 1, 'bytes': 0, 'files': 0, 'rate': 0})
+        self.assertEqual(zkclient.local.live_state, (200, 215, 0))
+        zkclient.publish_live(None, now=220, force=True)
+        zkclient.leave_workers()
+        self.assertFalse(any('/live/' in znode for znode in znodes))
+
+        # the running rsync is credited to the concurrency controller as it goes
+        zkclient.concurrency = mock.Mock()
+        zkclient.local.credited = (0, 0)
+        zkclient.credit_progress(1000, 1)
+        zkclient.credit_progress(1500, 1)
+        self.assertEqual(zkclient.concurrency.progress.call_args_list, [mock.call(1000, 1), mock.call(500, 0)])
+        self.assertEqual(zkclient.local.credited, (1500, 1))
+
+    @mock.patch('vsc.zk.rsync.source.RsyncSource.path_queue', new_callable=mock.PropertyMock)
+    def test_handle_stall(self, mock_paths):
+        """ Test requeueing and quarantining stalled paths """
+        zkclient = RsyncSource('dummy', session='new', netcat=True, rsyncpath='/path/dummy', rsyncdepth=2,
+                               maxstalls=2)
+        zkclient.finish_path = mock.Mock()
+        with mock.patch('vsc.zk.rsync.source.Counter') as mock_counter:
+            mock_counter.return_value.__iadd__.return_value.value = 1
+            zkclient.handle_stall('0_/path/dummy/a')
+            mock_paths.return_value.put.assert_called_with(b'0_/path/dummy/a', priority=zkclient.STALL_PRIORITY)
+            zkclient.finish_path.assert_not_called()
+            mock_counter.return_value.__iadd__.return_value.value = 2
+            zkclient.handle_stall('0_/path/dummy/a')
+            zkclient.finish_path.assert_called_with('0_/path/dummy/a', QUARANTINED, RSYNC_STALL_EXITCODE)
+            self.assertEqual(mock_paths.return_value.consume.call_count, 2)
+
+    @mock.patch('vsc.zk.rsync.source.RsyncSource.run_netcat')
+    @mock.patch('vsc.zk.rsync.source.RsyncSource.get_a_dest')
+    @mock.patch('vsc.zk.rsync.source.RsyncSource.dest_queue', new_callable=mock.PropertyMock)
+    @mock.patch('vsc.zk.rsync.source.RsyncSource.path_queue', new_callable=mock.PropertyMock)
+    def test_exit_codes(self, mock_paths, mock_dests, mock_dest, mock_run):
+        """ Test the handling of the rsync exit codes """
+        zkclient = RsyncSource('dummy', session='new', netcat=True, rsyncpath='/tmp', rsyncdepth=2)
+        zkclient.finish_path = mock.Mock()
+        zkclient.schedule_retry = mock.Mock()
+        mock_dest.return_value = '4444:dest1:123'
+
+        mock_run.return_value = (24, None)
+        self.assertEqual(zkclient.attempt_run('0_/tmp/a'), (0, None))
+        zkclient.finish_path.assert_called_with('0_/tmp/a', COMPLETED, 0, None)
+        mock_paths.return_value.consume.assert_not_called()  # consumed by the caller
+
+        mock_run.return_value = (23, None)
+        self.assertEqual(zkclient.attempt_run('0_/tmp/a'), (23, None))
+        zkclient.schedule_retry.assert_called_with('0_/tmp/a', 23)
+        mock_dests.return_value.release.assert_not_called()
+
+        mock_run.return_value = (10, None)
+        zkclient.attempt_run('0_/tmp/a')
+        zkclient.schedule_retry.assert_called_with('0_/tmp/a', 10)
+        mock_dests.return_value.release.assert_called_once()
+
+        mock_run.return_value = (3, None)
+        zkclient.attempt_run('0_/tmp/a')
+        zkclient.finish_path.assert_called_with('0_/tmp/a', QUARANTINED, 3, None)
+        self.assertEqual(zkclient.schedule_retry.call_count, 2)
+        self.assertEqual(mock_paths.return_value.consume.call_count, 3)
+
+    @mock.patch('vsc.zk.rsync.source.time.time')
+    @mock.patch('vsc.zk.rsync.source.RsyncSource.path_counter')
+    def test_schedule_retry(self, mock_counter, mock_time):
+        """ Test the exponential backoff of retries """
+        zkclient = RsyncSource('dummy', session='new', netcat=True, rsyncpath='/tmp', rsyncdepth=2,
+                               maxretries=3, retrydelay=10)
+        zkclient.create = mock.Mock()
+        zkclient.finish_path = mock.Mock()
+        mock_time.return_value = 1000
+        for retries, due in [(1, 1010), (2, 1020), (3, 1040)]:
+            mock_counter.return_value.__iadd__.return_value.value = retries
+            zkclient.schedule_retry('0_/tmp/a', 10)
+            zkclient.create.assert_called_with(f'/admin/rsync/new/retries/{due * 1000:015d}-', b'0_/tmp/a',
+                                               sequence=True, makepath=True)
+        mock_counter.return_value.__iadd__.return_value.value = 4
+        zkclient.schedule_retry('0_/tmp/a', 10)
+        zkclient.finish_path.assert_called_with('0_/tmp/a', FAILED, 10)
+        self.assertEqual(zkclient.create.call_count, 3)
+
+    def test_lookahead(self):
+        """ Test taking the paths claimed ahead """
+        zkclient = RsyncSource('dummy', session='new', netcat=True, rsyncpath='/tmp', rsyncdepth=2, lookahead=2)
+        current = mock.Mock(processing_element=None)
+        ahead = [mock.Mock(processing_element=('p2', b'0_/tmp/b')), mock.Mock(processing_element=('p3', b'0_/tmp/c'))]
+        zkclient.local.path_queue = current
+        zkclient.local.lookahead = list(ahead)
+        prefetcher = mock.Mock()
+        prefetcher.is_alive.side_effect = [True, True, False]
+        zkclient.local.prefetcher = prefetcher
+        zkclient.heartbeat = mock.Mock()
+        ahead[0].get.return_value = b'0_/tmp/b'
+        self.assertEqual(zkclient.next_path(5), b'0_/tmp/b')
+        self.assertEqual(zkclient.local.path_queue, ahead[0])
+        self.assertEqual(zkclient.local.prefetcher, None)
+        # the lease is renewed while waiting for the claims ahead
+        prefetcher.join.assert_called_with(zkclient.PREFETCH_WAIT)
+        self.assertEqual(zkclient.heartbeat.call_count, 2)
+
+        # a path that is still held goes first
+        self.assertEqual(zkclient.next_path(5), ahead[0].get.return_value)
+        self.assertEqual(zkclient.local.lookahead, [ahead[1]])
+        zkclient.release_lookahead()
+        ahead[1].release.assert_called_once()
+        self.assertEqual(zkclient.local.lookahead, [])
+
+    def test_prewarm(self):
+        """ Test announcing paths to a destination and prewarming them there """
+        zkclient = RsyncSource('dummy', session='new', netcat=True, rsyncpath='/path/dummy', rsyncdepth=2,
+                               rsyncroots=['data:/path/data'], destprewarm=True)
+        self.assertFalse(zkclient.destprewarm)  # netcat paths are only numbers
+        zkclient.create = mock.Mock()
+        zkclient.local.lookahead = [mock.Mock(processing_element=('p2', b'1_data_/path/data/b'))]
+        zkclient.announce_paths('4444:dest1:123', '0_/path/dummy/a')
+        zkclient.announce_paths('4444:dest1:123', '1_data_/path/data/b')
+        self.assertEqual(zkclient.local.announced, ('dest1:123', {'1_data_/path/data/b'}))  # the done paths are pruned
+        announced = [json.loads(call[0][1]) for call in zkclient.create.call_args_list]
+        self.assertEqual(announced, [{'root': '', 'path': 'a', 'recursive': 0},
+                                     {'root': 'data', 'path': 'b', 'recursive': 1}])
+        self.assertEqual(zkclient.create.call_args[0][0], '/admin/rsync/new/prewarm/dest1:123/path-')
+
+        destclient = RsyncDestination('dummy', rsyncpath='/tmp', session='new', rsyncroots=['data:/tmp/data'],
+                                      verifypath=False)
+        prewarmpath = f'/admin/rsync/new/prewarm/{destclient.whoami}'
+        children = {'path-0001': announced[0], 'path-0002': announced[1],
+                    'path-0003': {'root': '', 'path': '../etc', 'recursive': 1}}
+        destclient.get_children = mock.Mock(return_value=list(children))
+        destclient.get = lambda path: (json.dumps(children[path.split('/')[-1]]).encode(), None)
+        destclient.delete = mock.Mock()
+        destclient.prewarm_pool = mock.Mock()
+        destclient.prewarm_pool.submit.side_effect = lambda *args, **kwargs: mock.Mock(**{'done.return_value': False})
+        destclient.process_prewarm()
+        destclient.prewarm_pool.submit.assert_not_called()  # nothing announced yet
+        destclient.prewarm_pending.set()
+        destclient.process_prewarm()
+        self.assertEqual([call[0][1:] for call in destclient.prewarm_pool.submit.call_args_list],
+                         [('/tmp/a', 0), ('/tmp/data/b', 1)])
+        self.assertEqual(destclient.delete.call_args_list[0][0][0], f'{prewarmpath}/path-0001')
+        self.assertEqual(destclient.delete.call_count, 3)
+
+        futures = list(destclient.prewarm_futures)
+        self.assertEqual(len(futures), 2)
+        destclient.stop_prewarm()
+        for future in futures:
+            future.cancel.assert_called_once()
+        destclient.prewarm_pool.shutdown.assert_called_once_with(wait=False)
+
+    @mock.patch('vsc.zk.rsync.source.RsyncSource.path_queue', new_callable=mock.PropertyMock)
+    def test_checkpoint(self, mock_paths):
+        """ Test writing a checkpoint, recording completed paths and resuming from it """
+        zkclient = RsyncSource('dummy', session='new', netcat=True, rsyncpath='/tmp', rsyncdepth=2)
+        zkclient.CHECKPOINT_CHUNK = 2
+        znodes = fake_znodes(zkclient)
+
+        self.assertEqual(zkclient.read_checkpoint(), None)
+        paths = [f'{idx}:0_/tmp/p{idx}' for idx in range(5)]
+        zkclient.write_checkpoint(paths)
+        self.assertEqual(len([znode for znode in znodes if '/paths/' in znode]), 3)
+        self.assertEqual(zkclient.read_checkpoint(), (paths, set()))
+
+        ledgerdir = tempfile.mkdtemp()
+        zkclient.ledger = Ledger(os.path.join(ledgerdir, 'ledger'), interval=60)
+        zkclient.finish_path(paths[1], COMPLETED, 0)
+        self.assertEqual(zkclient.read_checkpoint()[1], set())  # not saved yet
+        zkclient.ledger.saved -= 60
+        zkclient.finish_path(paths[3], COMPLETED, 0)
+        self.assertEqual(zkclient.read_checkpoint()[1], {1, 3})
+        zkclient.finish_path(paths[2], FAILED, 23)
+        zkclient.finish_path('0_/tmp/noindex', QUARANTINED, 3)
+        zkclient.save_ledger(force=True)
+        self.assertEqual(zkclient.ledger_indices(FAILED), {2})
+        self.assertEqual(zkclient.report_ledger(), {COMPLETED: 2, FAILED: 1, QUARANTINED: 0})
+
+        zkclient.stats = {'Number_of_files': 10}
+        zkclient.checkpoint_stats()
+        self.assertEqual(zkclient.checkpoint_costs(), [[None, None]] * 5)
+        self.assertEqual(zkclient.estimate_progress(now=100)['paths_done'], 3)
+        self.assertEqual(zkclient.read_estimate()['paths_pct'], 60.0)
+        counter = mock.MagicMock()
+        zkclient.counters = {'Number_of_files': counter}
+        mock_paths.return_value.path = '/admin/rsync/new/pathQueue'
+        self.assertEqual(zkclient.resume_pathqueue(), 5)
+        self.assertEqual([call[0][0] for call in mock_paths.return_value.put.call_args_list],
+                         [b'0:0_/tmp/p0', b'2:0_/tmp/p2', b'4:0_/tmp/p4'])  # failed paths are tried again
+        counter.__iadd__.assert_called_with(10)
+        # the failed path is counted once, with the status of its next run
+        self.assertEqual(zkclient.ledger_indices(FAILED), set())
+        zkclient.finish_path(paths[2], COMPLETED, 0)
+        zkclient.save_ledger(force=True)
+        self.assertEqual(zkclient.report_ledger(), {COMPLETED: 3, FAILED: 0, QUARANTINED: 0})
+        with open(os.path.join(ledgerdir, 'ledger'), encoding='utf8') as ledger:
+            self.assertEqual(len(ledger.readlines()), 5)
+        shutil.rmtree(ledgerdir)
+
+    def test_bulk_ops(self):
+        """ Test reading and deleting many znodes with asynchronous requests """
+        zkclient = RsyncSource('dummy', session='new', netcat=True, rsyncpath='/tmp', rsyncdepth=2)
+        zkclient.ASYNC_BATCH = 2
+        znodes = fake_znodes(zkclient)
+        for idx in range(5):
+            zkclient.create(f'/admin/rsync/new/a/{idx}/x', str(idx).encode(), makepath=True)
+        zkclient.create('/admin/rsync/new/b', b'b')
+        zkclient.create('/admin/rsync/new/c', b'c')
+        children = zkclient.children_many(['/admin/rsync/new/a', '/admin/rsync/new/none'])
+        self.assertEqual(len(children), 5)
+        self.assertEqual(list(zkclient.get_many(['/admin/rsync/new/a/1/x', '/admin/rsync/new/none',
+                                                 '/admin/rsync/new/b'])),
+                         [('/admin/rsync/new/a/1/x', b'1'), ('/admin/rsync/new/b', b'b')])
+        zkclient.delete_trees(['new/a', 'new/b', 'new/none'])
+        self.assertEqual(list(znodes), ['/admin/rsync/new/c'])
+
+    def test_write_report(self):
+        """ Test streaming the report and summarising it """
+        reportdir = tempfile.mkdtemp()
+        report = os.path.join(reportdir, 'report.jsonl.gz')
+        historydb = os.path.join(reportdir, 'history.db')
+        zkclient = RsyncSource('dummy', session='new', netcat=True, rsyncpath='/tmp', rsyncdepth=2, report=report,
+                               historydb=historydb)
+        zkclient.REPORT_TOP = 2
+        fake_znodes(zkclient)
+        zkclient.write_checkpoint(['0:0_/tmp/a', '1:0_/tmp/b', '2:0_/tmp/c', '3:0_/tmp/d'])
+        zkclient.ledger = Ledger(os.path.join(reportdir, 'ledger'))
+        for idx, (nbytes, duration) in enumerate([(100, 5), (300, 1), (200, 10)]):
+            zkclient.local.run_details = {'bytes': nbytes, 'files': 1, 'size': nbytes, 'duration': duration,
+                                          'dest': 'dest1'}
+            zkclient.finish_path(f'{idx}:0_/tmp/{"abc"[idx]}', COMPLETED, 0)
+        zkclient.save_ledger(force=True)
+
+        summary = zkclient.write_report(['3:0_/tmp/d'])
+        self.assertEqual(summary['bytes'], 600)
+        self.assertEqual(summary['files'], 3)
+        self.assertEqual(summary['slowest'], [['2:0_/tmp/c', 10], ['0:0_/tmp/a', 5]])
+        self.assertEqual(summary['largest'], [['1:0_/tmp/b', 300], ['2:0_/tmp/c', 200]])
+        with gzip.open(report, 'rt', encoding='utf8') as reportfile:
+            entries = [json.loads(line) for line in reportfile]
+        self.assertEqual([(entry['path'], entry['status']) for entry in entries],
+                         [('0:0_/tmp/a', COMPLETED), ('1:0_/tmp/b', COMPLETED), ('2:0_/tmp/c', COMPLETED),
+                          ('3:0_/tmp/d', 'unfinished')])
+        self.assertEqual(entries[0]['attempts'], 1)
+        self.assertEqual(entries[0]['source'], zkclient.whoami)
+        self.assertEqual(entries[0]['dest'], 'dest1')
+
+        self.assertTrue('zkrsync_paths_total{client="%s",session="new",status="completed"} 3' % zkclient.whoami
+                        in zkclient.metrics.render())
+        zkclient.metricsfile = os.path.join(reportdir, 'zkrsync.prom')
+        zkclient.get_all_hosts = mock.Mock(return_value=['a', 'b'])
+        zkclient.get_sources = mock.Mock(return_value=['a'])
+        zkclient.get_workers = mock.Mock(return_value=[])
+        zkclient.len_retries = mock.Mock(return_value=1)
+        zkclient.create('/admin/rsync/new/dests/dest1', b'active', makepath=True)
+        zkclient.collect_metrics(1)
+        with open(zkclient.metricsfile, encoding='utf8') as metricsfile:
+            lines = metricsfile.read().splitlines()
+        self.assertTrue('zkrsync_destinations{client="%s",session="new",state="active"} 1' % zkclient.whoami
+                        in lines)
+        self.assertTrue('zkrsync_party_members{client="%s",party="allsd",session="new"} 2' % zkclient.whoami
+                        in lines)
+
+        # the costs of this run predict the next one
+        zkclient.record_history(summary)
+        paths = ['0:0_/tmp/b', '1:0_/tmp/d']
+        self.assertEqual(zkclient.predict_costs(paths, {}), [[1, 300], [None, None]])
+        shutil.rmtree(reportdir)
+
+    @mock.patch('vsc.zk.base.ChildrenWatch')
+    def test_peaks(self, mock_watch):
+        """ Test counting the sources and workers of a stable fleet for the history """
+        zkclient = RsyncSource('dummy', session='new', netcat=True, rsyncpath='/tmp', rsyncdepth=2)
+        zkclient.paths_total = 0
+        zkclient.get_all_hosts = mock.Mock(return_value=['a', 'b', 'c', 'd'])
+        zkclient.get_sources = mock.Mock(return_value=['a', 'b', 'c'])
+        zkclient.get_workers = mock.Mock(return_value=['a:0', 'a:1', 'b:0', 'b:1'])
+        zkclient.isempty_pathqueue = mock.Mock(return_value=True)
+        zkclient.handler = mock.Mock(event_object=threading.Event)
+        zkclient.wait_and_keep_progress()
+        self.assertEqual((zkclient.peak_sources, zkclient.peak_workers), (2, 4))
+        mock_watch.assert_called_once()  # one watch for the whole session
+
+    @mock.patch('vsc.zk.rsync.source.RsyncSource.path_queue', new_callable=mock.PropertyMock)
+    def test_cleanup_history(self, mock_paths):
+        """ Test only adding finished runs to history """
+        zkclient = RsyncSource('dummy', session='new', netcat=True, rsyncpath='/tmp', rsyncdepth=2,
+                               historydb='/dummy/history.db')
+        fake_znodes(zkclient)
+        zkclient.create('/admin/rsync/new/pathQueue/entries/entry-0001', b'0:0_/tmp/a', makepath=True)
+        mock_paths.return_value = mock.MagicMock(path='/admin/rsync/new/pathQueue',
+                                                 _entries_path='/admin/rsync/new/pathQueue/entries')
+        mock_paths.return_value.__len__.return_value = 1
+        zkclient.len_retries = mock.Mock(return_value=0)
+        zkclient.report_ledger = mock.Mock(return_value={COMPLETED: 1, FAILED: 0, QUARANTINED: 0})
+        zkclient.write_report = mock.Mock(return_value={})
+        zkclient.record_history = mock.Mock()
+        zkclient.output_stats = mock.Mock()
+        zkclient.remove_ready_watch = mock.Mock()
+        zkclient.release_lock = mock.Mock()
+        zkclient.cleanup()
+        zkclient.record_history.assert_not_called()
+
+        mock_paths.return_value.__len__.return_value = 0
+        zkclient.cleanup()
+        zkclient.record_history.assert_called_once_with({'unfinished': 0, 'failed': 0, 'quarantined': 0,
+                                                         'completed': 1})
+
+    @mock.patch('vsc.zk.rsync.source.RsyncSource.shutdown_all')
+    @mock.patch('vsc.zk.rsync.source.RsyncSource.wait_and_keep_progress')
+    @mock.patch('vsc.zk.rsync.source.RsyncSource.build_pathqueue')
+    @mock.patch('vsc.zk.rsync.source.RsyncSource.len_paths')
+    def test_take_over(self, mock_len, mock_build, mock_wait, mock_shutdown):
+        """ Test a source taking over as master """
+        zkclient = RsyncSource('dummy', session='new', netcat=True, rsyncpath='/tmp', rsyncdepth=2)
+        zkclient.ledger_indices = mock.Mock(return_value=set())
+        zkclient.estimate_progress = mock.Mock(return_value=None)
+        zkclient.counters = {}
+        zkclient.Lock = mock.Mock()
+        mock_len.return_value = 3
+        watch = {}
+
+        def get(path):
+            if path == '/admin/rsync/new/checkpoint/walk':
+                return json.dumps({'total': 10, 'chunks': 1}).encode(), None
+            if path in watch:
+                return watch[path], None
+            raise NoNodeError()
+        zkclient.get = get
+        zkclient.create = mock.Mock()
+
+        # the lock of a session that is done
+        zkclient.watch_master()
+        zkclient.stop_contending()
+        zkclient.Lock.return_value.release.assert_called_once()
+        self.assertFalse(zkclient.promoted)
+        mock_wait.assert_not_called()
+
+        watch['/admin/rsync/new/watch/ready'] = b'start'
+        zkclient.watch_master()
+        zkclient.stop_contending()
+        self.assertTrue(zkclient.promoted)
+        self.assertEqual(zkclient.paths_total, 10)
+        mock_build.assert_not_called()
+        mock_wait.assert_called_once()
+        mock_shutdown.assert_called_once()
+
+        # not promoted: pending acquire is cancelled
+        zkclient.promoted = False
+        zkclient.Lock.return_value.cancel.reset_mock()
+        zkclient.Lock.return_value.acquire.side_effect = CancelledError()
+        zkclient.watch_master()
+        zkclient.stop_contending()
+        zkclient.Lock.return_value.cancel.assert_called_once()
+        mock_wait.assert_called_once()
+
     @mock.patch('vsc.zk.rsync.source.RsyncSource.len_paths')
     def test_get_state(self, mock_len):
 
         zkclient = RsyncSource('dummy', session='new', netcat=True, rsyncpath='/path/dummy', rsyncdepth=2)
+        zkclient.ledger_indices = mock.Mock(return_value={1})
+        zkclient.read_estimate = mock.Mock(return_value={'paths': 2, 'paths_done': 1, 'size_pct': 50.0, 'eta': 60})
         mock_len.return_value = 5
         self.assertEqual(zkclient.get_state(), 0)
         mock_len.return_value = 0